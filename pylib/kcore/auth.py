@@ -113,6 +113,8 @@ PY_VER = sys.version_info[0]
 DEBUG = False   # WARNING- outputs lots of secrets!
 DEFAULT_MAX_TIME_DELTA = 90
 DEFAULT_DB_FILENAME = 'kcore_auth_db.data.pcrypt'
+DNS_CACHE_TTL = 300          # seconds to remember hostname -> IP resolutions.
+DNS_NEGATIVE_CACHE_TTL = 30  # seconds to remember failed resolutions.
 TOKEN_VERSION = 'v2'
 
 
@@ -193,7 +195,15 @@ LAST_RECEIVED_TIMES = {}  # maps command-specific-key-name -> epoch seconds of m
 # LAST_RECEIVED_TIMES is not persisted beyond module lifetime.
 
 # key for the dict is generated by SharedSecret.lookup_key()
-REGISTRATION_DB = P.DictOfDataclasses(filename=None, rhs_type=SharedSecret)
+# watch=True means checking whether the db has changed doesn't need a syscall.
+REGISTRATION_DB = P.DictOfDataclasses(filename=None, rhs_type=SharedSecret, watch=True)
+
+# A snapshot of REGISTRATION_DB's contents, rebuilt only when the db is
+# reloaded, so lookups never see a db that's part-way through reloading.
+# Populated by get_registration_index(): (db_filename, db_passwd, cache_mtime, dict)
+REGISTRATION_INDEX = None
+
+DNS_CACHE = {}   # maps hostname -> (expiration epoch seconds, IP address or None)
 
 
 # ---------- general purpose helpers
@@ -204,11 +214,25 @@ def compare_hosts(host1, host2):
   if host1 == host2: return True
 
   # Translate hostnmes to IP addresses and then compare those.
+  host1 = resolve_host(host1)
+  host2 = resolve_host(host2)
+  return host1 is not None and host1 == host2
+
+
+def resolve_host(host):
+  '''Return IP address for a hostname (or pass through an IP address); None on failure.
+     Results are cached for DNS_CACHE_TTL (or DNS_NEGATIVE_CACHE_TTL for failures).'''
+  if not host: return None
+  if host[0].isdigit(): return host
+  time_now = time.time()
+  cached = DNS_CACHE.get(host)
+  if cached and cached[0] > time_now: return cached[1]
   try:
-    if not host1[0].isdigit(): host1 = socket.gethostbyname(host1)
-    if not host2[0].isdigit(): host2 = socket.gethostbyname(host2)
-  except Exception: return False
-  return host1 == host2
+    addr, ttl = socket.gethostbyname(host), DNS_CACHE_TTL
+  except Exception:
+    addr, ttl = None, DNS_NEGATIVE_CACHE_TTL
+  DNS_CACHE[host] = (time_now + ttl, addr)
+  return addr
 
 
 def debug_msg(msg):
@@ -336,6 +360,13 @@ def generate_token_given_shared_secret(
      This method is intended for internal-use by the verification logic.
   '''
 
+  return generate_token_given_shared_secret_str(
+    command, render_shared_secret(shared_secret), use_hostname, username, override_time)
+
+
+def render_shared_secret(shared_secret):
+  '''Returns the string form of shared_secret that is blended into token hashes.'''
+
   # shared_secret.server_override_hostname is a server-side only concept, if
   # generate_token_given_shared_secret() is called from the client side, it will
   # likely be blank or different, so we need to exclude it from the contents of
@@ -343,16 +374,19 @@ def generate_token_given_shared_secret(
   if shared_secret.server_override_hostname:
     temp = copy.copy(shared_secret)
     temp.server_override_hostname = None
-    shared_secret_str = str(temp)
-  else:
-    shared_secret_str = str(shared_secret)
+    return str(temp)
+  return str(shared_secret)
+
 
+def generate_token_given_shared_secret_str(
+    command, shared_secret_str, use_hostname=None, username='', override_time=None):
+  '''As generate_token_given_shared_secret(), but with a pre-rendered shared secret.'''
   hostname = use_hostname or socket.gethostname()
   time_now = override_time or now()
   plaintext_context = '%s:%s:%s:%s' % (TOKEN_VERSION, hostname, username, time_now)
   data_to_hash = '%s:%s:%s' % (plaintext_context, command, shared_secret_str)
   hashed = hasher(data_to_hash)
-  debug_msg(f'hash data: {data_to_hash} -> {hashed}')
+  if DEBUG: debug_msg(f'hash data: {data_to_hash} -> {hashed}')
   return '%s:%s' % (plaintext_context, hashed)
 
 
@@ -378,15 +412,55 @@ def verify_token(token, command, client_addr, db_passwd,
 
      Returns: VerificationResults
   '''
-  if not token: return VerificationResults(False, f'no authN token provided', None, None, None)
-  token_version, token_hostname, username, sent_time_str, sent_auth = token.split(':', 4)
-  shared_secret = get_shared_secret_from_db(db_passwd, db_filename, token_hostname, client_addr, username)
-  if not shared_secret:
-    return VerificationResults(False, f'could not find client registration for {token_hostname}:{username}', None, None, None)
+  return verify_tokens_batch(
+    [(token, command, client_addr)], db_passwd=db_passwd,
+    must_be_later_than_last_check=must_be_later_than_last_check,
+    max_time_delta=max_time_delta, db_filename=db_filename)[0]
 
-  return verify_token_given_shared_secret(
-    token=token, command=command, shared_secret=shared_secret, client_addr=client_addr,
-    must_be_later_than_last_check=must_be_later_than_last_check, max_time_delta=max_time_delta)
+
+def verify_tokens_batch(requests, db_passwd,
+                        must_be_later_than_last_check=True, max_time_delta=DEFAULT_MAX_TIME_DELTA,
+                        db_filename=DEFAULT_DB_FILENAME):
+  '''Verify a list of (token, command, client_addr) tuples, as per verify_token().
+
+     The registration db is consulted once for the whole batch, each token is
+     parsed once, and each matching registration's shared secret is rendered
+     once no matter how many tokens use it.
+
+     Returns: list of VerificationResults, in the same order as requests.
+  '''
+  reg = get_registration_index(db_passwd, db_filename)
+  rendered = {}  # maps SharedSecret.lookup_key() -> render_shared_secret() output
+  results = []
+  for token, command, client_addr in requests:
+    if not token:
+      results.append(VerificationResults(False, f'no authN token provided', None, None, None))
+      continue
+    fields = parse_token(token)
+    if not fields:
+      results.append(VerificationResults(False, 'token fails to parse', None, None, None))
+      continue
+    token_version, token_hostname, username, sent_time = fields
+    shared_secret = lookup_shared_secret(reg, token_hostname, client_addr, username)
+    if not shared_secret:
+      results.append(VerificationResults(False, f'could not find client registration for {token_hostname}:{username}', None, None, None))
+      continue
+    key = shared_secret.lookup_key()
+    shared_secret_str = rendered.get(key)
+    if shared_secret_str is None: shared_secret_str = rendered[key] = render_shared_secret(shared_secret)
+    results.append(verify_parsed_token(
+      token, fields, command, shared_secret, shared_secret_str, client_addr,
+      must_be_later_than_last_check, max_time_delta))
+  return results
+
+
+def parse_token(token):
+  '''Returns (token_version, token_hostname, username, sent_time), or None if token is malformed.'''
+  try:
+    token_version, token_hostname, username, sent_time_str, sent_auth = token.split(':', 4)
+    return token_version, token_hostname, username, int(sent_time_str)
+  except Exception:
+    return None
 
 
 def verify_token_given_shared_secret(
@@ -397,13 +471,19 @@ def verify_token_given_shared_secret(
   '''
   if isinstance(shared_secret, str): shared_secret = SharedSecret.from_string(shared_secret)
 
-  debug_msg(f'starting verification token={token} command={command} shared_secret={shared_secret} client_addr={client_addr}')
-  try:
-    token_version, token_hostname, username, sent_time_str, sent_auth = token.split(':', 4)
-    sent_time = int(sent_time_str)
-  except Exception:
-    return VerificationResults(False, 'token fails to parse', None, None, None)
+  if DEBUG: debug_msg(f'starting verification token={token} command={command} shared_secret={shared_secret} client_addr={client_addr}')
+  fields = parse_token(token)
+  if not fields: return VerificationResults(False, 'token fails to parse', None, None, None)
+
+  return verify_parsed_token(
+    token, fields, command, shared_secret, render_shared_secret(shared_secret), client_addr,
+    must_be_later_than_last_check, max_time_delta)
 
+
+def verify_parsed_token(token, fields, command, shared_secret, shared_secret_str, client_addr,
+                        must_be_later_than_last_check, max_time_delta):
+  '''Internal: the checks shared by all verification paths.  fields is from parse_token().'''
+  token_version, token_hostname, username, sent_time = fields
   if token_version != TOKEN_VERSION:
     return VerificationResults(False, f'Wrong token/protocol version.   Saw "{token_version}", expected "{TOKEN_VERSION}".', shared_secret.hostname, username, sent_time)
 
@@ -425,10 +505,10 @@ def verify_token_given_shared_secret(
       if sent_time <= LAST_RECEIVED_TIMES[keyname]:
         return VerificationResults(False, f'Received token is not later than a previous token: {sent_time} < {LAST_RECEIVED_TIMES[keyname]}', expected_hostname, username, sent_time)
 
-  expect_token = generate_token_given_shared_secret(
-    command=command, shared_secret=shared_secret,
+  expect_token = generate_token_given_shared_secret_str(
+    command=command, shared_secret_str=shared_secret_str,
     use_hostname=shared_secret.hostname, username=username, override_time=sent_time)
-  debug_msg(f'expect_token={expect_token} expected_hostname={expected_hostname}')
+  if DEBUG: debug_msg(f'expect_token={expect_token} expected_hostname={expected_hostname}')
   if token != expect_token: return VerificationResults(False, f'Token fails to verify  Saw "{token}", expected "{expect_token}".', expected_hostname, username, sent_time)
 
   return VerificationResults(True, 'ok', expected_hostname, username, sent_time)
@@ -437,36 +517,40 @@ def verify_token_given_shared_secret(
 # ---------- server-side persistence
 
 
-def get_shared_secret_from_db(db_passwd, db_filename, token_hostname, client_addr=None, username=''):
-  REGISTRATION_DB.filename = db_filename
-  REGISTRATION_DB.password = db_passwd
+def get_registration_index(db_passwd, db_filename):
+  '''Returns a dict snapshot of the registration db, keyed by SharedSecret.lookup_key().'''
+  global REGISTRATION_INDEX
+  if REGISTRATION_DB.filename != db_filename or REGISTRATION_DB.password != db_passwd:
+    REGISTRATION_DB.filename = db_filename
+    REGISTRATION_DB.password = db_passwd
+    REGISTRATION_INDEX = None
   reg = REGISTRATION_DB.get_data()
-  if not reg:
-    debug_msg(f'failed to load registration db: {REGISTRATION_DB.__dict__}')
-    return None
+  index = REGISTRATION_INDEX
+  if index and index[:3] == (db_filename, db_passwd, REGISTRATION_DB.cache_mtime): return index[3]
+  index = dict(reg or {})
+  REGISTRATION_INDEX = (db_filename, db_passwd, REGISTRATION_DB.cache_mtime, index)
+  return index
 
-  srch = f'{token_hostname}:{username}'
-  lookup = reg.get(srch)
-  if lookup:
-    debug_msg(f'returning token hostname match: {token_hostname}')
-    return lookup
-  else: debug_msg(f'trying {srch} in reg db didnt work...')
 
-  srch = f'{client_addr}:{username}'
-  lookup = reg.get(srch)
-  if lookup:
-    debug_msg(f'returning client address hostname match: {client_addr}')
-    return lookup
-  else: debug_msg(f'trying {srch} in reg db didnt work...')
+def get_shared_secret_from_db(db_passwd, db_filename, token_hostname, client_addr=None, username=''):
+  return lookup_shared_secret(get_registration_index(db_passwd, db_filename), token_hostname, client_addr, username)
+
+
+def lookup_shared_secret(reg, token_hostname, client_addr=None, username=''):
+  '''Find the registration for a token in a dict from get_registration_index().'''
+  if not reg:
+    if DEBUG: debug_msg(f'failed to load registration db: {REGISTRATION_DB.__dict__}')
+    return None
 
-  srch = f'*:{username}'
-  lookup = reg.get(srch)
-  if lookup:
-    debug_msg(f'returning wildcard hostname match')
-    return lookup
-  else: debug_msg(f'trying {srch} in reg db didnt work...')
+  # Search by the hostname in the token, then by the client's address, then for a wildcard registration.
+  for srch_host in (token_hostname, client_addr, '*'):
+    lookup = reg.get(f'{srch_host}:{username}')
+    if lookup:
+      if DEBUG: debug_msg(f'returning match for hostname {srch_host}')
+      return lookup
+    if DEBUG: debug_msg(f'trying {srch_host}:{username} in reg db didnt work...')
 
-  debug_msg(f'no matching entry in reg_db: {reg.__dict__}')
+  if DEBUG: debug_msg(f'no matching entry in reg_db: {reg}')
 
 
 def register(shared_secret, db_passwd, db_filename=DEFAULT_DB_FILENAME,
@@ -475,10 +559,12 @@ def register(shared_secret, db_passwd, db_filename=DEFAULT_DB_FILENAME,
   if shared_secret.version_tag != TOKEN_VERSION: return False
   if server_override_hostname: shared_secret.server_override_hostname = server_override_hostname
 
+  global REGISTRATION_INDEX
   REGISTRATION_DB.filename = db_filename
   REGISTRATION_DB.password = db_passwd
   with REGISTRATION_DB.get_rw() as db:
     db[shared_secret.lookup_key()] = shared_secret
+  REGISTRATION_INDEX = None
 
   return True
 
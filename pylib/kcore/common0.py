@@ -15,7 +15,7 @@ CIRCUITPYTHON = 'boot_out.txt' in os.listdir('/')
 PY_VER = sys.version_info[0]
 
 if not CIRCUITPYTHON:
-    import syslog, urllib
+    import atexit, collections, queue, syslog, threading, urllib
     if PY_VER == 2: import urllib2
     else: import urllib.parse, requests
 
@@ -159,9 +159,10 @@ for k, v in NAME_TO_LEVEL.items():
 
 # ---------- Internal state
 
-# In-memory queue of most recent log messages.
-LOG_QUEUE = []
-LOG_QUEUE_LEN_MAX = 40
+# In-memory queue of most recent log messages (LogRecord's, newest first).
+LOG_QUEUE_LEN_MAX = 40 if CIRCUITPYTHON else 10000
+LOG_QUEUE = None        # populated below, once _new_log_queue is defined.
+LOG_QUEUE_LOCK = threading.Lock() if not CIRCUITPYTHON else None
 
 # initial state set so that calls to log() will output to stderr BEFORE init_log() is called.
 FILTER_LEVEL_LOGFILE = NEVER   # default becomes INFO  once init_log() is called, if not otherwise set.
@@ -173,6 +174,7 @@ FILTER_LEVEL_MIN = DEBUG
 # ---------- Internal state
 
 LOG_FILENAME = None
+LOG_WRITER = None      # A LogWriter instance if init_log(async_write=True).
 LOG_TITLE = sys.argv[0] or 'log'
 FORCE_TIME = None
 
@@ -192,7 +194,9 @@ def init_log(log_title='log', logfile='logfile',
              log_queue_len=None, filter_level_logfile=None,
              filter_level_stdout=None, filter_level_stderr=None, filter_level_syslog=None,
              clear=False,        ## Delete existing logfile and clear internal queue.
+             async_write=False,  ## Write the logfile from a background thread; see LogWriter.
              force_time=None):   ## force_time is for testing only.
+    stop_log_writer()
     if clear: clear_log()
 
     global LOG_FILENAME, LOG_QUEUE_LEN_MAX, LOG_TITLE, FORCE_TIME
@@ -225,33 +229,44 @@ def init_log(log_title='log', logfile='logfile',
                 FILTER_LEVEL_STDERR = min(FILTER_LEVEL_STDERR, FILTER_LEVEL_LOGFILE)
                 FILTER_LEVEL_LOGFILE = NEVER
                 stderr('Also failed to open fallback logfile %s: %s.  Disabling logfile and setting stderr level from standard log level' % (LOG_FILENAME, e))
+    if async_write and LOG_FILENAME and LOG_FILENAME != '-' and not CIRCUITPYTHON:
+        global LOG_WRITER
+        LOG_WRITER = LogWriter(LOG_FILENAME)
     varz.set('log-filter-levels', 'file:%s, stdout: %s, stderr: %s, syslog: %s' % (
         getLevelName(FILTER_LEVEL_LOGFILE), getLevelName(FILTER_LEVEL_STDOUT),
         getLevelName(FILTER_LEVEL_STDERR), getLevelName(FILTER_LEVEL_SYSLOG)))
     return True
 
 
-def log(msg, level=INFO):
+def is_enabled(level):
+    '''Would a log at {level} go anywhere?  Use to skip expensive debug-only work.'''
+    return level >= FILTER_LEVEL_MIN
+
+
+# msg can be a %-format string with its args passed after level, or a
+# callable returning the message.  Either way, formatting only happens if the
+# message is actually emitted, so e.g. C.log_debug('x=%s', x) is nearly free
+# when debug logging is off, whereas C.log_debug(f'x={x}') is not.
+def log(msg, level=INFO, *args):
     if level < FILTER_LEVEL_MIN: return varz.bump('log-absorbed')
     if level >= ERROR: varz.bump('log-error-or-higher')
-    level_name = getLevelName(level)
-    time = FORCE_TIME or timestr()
-    msg2 = '%s: %s: %s: %s' % (LOG_TITLE, time, level_name, msg)
+    record = LogRecord(level, FORCE_TIME or time.time(), LOG_TITLE, msg, args)
 
-    # Add to internal in-memory queue
-    global LOG_QUEUE, LOG_QUEUE_LEN_MAX
-    if LOG_QUEUE_LEN_MAX and len(LOG_QUEUE) >= LOG_QUEUE_LEN_MAX: del LOG_QUEUE[LOG_QUEUE_LEN_MAX - 1]
-    LOG_QUEUE.insert(0, msg2)
+    # Add to internal in-memory queue (formatting is deferred until viewed).
+    if LOG_QUEUE_LOCK: LOG_QUEUE_LOCK.acquire()
+    LOG_QUEUE.appendleft(record)
+    if LOG_QUEUE_LOCK: LOG_QUEUE_LOCK.release()
 
     # Send to other destinations.
     if level >= FILTER_LEVEL_LOGFILE and LOG_FILENAME:
-        msg = '%s:%s:%s: %s' % (level_name, LOG_TITLE, time, msg)
-        if LOG_FILENAME == '-': print(msg)
+        line = record.file_format()
+        if LOG_FILENAME == '-': print(line)
+        elif LOG_WRITER: LOG_WRITER.write(line + '\n')
         else:
-            with open(LOG_FILENAME, 'a') as f: f.write(msg + '\n')
-    if level >= FILTER_LEVEL_STDOUT: print(msg2)
-    if level >= FILTER_LEVEL_STDERR: stderr(msg2)
-    if level >= FILTER_LEVEL_SYSLOG: log_syslog(msg2, level)
+            with open(LOG_FILENAME, 'a') as f: f.write(line + '\n')
+    if level >= FILTER_LEVEL_STDOUT: print(record)
+    if level >= FILTER_LEVEL_STDERR: stderr(record)
+    if level >= FILTER_LEVEL_SYSLOG: log_syslog(str(record), level)
     return True
 
 
@@ -264,7 +279,9 @@ def log_syslog(msg, level=INFO, ident=None, facility=None):
 
 def clear_log():
     global LOG_QUEUE
-    LOG_QUEUE = []
+    LOG_QUEUE = _new_log_queue(LOG_QUEUE_LEN_MAX)
+    # Have the writer (if any) finish with the old file, so later lines go to a new one.
+    if LOG_WRITER: LOG_WRITER.reopen()
     if LOG_FILENAME and os.path.exists(LOG_FILENAME): os.unlink(LOG_FILENAME)
     # Clean varz
     rm = []
@@ -275,13 +292,196 @@ def clear_log():
 
 def set_queue_len(new_len):
     global LOG_QUEUE, LOG_QUEUE_LEN_MAX
+    if LOG_QUEUE_LOCK: LOG_QUEUE_LOCK.acquire()
     LOG_QUEUE_LEN_MAX = new_len
-    if len(LOG_QUEUE) > new_len: LOG_QUEUE = LOG_QUEUE[:new_len]
+    LOG_QUEUE = _new_log_queue(new_len, LOG_QUEUE)
+    if LOG_QUEUE_LOCK: LOG_QUEUE_LOCK.release()
+
+
+# ---------- log records
+
+# Entries in LOG_QUEUE.  Messages are only formatted when someone looks.
+class LogRecord:
+    __slots__ = ('level', 'time', 'title', '_raw', '_text')
+
+    def __init__(self, level, time, title, msg, args=()):
+        self.level = level
+        self.time = time      # epoch seconds, or a string if FORCE_TIME was set.
+        self.title = title
+        self._raw = (msg, args)   # msg is a str, %-format string (with args), or callable.
+        self._text = None
+
+    @property
+    def msg(self):
+        '''The rendered message (rendered once, upon first access).'''
+        if self._text is None:
+            raw = self._raw
+            if raw is None: return self._text      # Just rendered by another thread.
+            msg, args = raw
+            if callable(msg): msg = msg()
+            if args:
+                try: msg = msg % args
+                except Exception: msg = '%s %s' % (msg, args)
+            self._text = msg
+            self._raw = None      # Don't keep the args (or closure) alive once rendered.
+        return self._text
+
+    def timestr(self):
+        return self.time if isinstance(self.time, str) else timestr(self.time)
+
+    def file_format(self):
+        return '%s:%s:%s: %s' % (getLevelName(self.level), self.title, self.timestr(), self.msg)
+
+    def __str__(self):
+        return '%s: %s: %s: %s' % (self.title, self.timestr(), getLevelName(self.level), self.msg)
+
+
+# Circuit Python's deque has no appendleft or maxlen trimming, so use a list there.
+class _ListQueue(list):
+    def __init__(self, maxlen=None, items=[]):
+        super().__init__(items[:maxlen] if maxlen else items)
+        self.maxlen = maxlen
+    def appendleft(self, item):
+        if self.maxlen and len(self) >= self.maxlen: del self[self.maxlen - 1]
+        self.insert(0, item)
+
+
+def _new_log_queue(maxlen, items=[]):
+    if CIRCUITPYTHON: return _ListQueue(maxlen, list(items))
+    return collections.deque(list(items)[:maxlen] if maxlen else items, maxlen=maxlen or None)
+
+LOG_QUEUE = _new_log_queue(LOG_QUEUE_LEN_MAX)
+
+
+# ---------- background log writer
+
+# Writing the logfile synchronously costs an open/write/close per log line on
+# the caller's thread.  A LogWriter instead queues lines for a background
+# thread which keeps the file open, flushes when enough data is buffered or
+# enough time has passed, and reopens the file if it's been moved or deleted
+# (e.g. by logrotate).  Use init_log(async_write=True) to enable.
+#
+# If the queue fills (the disk can't keep up), log() blocks rather than
+# dropping lines, and bumps varz log-writer-queue-full.
+
+_REOPEN = object()    # Queued by LogWriter.reopen().
+
+class LogWriter:
+    def __init__(self, filename, max_queue=10000, flush_bytes=65536, flush_interval=1.0):
+        self.filename = filename
+        self.flush_bytes = flush_bytes
+        self.flush_interval = flush_interval
+        self._queue = queue.Queue(max_queue)
+        self._file = None
+        self._buffered = 0
+        self._last_flush = time.time()
+        self._thread = threading.Thread(target=self._run, daemon=True, name='log-writer')
+        self._thread.start()
+        atexit.register(self._atexit)
+
+    def write(self, line):
+        try:
+            self._queue.put_nowait(line)
+        except queue.Full:
+            varz.bump('log-writer-queue-full')
+            self._queue.put(line)
+
+    def flush(self, timeout=5):
+        '''Blocks until everything written so far is on disk (or timeout).'''
+        if not self._thread.is_alive(): return False
+        done = threading.Event()
+        self._queue.put(done)
+        return done.wait(timeout)
+
+    def reopen(self, timeout=5):
+        '''Flushes and closes the file (to be reopened upon the next write).'''
+        if not self._thread.is_alive(): return False
+        self._queue.put(_REOPEN)
+        return self.flush(timeout)
+
+    def close(self, timeout=5):
+        if not self._thread.is_alive(): return
+        self._queue.put(None)
+        self._thread.join(timeout)
+
+    def _atexit(self):
+        global LOG_WRITER
+        if LOG_WRITER is self: LOG_WRITER = None    # Any later log() calls write synchronously.
+        self.close()
+
+    # ----- internals (background thread only)
+
+    def _run(self):
+        while True:
+            try:
+                item = self._queue.get(timeout=self.flush_interval)
+            except queue.Empty:
+                item = ''
+            if item is None:
+                self._flush()
+                if self._file: self._file.close()
+                return
+            if isinstance(item, threading.Event):
+                self._flush()
+                item.set()
+                continue
+            if item is _REOPEN:
+                self._flush()
+                self._close_file()
+                continue
+            if item:
+                self._write(item)
+                if self._buffered < self.flush_bytes and time.time() - self._last_flush < self.flush_interval: continue
+            if self._buffered: self._flush()
+
+    def _write(self, line):
+        try:
+            # Check for rotation (or deletion) before starting each batch, so it
+            # isn't written into a file that's gone.
+            if self._file and not self._buffered and self._rotated():
+                self._close_file()
+                varz.bump('log-writer-reopens')
+            if not self._file: self._file = open(self.filename, 'a')
+            self._file.write(line)
+            self._buffered += len(line)
+        except Exception as e:
+            varz.bump('log-writer-errors')
+            stderr('Error writing logfile %s: %s: %s' % (self.filename, e, line.strip()))
+
+    def _flush(self):
+        self._buffered = 0
+        self._last_flush = time.time()
+        if not self._file: return
+        try:
+            self._file.flush()
+        except Exception as e:
+            varz.bump('log-writer-errors')
+            stderr('Error flushing logfile %s: %s' % (self.filename, e))
+
+    def _rotated(self):
+        try: return os.stat(self.filename).st_ino != os.fstat(self._file.fileno()).st_ino
+        except FileNotFoundError: return True
+
+    def _close_file(self):
+        if not self._file: return
+        try: self._file.close()
+        except Exception: pass
+        self._file = None
+
+
+def flush_log():
+    if LOG_WRITER: LOG_WRITER.flush()
+
+
+def stop_log_writer():
+    global LOG_WRITER
+    if LOG_WRITER: LOG_WRITER.close()
+    LOG_WRITER = None
 
 
 # Circuit Python doesn't have datetime, so here's our poor-man's-strftime
-def timestr():
-    now = time.localtime()
+def timestr(t=None):
+    now = time.localtime(t) if t is not None else time.localtime()
     return '%d-%d-%d %d:%d:%d' % (now.tm_year, now.tm_mon, now.tm_mday, now.tm_hour, now.tm_min, now.tm_sec)
 
 
@@ -304,21 +504,33 @@ def init_log_tracking(log_title):
 # ---------- So callers don't need to import logging...
 
 
-def log_crit(msg):     return log(msg, level=CRITICAL)
-def log_critical(msg): return log(msg, level=CRITICAL)
-def log_alert(msg):    return log(msg, level=CRITICAL)
-def log_error(msg):    return log(msg, level=ERROR)
-def log_warning(msg):  return log(msg, level=WARNING)
-def log_info(msg):     return log(msg, level=INFO)
-def log_debug(msg):    return log(msg, level=DEBUG)
-def debug(msg):        return log(msg, level=DEBUG)
+def log_crit(msg, *args):     return log(msg, CRITICAL, *args)
+def log_critical(msg, *args): return log(msg, CRITICAL, *args)
+def log_alert(msg, *args):    return log(msg, CRITICAL, *args)
+def log_error(msg, *args):    return log(msg, ERROR, *args)
+def log_warning(msg, *args):  return log(msg, WARNING, *args)
+def log_info(msg, *args):     return log(msg, INFO, *args)
+def log_debug(msg, *args):    return log(msg, DEBUG, *args)
+def debug(msg, *args):        return log(msg, DEBUG, *args)
 
 
 # ----------
 # Log queue access passthrough
 
-def last_logs(): return '\n'.join(LOG_QUEUE)
-def last_logs_html(): return '<p>' + '<br/>'.join(LOG_QUEUE)
+def log_records(level=None, substring=None, offset=0, limit=None):
+    '''Returns LogRecord's from the queue, newest first.
+       level is a minimum level (number or name), substring must appear in the
+       title or message, and offset/limit select a page of the matches.'''
+    if isinstance(level, str): level = getLevelNumber(level.upper())
+    if LOG_QUEUE_LOCK: LOG_QUEUE_LOCK.acquire()
+    records = list(LOG_QUEUE)
+    if LOG_QUEUE_LOCK: LOG_QUEUE_LOCK.release()
+    if level: records = [r for r in records if r.level >= level]
+    if substring: records = [r for r in records if substring in str(r.msg) or substring in r.title]
+    return records[offset:offset + limit] if limit else records[offset:]
+
+def last_logs(**kwargs): return '\n'.join([str(r) for r in log_records(**kwargs)])
+def last_logs_html(**kwargs): return '<p>' + '<br/>'.join([str(r) for r in log_records(**kwargs)])
 
 
 # ----------------------------------------
@@ -39,18 +39,43 @@ And there are methods that provide either thread-based or file-based locking,
 if you want to be moderately sure that concurrent writes don't mess things up.
 However, these aren't thoroughly tested, and if you've really got a highly
 concurrent application with strong concurrency guarantee requirements, you
-should probably use a real database anyway. '''
-
-import copy, os, sys
+should probably use a real database anyway.
+
+The eval-based format above is the default, but parsing it is relatively
+slow, and eval() of a data file isn't great practice.  Pass serializer=JSON
+to any of the Persister classes to store JSON instead (dataclasses are
+stored as dicts of their fields and rebuilt from the class's schema, so
+field values must be JSON-compatible types).  Files in the eval format are
+still readable by a JSON Persister, and are converted on the next save, so
+switching an existing file over is just a matter of changing the
+constructor (or calling migrate()).  See tests/kcore/bench_persister.py
+for a load/save throughput comparison. '''
+
+import copy, ctypes, ctypes.util, dataclasses, json, os, stat, struct, sys, threading, time, weakref
 from contextlib import contextmanager
 
 import kcore.common as C
 import kcore.uncommon as UC
 
+# ------------------------------------------------------------
+# Pluggable serializers.
+#
+# A serializer converts between a string and "plain" data (dicts, lists,
+# strings, numbers, bools and None); the Persister classes convert their data
+# to and from plain types via to_plain() and from_plain().
+
+class JsonSerializer:
+    name = 'json'
+    def dumps(self, plain): return json.dumps(plain, separators=(',', ':'))
+    def loads(self, serialized): return json.loads(serialized)
+
+JSON = JsonSerializer()
+
+
 class Persister:
     # ---------- primary API
 
-    def __init__(self, filename=None, default_value=None, password=None):
+    def __init__(self, filename=None, default_value=None, password=None, serializer=None, watch=False, cow=False):
         '''filename can be passed as None (e.g. if you don't know it yet because
            this instance is created as a global variable and command-line flags
            indicating the filename haven't been parsed yet.  But if you pass
@@ -63,16 +88,42 @@ class Persister:
 
            providing a password will encrypt the stored data using
            kcore.uncommon.symmetric_crypt().
+
+           serializer=None uses the eval-based format (i.e. serialize() and
+           deserialize()); otherwise pass a serializer instance, like JSON.
+
+           watch=True avoids stat'ing the file on every get_data() call: an
+           inotify watch flags the cache as stale when the file changes.  If
+           inotify isn't available, the file's mtime is checked at most every
+           WATCH_POLL_INTERVAL seconds instead.
+
+           cow=True makes get_rw() copy-on-write: the writer gets a private
+           deep copy which replaces the cache (and is saved) when the with
+           block completes, so data returned by get_data() / get_ro() is a
+           snapshot that's never modified underneath the reader.  Readers
+           must therefore treat what they get as read-only.  Not available
+           for the mix-in classes (DictOfDataclasses, ListOfDataclasses),
+           where the Persister itself is the data.
         '''
 
         self.filename = filename
         self.default_value = default_value
         self.password = password
+        self.serializer = serializer
+        self.watch = watch
+        self._watching = None       # filename currently registered with the watcher (or polled).
+        self._inotify = False       # True if _watching is being watched via inotify.
+        self._stale = False         # set by the watcher thread.
+        self._last_poll = 0
+        self._rw_keys = None        # dirty_keys of the get_rw() in progress (None if unknown).
+
+        self.cow = cow
+        if cow and default_value is self: raise ValueError('cow mode is not supported when the Persister is the data')
 
         self.cache = self.get_default_value()
         self.file_lock = None
         self.cache_mtime = 0
-        self.thread_lock = None
+        self.thread_lock = threading.RLock()   # Serializes writers (readers never take it).
         if filename: self.load_from_file()
 
     # ----- simple getter and setter
@@ -82,15 +133,16 @@ class Persister:
         if self.is_cache_fresh(): return self.cache
         ok = self.load_from_file()
         if not ok:
-            C.log_debug(f'filename={self.filename} load from file failed; returning default value')
+            C.log_debug('filename=%s load from file failed; returning default value', self.filename)
             self.cache = self.get_default_value()
-        C.log_debug(f'loaded data from {self.filename}.')
+        C.log_debug('loaded data from %s.', self.filename)
         return self.cache
 
     def set_data(self, data=None):
         '''Passing data=None just saves the current cached data.'''
-        if data: self.cache = data
-        self.save_to_file()
+        with self.thread_lock:
+            if data: self.cache = data
+            self.save_to_file()
 
     # ----- context manager getter and setter
 
@@ -99,41 +151,60 @@ class Persister:
         yield self.get_data()
 
     @contextmanager
-    def get_rw(self):
+    def get_rw(self, dirty_keys=None):
         '''Yield latest data, then save any changes upon exit.
            WARNING: only works for types where a pointer is returned, i.e. things
            like lists and dicts, not simple things like ints and strings.  For
-           those atomic types, use set_data().'''
+           those atomic types, use set_data().
+
+           Writers within a process are serialized by self.thread_lock.  In
+           cow mode, an exception in the with block discards the changes.
 
-        local_data = self.get_data()
-        yield local_data
+           dirty_keys is a promise that only the values of those keys will be
+           modified in place (setting or deleting keys is fine regardless).
+           Journal-mode PersisterDictOfDC uses it to save (and in cow mode,
+           copy) just those keys rather than everything.'''
 
-        self.save_to_file()
+        with self.thread_lock:
+            prev_keys = self._rw_keys
+            self._rw_keys = None if dirty_keys is None else set(dirty_keys)
+            try:
+                if not self.cow:
+                    local_data = self.get_data()
+                    yield local_data
+                    self.save_to_file()
+                    return
+
+                old = self.get_data()
+                local_data = self.copy_for_write(old)
+                yield local_data
+                self.cache = local_data     # Publish the new snapshot (an atomic reference swap).
+                try:
+                    self.save_to_file()
+                except Exception:
+                    self.cache = old
+                    raise
+            finally:
+                self._rw_keys = prev_keys
 
     # ---------- API with locking options
 
+    # get_rw() now always takes the thread lock; this is kept for compatibility.
     @contextmanager
     def get_rw_locked_thread(self):
-        import threading
-        if not self.thread_lock: self.thread_lock = threading.thread_lock()
-        with self.thread_lock:
-            C.log_debug(f'start filename={self.filename} thread lock')
-            local_data = self.get_data()
+        with self.get_rw() as local_data:
             yield local_data
-            self.save_to_file()
-            self.cache = local_data
-            C.log_debug(f'end filename={self.filename} thread lock')
 
     @contextmanager
     def get_rw_locked_file(self):
         import kcore.uncommon as UC
         if not self.file_lock: self.file_lock = UC.FileLock(self.filename)
         with self.file_lock:
-            C.log_debug(f'start filename={self.filename}.lock file lock')
+            C.log_debug('start filename=%s.lock file lock', self.filename)
             local_data = self.get_data()
             yield local_data
             self.save_to_file()
-            C.log_debug(f'end filename={self.filename}.lock file lock')
+            C.log_debug('end filename=%s.lock file lock', self.filename)
 
 
     # ---------- internal methods
@@ -142,7 +213,7 @@ class Persister:
 
     def deserialize(self, serialized):
         if not serialized:
-            C.log_debug(f'filename={self.filename}: cannot deserialize; no serialized data provided')
+            C.log_debug('filename=%s: cannot deserialize; no serialized data provided', self.filename)
             return None
         # NB: no try..except; if eval fails, pass exception up to caller for easier debugging.
         return eval(serialized, {}, {})
@@ -151,6 +222,30 @@ class Persister:
         out = "'%s'" % data if isinstance(data, str) else str(data)
         return out + '\n'
 
+    # Conversions to and from plain types, for use with self.serializer.
+    def to_plain(self, data): return data
+    def from_plain(self, plain): return plain
+
+    def encode(self, data):
+        if not self.serializer: return self.serialize(data)
+        return self.serializer.dumps(self.to_plain(data)) + '\n'
+
+    def decode(self, serialized):
+        if self.serializer and serialized:
+            try:
+                plain = self.serializer.loads(serialized)
+            except ValueError:
+                # Probably a file saved in the eval format; it'll be converted upon the next save.
+                C.log_info('filename=%s is not %s; reading as legacy format.', self.filename, self.serializer.name)
+            else:
+                return self.from_plain(plain)
+        return self.deserialize(serialized)
+
+    def migrate(self):
+        '''Rewrite the file in the current serializer's format.'''
+        if not self.load_from_file(): return False
+        return self.save_to_file()
+
 
     # ----- other
 
@@ -159,57 +254,84 @@ class Persister:
     def get_default_value(self):
         return copy.copy(self.default_value)
 
+    # The private copy a cow-mode get_rw() hands to the writer.
+    def copy_for_write(self, data):
+        return copy.deepcopy(data)
+
 
     # ----- dealing with the saved file
 
     def get_file_mtime(self):
         try: return os.path.getmtime(self.filename)
         except:
-            C.log_debug(f'filename={self.filename} not found; returning None as mtime.')
+            C.log_debug('filename=%s not found; returning None as mtime.', self.filename)
             return None
 
     def is_cache_fresh(self):
+        if self.watch:
+            if self._watching != self.filename: self._start_watch()
+            if self._inotify:
+                if not self._stale: return True
+                self._stale = False   # Cleared before reloading, so changes during the reload re-flag.
+                return False
+            now = time.time()
+            if now - self._last_poll < WATCH_POLL_INTERVAL: return True
+            self._last_poll = now
         file_mtime = self.get_file_mtime()
         is_fresh = self.cache_mtime == file_mtime
-        C.log_debug(f'is filename={self.filename} fresh? {is_fresh}  file_mtime={file_mtime} cache_mtime={self.cache_mtime}')
+        C.log_debug('is filename=%s fresh? %s  file_mtime=%s cache_mtime=%s', self.filename, is_fresh, file_mtime, self.cache_mtime)
         return is_fresh
 
+    def _start_watch(self):
+        self._watching = self.filename
+        self._inotify = False
+        self._last_poll = 0
+        if not self.filename or self.filename == '-' or not get_watcher(): return
+        try:
+            WATCHER.add(self)
+        except OSError as e:
+            C.log_info('cannot watch %s (%s); will poll its mtime.', self.filename, e)
+            return
+        self._inotify = True
+        self._stale = self.get_file_mtime() != self.cache_mtime
+
     def load_from_file(self):
         if self.filename == '-':
             serialized = sys.stdin.read()
         else:
             if not self.filename or not os.path.isfile(self.filename):
-                C.log_debug(f'filename={self.filename} file not found.')
+                C.log_debug('filename=%s file not found.', self.filename)
                 return False
             with open(self.filename) as f: serialized = f.read()
 
         if self.password:
             if not serialized:
-                C.log_debug(f'filename={self.filename} loaded empty; cannot decrypt.')
+                C.log_debug('filename=%s loaded empty; cannot decrypt.', self.filename)
                 return False
             tmp = serialized
             serialized = UC.decrypt(serialized, self.password)
             if serialized.startswith('ERROR'): raise ValueError(serialized)
-            C.log_debug(f'decrypted contents of {self.filename}.')
+            C.log_debug('decrypted contents of %s.', self.filename)
 
-        self.cache = self.deserialize(serialized)
+        self.cache = self.decode(serialized)
         if self.cache is None: return False
         self.cache_mtime = self.get_file_mtime()
-        C.log_debug(f'deserialization success {self.filename}.')
+        C.log_debug('deserialization success %s.', self.filename)
         return True
 
     def save_to_file(self):
         if not self.filename:
             C.log_debug('save_to_file: filename not set; skipping.')
             return False
-        serialized = self.serialize(self.cache)
+        serialized = self.encode(self.cache)
         if self.password: serialized = UC.encrypt(serialized, self.password)
         if self.filename == '-':
             print(serialized)
         else:
-            with open(self.filename, 'w') as f: f.write(serialized)
+            write_file_atomic(self.filename, serialized)
         self.cache_mtime = self.get_file_mtime()
-        C.log_debug(f'serialized to {self.filename}; ok.')
+        self._stale = False   # The watcher may have seen our own write before cache_mtime was updated.
+        C.log_debug('serialized to %s; ok.', self.filename)
         return True
 
 
@@ -234,10 +356,13 @@ class PersisterDC(Persister):
 
     '''
 
-    def __init__(self, filename, dc_type):
+    def __init__(self, filename, dc_type, **kwargs):
         self.filename = filename
         self.dc_type = dc_type
-        super().__init__(filename, None)
+        super().__init__(filename, None, **kwargs)
+
+    def to_plain(self, data): return dc_to_plain(data)
+    def from_plain(self, plain): return self.dc_type(**plain)
 
     def serialize(self, data):
         s = ''
@@ -275,19 +400,84 @@ class PersisterDC(Persister):
 
 # ------------------------------------------------------------
 # A Persister specialized for dictionaries of @dataclass instances.
+#
+# With journal=True, saves don't rewrite the whole file.  Instead, the keys
+# that changed since the last load or save are appended (and fsync'd) as JSON
+# lines to {filename}.journal, and loads replay the journal on top of the main
+# file.  Once the journal passes compact_bytes, it's set aside as
+# {filename}.journal.compacting and a background thread rewrites the main
+# file (temp file + rename) and then removes it.  Journal records are
+# absolute values, so replaying one that's already in the main file (e.g.
+# after a crash mid-compaction) is harmless, and a torn final line from a
+# power loss is just skipped.  A .compacting file left by a crash is replayed
+# on load, and the next compaction adds the journal to it rather than
+# replacing it.  Compaction rebuilds the main file from the files themselves
+# (main file + .compacting), so records appended by other processes aren't lost.
+#
+# To find the changed keys, the dict records keys that are set or deleted,
+# and get_rw(dirty_keys=...) names the values that will be modified in place.
+# A save without that information (e.g. set_data(), or get_rw() without
+# dirty_keys) falls back to comparing every value with what was last saved.
+
+JOURNAL_COMPACT_BYTES = 64 * 1024
+
+
+# A dict that records which keys have been set or deleted.
+class _TrackedDict(dict):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._journal_dirty = set()
+
+    def __setitem__(self, k, v):
+        self._journal_dirty.add(k)
+        dict.__setitem__(self, k, v)
+
+    def __delitem__(self, k):
+        self._journal_dirty.add(k)
+        dict.__delitem__(self, k)
+
+    def pop(self, k, *args):
+        self._journal_dirty.add(k)
+        return dict.pop(self, k, *args)
+
+    def popitem(self):
+        k, v = dict.popitem(self)
+        self._journal_dirty.add(k)
+        return k, v
+
+    def setdefault(self, k, default=None):
+        if k not in self: self._journal_dirty.add(k)
+        return dict.setdefault(self, k, default)
+
+    def update(self, *args, **kwargs):
+        for k, v in dict(*args, **kwargs).items(): self[k] = v
+
+    def clear(self):
+        self._journal_dirty.update(self.keys())
+        dict.clear(self)
 
 class PersisterDictOfDC(Persister):
-    def __init__(self, filename, rhs_type, default_value=None, **kwargs):
+    def __init__(self, filename, rhs_type, default_value=None,
+                 journal=False, compact_bytes=JOURNAL_COMPACT_BYTES, **kwargs):
         if default_value is None: default_value = dict()
+        if journal and kwargs.get('password'): raise ValueError('journal mode does not support encryption')
         self.filename = filename
         self.rhs_type = rhs_type
+        self.journal = journal
+        self.compact_bytes = compact_bytes
+        self._saved_plain = {}      # journal mode: key -> JSON of its value as of the last load or save.
+        self._journal_lock = threading.Lock()
+        self._compactor = None
         super().__init__(filename=filename, default_value=default_value, **kwargs)
 
     def deserialize(self, serialized):
         if serialized is None: return None
-        locals = { self.rhs_type.__name__: self.rhs_type }
         data = self.get_default_value()
         data.clear()
+        return self._parse(serialized, data)
+
+    def _parse(self, serialized, data):
+        locals = { self.rhs_type.__name__: self.rhs_type }
         for line in serialized.split('\n'):
             if not line or line.startswith('#'): continue
             line = line.replace('\t', ' ')  # be tolerant of tabs
@@ -301,12 +491,171 @@ class PersisterDictOfDC(Persister):
         out = '\n'.join([f"'{k}': {str(v)}" for k, v in data.items()])
         return out + '\n'
 
+    def to_plain(self, data):
+        return {k: dc_to_plain(v) for k, v in data.items()}
+
+    def from_plain(self, plain):
+        data = self.get_default_value()
+        data.clear()
+        rhs_type = self.rhs_type
+        for k, v in plain.items(): data[k] = rhs_type(**v)
+        return data
+
+    def get_default_value(self):
+        if not self.journal: return super().get_default_value()
+        return _TrackedDict(self.default_value)
+
+    # ----- journal mode
+
+    def journal_filename(self): return self.filename + '.journal'
+
+    def compacting_filename(self): return self.filename + '.journal.compacting'
+
+    def get_file_mtime(self):
+        if not self.journal: return super().get_file_mtime()
+        stamps = []
+        for fn in (self.filename, self.compacting_filename(), self.journal_filename()):
+            try:
+                st = os.stat(fn)
+                stamps.append((st.st_mtime, st.st_size))
+            except OSError:
+                stamps.append(None)
+        return None if stamps == [None, None, None] else tuple(stamps)
+
+    def load_from_file(self):
+        if not self.journal: return super().load_from_file()
+        if not self.filename: return False
+        with self._journal_lock:
+            mtime = self.get_file_mtime()
+            if os.path.isfile(self.filename):
+                if not super().load_from_file(): return False
+            elif mtime:
+                self.cache = self.get_default_value()
+                self.cache.clear()
+            else:
+                C.log_debug('filename=%s file not found.', self.filename)
+                return False
+            for fn in (self.compacting_filename(), self.journal_filename()):
+                self._replay(fn, self.cache)
+            self._saved_plain = self._snapshot(self.cache)
+            self._dirty_keys(self.cache).clear()
+            self.cache_mtime = mtime
+        return True
+
+    def save_to_file(self):
+        if not self.journal: return super().save_to_file()
+        if not self.filename:
+            C.log_debug('save_to_file: filename not set; skipping.')
+            return False
+        # Compare JSON strings rather than plain dicts, as the plain dicts share
+        # mutable field values (lists, dicts) with the live dataclasses.
+        data = self.cache
+        dirty = self._dirty_keys(data)
+        old = self._saved_plain
+        if self._rw_keys is None:
+            snapshot = self._snapshot(data)
+            deleted = [k for k in old if k not in snapshot]
+        else:
+            keys = dirty | self._rw_keys
+            snapshot = {k: json.dumps(dc_to_plain(data[k])) for k in keys if k in data}
+            deleted = [k for k in keys if k not in data and k in old]
+        lines = ['{"k": %s, "v": %s}' % (json.dumps(k), v) for k, v in snapshot.items() if old.get(k) != v]
+        lines.extend([json.dumps({'k': k, 'd': 1}) for k in deleted])
+        if not lines:
+            dirty.clear()
+            return True
+        with self._journal_lock:
+            journal_size = append_lines(self.journal_filename(), '\n'.join(lines) + '\n')
+            if self._rw_keys is None:
+                self._saved_plain = snapshot
+            else:
+                old.update(snapshot)
+                for k in deleted: del old[k]
+            dirty.clear()
+            self.cache_mtime = self.get_file_mtime()
+            self._stale = False
+        C.log_debug('journaled %d changes to %s.', len(lines), self.filename)
+        if journal_size >= self.compact_bytes: self.compact()
+        return True
+
+    def compact(self, wait=False):
+        '''Fold the journal into the main file (in a background thread unless wait=True).'''
+        with self._journal_lock:
+            if self._compactor and self._compactor.is_alive(): return False
+            if not os.path.isfile(self.journal_filename()): return False
+            if os.path.isfile(self.compacting_filename()):
+                # A previous compaction didn't finish; add to its records rather than replacing them.
+                with open(self.journal_filename()) as f: append_lines(self.compacting_filename(), f.read())
+                os.unlink(self.journal_filename())
+            else:
+                os.replace(self.journal_filename(), self.compacting_filename())
+            self._compactor = threading.Thread(target=self._compact, daemon=True, name='persister-compact')
+            self._compactor.start()
+        if wait: self._compactor.join()
+        return True
+
+    def _compact(self):
+        with self._journal_lock:
+            # Rebuild from the files rather than our own cache, which may be
+            # missing records other processes have journaled.
+            plain = self._read_plain(self.filename)
+            self._replay(self.compacting_filename(), plain, raw=True)
+            if self.serializer:
+                serialized = self.serializer.dumps(plain) + '\n'
+            else:
+                serialized = self.serialize({k: self.rhs_type(**v) for k, v in plain.items()})
+            write_file_atomic(self.filename, serialized)
+            os.unlink(self.compacting_filename())
+        C.log_debug('compacted journal into %s.', self.filename)
+
+    def copy_for_write(self, data):
+        if not self.journal or self._rw_keys is None: return super().copy_for_write(data)
+        # Only the dirty values can be modified in place; the rest are shared with the snapshot.
+        out = _TrackedDict(data)
+        for k in self._rw_keys:
+            if k in data: dict.__setitem__(out, k, copy.deepcopy(data[k]))
+        return out
+
+    def _dirty_keys(self, data):
+        dirty = getattr(data, '_journal_dirty', None)
+        return set() if dirty is None else dirty   # e.g. if set_data() was given a plain dict.
+
+    def _snapshot(self, data):
+        return {k: json.dumps(dc_to_plain(v)) for k, v in data.items()}
+
+    def _read_plain(self, filename):
+        if not os.path.isfile(filename): return {}
+        with open(filename) as f: serialized = f.read()
+        if self.serializer and serialized:
+            try:
+                return self.serializer.loads(serialized)
+            except ValueError:
+                pass   # legacy format
+        return self.to_plain(self._parse(serialized, {}))
+
+    def _replay(self, journal_filename, data, raw=False):
+        '''Apply journal records to data (a dict of rhs_type, or of plain dicts if raw).'''
+        if not os.path.isfile(journal_filename): return
+        with open(journal_filename) as f: lines = f.read().split('\n')
+        rhs_type = self.rhs_type
+        for line in lines:
+            if not line: continue
+            try:
+                rec = json.loads(line)
+            except ValueError:
+                C.log_warning('%s: skipping unparsable journal line (torn write?): %s', journal_filename, line)
+                continue
+            if rec.get('d'): data.pop(rec['k'], None)
+            elif raw: data[rec['k']] = rec['v']
+            else: data[rec['k']] = rhs_type(**rec['v'])
+
 
 # Multiple inheritance merges together dict and PersisterDictOfDC to create a dict
 # with Persister's automatic loading and saving semantics.
 #
-class DictOfDataclasses(PersisterDictOfDC, dict):
+class DictOfDataclasses(PersisterDictOfDC, _TrackedDict):
     def __init__(self, filename, rhs_type, **kwargs):
+        self._journal_dirty = set()
         super().__init__(filename=filename, rhs_type=rhs_type, default_value=self, **kwargs)
 
     def get_default_value(self): return self
@@ -340,6 +689,16 @@ class PersisterListOfDC(Persister):
         out = '\n'.join([str(x) for x in data])
         return out + '\n'
 
+    def to_plain(self, data):
+        return [dc_to_plain(x) for x in data]
+
+    def from_plain(self, plain):
+        data = self.get_default_value()
+        data.clear()
+        dc_type = self.dc_type
+        data.extend([dc_type(**x) for x in plain])
+        return data
+
 
 # Multiple inheritance merges together list and PersisterListOfDC to create a list
 # with Persister's automatic loading and saving semantics.
@@ -349,3 +708,173 @@ class ListOfDataclasses(PersisterListOfDC, list):
         super().__init__(filename=filename, dc_type=dc_type, default_value=self, **kwargs)
 
     def get_default_value(self): return self
+
+
+# ------------------------------------------------------------
+# File change watcher (for Persister(watch=True))
+#
+# A single thread watches the directories of all watched Persisters via
+# inotify (called through ctypes, so there's no extra dependency).  When
+# something changes a file whose name starts with a Persister's filename
+# (which covers its journal and temp files), the Persister's mtime is
+# checked, and if it doesn't match the cache, the Persister is flagged as
+# stale.  The mtime check (and saves clearing the flag) keep a Persister's
+# own saves from forcing a reload.
+
+WATCH_POLL_INTERVAL = 2.0   # seconds, for when inotify isn't available.
+WATCHER = None              # Populated by get_watcher() if inotify is available.
+
+class InotifyWatcher:
+    # from <sys/inotify.h>
+    IN_ATTRIB, IN_CLOSE_WRITE = 0x4, 0x8
+    IN_MOVED_FROM, IN_MOVED_TO, IN_CREATE, IN_DELETE = 0x40, 0x80, 0x100, 0x200
+    IN_Q_OVERFLOW, IN_IGNORED = 0x4000, 0x8000
+    MASK = IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+    EVENT = struct.Struct('iIII')
+
+    def __init__(self):
+        self.libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        self.fd = self.libc.inotify_init1(os.O_CLOEXEC)
+        if self.fd < 0: raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        self.lock = threading.RLock()   # Reentrant, as _forget() can be called by GC at any time.
+        self.dirs = {}        # wd -> dirname
+        self.persisters = {}  # dirname -> list of weakrefs to Persisters (so they can be garbage collected)
+        threading.Thread(target=self._run, daemon=True, name='persister-watcher').start()
+
+    def add(self, persister):
+        dirname = os.path.dirname(os.path.abspath(persister.filename))
+        with self.lock:
+            if dirname not in self.persisters:
+                wd = self.libc.inotify_add_watch(self.fd, dirname.encode(), self.MASK)
+                if wd < 0: raise OSError(ctypes.get_errno(), f'inotify_add_watch failed for {dirname}')
+                self.dirs[wd] = dirname
+                self.persisters[dirname] = []
+            for d, plist in self.persisters.items():
+                self.persisters[d] = [r for r in plist if r() is not None and r() is not persister]
+            self.persisters[dirname].append(weakref.ref(persister, self._forget))
+
+    def _forget(self, ref):
+        with self.lock:
+            for plist in self.persisters.values():
+                if ref in plist: plist.remove(ref)
+
+    def _run(self):
+        while True: self._handle(os.read(self.fd, 64 * 1024))
+
+    def _handle(self, buf):
+        changed = {}   # dirname -> set of names
+        overflow = False
+        pos = 0
+        while pos < len(buf):
+            wd, mask, cookie, name_len = self.EVENT.unpack_from(buf, pos)
+            pos += self.EVENT.size
+            name = buf[pos:pos + name_len].rstrip(b'\0').decode(errors='replace')
+            pos += name_len
+            if mask & self.IN_Q_OVERFLOW: overflow = True
+            elif mask & self.IN_IGNORED: self._lost_watch(wd)
+            elif wd in self.dirs: changed.setdefault(self.dirs[wd], set()).add(name)
+        if overflow:
+            # Events were dropped, so any file might have changed.
+            C.log_warning('inotify queue overflow; rechecking all watched persisters.')
+            for p in self._live(self.persisters.keys()): p._stale = True
+            return
+        for d, names in changed.items():
+            for p in self._live([d]):
+                base = os.path.basename(p.filename or '')
+                if base and any([n.startswith(base) for n in names]) and p.get_file_mtime() != p.cache_mtime:
+                    p._stale = True
+
+    # Returns the (still existing) Persisters watched in the given directories.
+    def _live(self, dirnames):
+        with self.lock:
+            refs = [r for d in list(dirnames) for r in self.persisters.get(d, [])]
+        return [p for p in [r() for r in refs] if p is not None]
+
+    # The kernel dropped a watch (e.g. its directory was deleted); fall back to
+    # polling mtimes for the Persisters that were relying on it.
+    def _lost_watch(self, wd):
+        with self.lock:
+            dirname = self.dirs.pop(wd, None)
+            refs = self.persisters.pop(dirname, [])
+        for p in [r() for r in refs]:
+            if p is None: continue
+            p._inotify = False
+            p._last_poll = 0
+
+
+def get_watcher():
+    global WATCHER
+    if WATCHER is None:
+        try:
+            WATCHER = InotifyWatcher()
+        except Exception as e:
+            C.log_info('inotify unavailable (%s); persister watches will poll mtimes.', e)
+            WATCHER = False
+    return WATCHER
+
+
+# ------------------------------------------------------------
+# helpers
+
+def write_file_atomic(filename, data):
+    '''Write via a temp file, fsync and rename, so readers (and crashes) never see a partial file.
+       The file keeps the permissions (and owner, if allowed) of the file it replaces.
+       If filename is a symlink, the file it points to is the one replaced.'''
+    filename = os.path.realpath(filename)
+    tmp = '%s.tmp.%d.%d' % (filename, os.getpid(), threading.get_ident())
+    try:
+        st = os.stat(filename)
+    except OSError:
+        st = None
+    # Replacing a file: start private, then copy its mode before it's visible.
+    # New file: the usual umask-based permissions, as open() would give.
+    fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600 if st else 0o666)
+    try:
+        with os.fdopen(fd, 'w') as f:
+            if st:
+                os.fchmod(fd, stat.S_IMODE(st.st_mode))
+                try:
+                    os.fchown(fd, st.st_uid, st.st_gid)
+                except OSError:
+                    pass
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, filename)
+    except BaseException:
+        try:
+            os.unlink(tmp)
+        except OSError:
+            pass
+        raise
+    # fsync the directory so the rename itself survives a crash.
+    dir_fd = os.open(os.path.dirname(filename), os.O_RDONLY)
+    try:
+        os.fsync(dir_fd)
+    finally:
+        os.close(dir_fd)
+
+
+def append_lines(filename, data):
+    '''Append and fsync data (ending in a newline), starting a new line if the
+       file ends with a torn one.  Returns the new size of the file.'''
+    with open(filename, 'ab+') as f:
+        f.seek(0, os.SEEK_END)
+        if f.tell():
+            f.seek(-1, os.SEEK_END)
+            if f.read(1) != b'\n': data = '\n' + data
+        f.write(data.encode())
+        f.flush()
+        os.fsync(f.fileno())
+        return f.tell()
+
+
+# Maps from @dataclass type to a tuple of its field names.
+_DC_FIELDS = {}
+
+def dc_to_plain(dc):
+    '''Returns a dict of a @dataclass instance's fields (not any other attributes it has).'''
+    names = _DC_FIELDS.get(dc.__class__)
+    if names is None:
+        names = _DC_FIELDS[dc.__class__] = tuple([f.name for f in dataclasses.fields(dc)])
+    return {name: getattr(dc, name) for name in names}
@@ -212,20 +212,48 @@ class RateLimiter:
 
 ENCRYPTION_PREFIX = 'pcrypt1:'   # Can be used to auto-detect whether to encrypt or decrypt.
 
-def symmetric_crypt(data, password, salt=None, decrypt=None):
-    if decrypt is None: decrypt = data.startswith(ENCRYPTION_PREFIX)
+# Deriving a key from a password (PBKDF2, 150k iterations) is deliberately
+# slow (100's of ms on a Pi), so derived keys (well, the Fernet instances
+# holding them) are cached in process memory, keyed by a hash of the password
+# and salt.  wipe_key_cache() drops them, e.g. once a program has finished
+# with its secrets.  Note that Python can't guarantee the old key bytes are
+# overwritten in memory; this just drops all references to them.
+KEY_CACHE_MAX = 16
+_KEY_CACHE = {}
+_KEY_CACHE_LOCK = threading.Lock()
+
+def wipe_key_cache():
+    with _KEY_CACHE_LOCK: _KEY_CACHE.clear()
+
+
+def _get_fernet(password, salt):
+    import hashlib
+    cache_key = hashlib.sha256(('%s\0%s' % (salt, password)).encode()).digest()
+    with _KEY_CACHE_LOCK:
+        f = _KEY_CACHE.pop(cache_key, None)
+        if f: _KEY_CACHE[cache_key] = f    # Move to most-recently-used.
+    if f: return f
+
     import base64
     from cryptography.fernet import Fernet
     from cryptography.hazmat.backends import default_backend
     from cryptography.hazmat.primitives import hashes
     from cryptography.hazmat.primitives.kdf.pbkdf2 import PBKDF2HMAC
+    kdf = PBKDF2HMAC(algorithm=hashes.SHA256(), length=32, salt=salt.encode(),
+                     iterations=150000, backend=default_backend())
+    f = Fernet(base64.urlsafe_b64encode(kdf.derive(password.encode())))
+    with _KEY_CACHE_LOCK:
+        while len(_KEY_CACHE) >= KEY_CACHE_MAX: _KEY_CACHE.pop(next(iter(_KEY_CACHE)))
+        _KEY_CACHE[cache_key] = f
+    return f
+
+
+def symmetric_crypt(data, password, salt=None, decrypt=None):
+    if decrypt is None: decrypt = data.startswith(ENCRYPTION_PREFIX)
     if not salt: salt = DEFAULT_SALT
     if decrypt: data = data.replace(ENCRYPTION_PREFIX, '')
     try:
-        kdf = PBKDF2HMAC(algorithm=hashes.SHA256(), length=32, salt=salt.encode(),
-                         iterations=150000, backend=default_backend())
-        key = base64.urlsafe_b64encode(kdf.derive(password.encode()))
-        f = Fernet(key)
+        f = _get_fernet(password, salt)
         in_bytes = data.encode()
         out_bytes = f.decrypt(in_bytes) if decrypt else f.encrypt(in_bytes)
         out = out_bytes.decode()
@@ -20,6 +20,8 @@ import os, re, sys, time
 
 CIRCUITPYTHON = 'boot_out.txt' in os.listdir('/')
 
+if not CIRCUITPYTHON: import threading
+
 # varz is intended to be a very low level module, so don't included the
 # complicated Prometheus deps unless really necessary.  Also worth noting that
 # the inclusion of webserver_base is technically a leveling violation (varz is
@@ -39,11 +41,31 @@ else:
 
 # ---------- internal state
 
+# Counters (anything updated via inc/bump) are stored in VARZ as _Counter
+# instances, which look up as plain numbers through VARZ[k] / VARZ.get(k).
+class _VarzDict(dict):
+    def __getitem__(self, key): return _resolve(dict.__getitem__(self, key))
+    def get(self, key, default=None): return _resolve(dict.get(self, key, default))
+    def items(self): return [(k, _resolve(v)) for k, v in dict.items(self)]
+    def values(self): return [_resolve(v) for v in dict.values(self)]
+    def pop(self, key, *default): return _resolve(dict.pop(self, key, *default))
+
 PROGRAM_NAME = os.path.basename(sys.argv[0]) if not CIRCUITPYTHON else 'code.py'
-VARZ = {}
+VARZ = _VarzDict()
+_VARZ_LOCK = threading.Lock() if not CIRCUITPYTHON else None   # Only used when creating counters, histograms and rates.
+
+# Snapshot related
+SNAPSHOT = {}              # Values as of the most recent snapshot().
+SNAPSHOT_GEN = 0           # Increases whenever a snapshot differs from the previous one.
+_KEY_GEN = {}              # Maps from varz name to the generation in which it last changed.
+_SNAPSHOT_LOCK = threading.Lock() if not CIRCUITPYTHON else None
+_CHANGED = threading.Condition() if not CIRCUITPYTHON else None   # Notified on changes while anyone waits.
+_WAITERS = 0               # Number of changes_since() calls waiting; setters skip notifying if 0.
+_CHANGES = 0               # Count of notifications (under _CHANGED), so waiters don't miss any.
 
 # Prometheus related
-PROM_INSTANCES = {}        # Maps from varz name to prometheus metric instances.
+PROM_INSTANCES = {}        # Maps from prometheus name to prometheus metric instances.
+PROM_CHILDREN = {}         # Maps from (varz name, factory) to the labeled child metric.
 WEBSERVER = None           # Populated by webserver_base:__init__ if $KTOOLS_VARZ_PROM is set.
 
 
@@ -67,9 +89,10 @@ def bump(counter_name): inc(counter_name, 1)
 
 
 def inc(counter_name, add=1):
-    global VARZ
-    if counter_name not in VARZ: VARZ[counter_name] = 0
-    VARZ[counter_name] += add
+    counter = dict.get(VARZ, counter_name)
+    if counter.__class__ is not _Counter: counter = _make_counter(counter_name)
+    counter.inc(add)
+    if _WAITERS: _notify()
     if USE_PROM: _get_prom_instance(counter_name, PC.Counter).inc(add)
 
 
@@ -77,6 +100,7 @@ def set(var_name, value):
     '''value can be a normal value (of any basic type), or a callable function to be evaluated upon each get.  note that callables do not work with prometheus,'''
     global VARZ
     VARZ[var_name] = value
+    if _WAITERS: _notify()
     if USE_PROM and not callable(value):
         # TODO(defer): can callables be made compatible with Prometheus ?
         if isinstance(value, int) or isinstance(value, float):
@@ -85,28 +109,314 @@ def set(var_name, value):
             _get_prom_instance(var_name, PC.Info).info({'value': value})
 
 
+def observe(histogram_name, value_ms):
+    '''Add a (latency) observation in milliseconds to a Histogram varz, creating it if needed.'''
+    global VARZ
+    h = dict.get(VARZ, histogram_name)
+    if not isinstance(h, Histogram): h = _make_instance(histogram_name, Histogram)
+    h.observe(value_ms)
+    if _WAITERS: _notify()
+    if USE_PROM: _get_prom_instance(histogram_name, _prom_histogram_factory).observe(value_ms / 1000.0)
+
+
+def rate(rate_name, n=1):
+    '''Record n events in a windowed Rate varz, creating it if needed.'''
+    global VARZ
+    r = dict.get(VARZ, rate_name)
+    if not isinstance(r, Rate): r = _make_instance(rate_name, Rate)
+    r.mark(n)
+    if _WAITERS: _notify()
+    if USE_PROM: _get_prom_instance(rate_name, PC.Counter).inc(n)   # Prometheus computes its own rates.
+
+
 def stamp(stamp_name):  # Sets current epoch seconds.
     global VARZ
     VARZ[stamp_name] = int(time.time())
+    if _WAITERS: _notify()
     if USE_PROM: _get_prom_instance(stamp_name, PC.Counter).inc()
 
 
+# ---------- snapshots
+
+def snapshot():
+    '''Returns (generation, dict of current values, with non-basic types as strings).
+
+       The generation number increases each time a snapshot differs from the
+       previous one, and each key remembers the generation in which it last
+       changed, so changes_since() can report just the keys that moved.'''
+    global SNAPSHOT, SNAPSHOT_GEN
+    current = {k: _exportable(v) for k, v in get_dict().items()}
+    if _SNAPSHOT_LOCK: _SNAPSHOT_LOCK.acquire()
+    try:
+        changed = [k for k, v in current.items() if k not in SNAPSHOT or SNAPSHOT[k] != v]
+        deleted = [k for k in SNAPSHOT if k not in current]
+        if changed or deleted:
+            SNAPSHOT_GEN += 1
+            for k in changed + deleted: _KEY_GEN[k] = SNAPSHOT_GEN
+        SNAPSHOT = current
+        return SNAPSHOT_GEN, current
+    finally:
+        if _SNAPSHOT_LOCK: _SNAPSHOT_LOCK.release()
+
+
+def changes_since(generation, timeout=0, prefix=None, ignore_prefix=None, poll_interval=0.25):
+    '''Returns (current generation, {key: value}) for keys changed after {generation}.
+
+       Deleted keys are reported with a value of None.  If nothing (whose name
+       starts with {prefix}, if provided) has changed, waits up to {timeout}
+       seconds for something to change.  Changes to keys starting with
+       {ignore_prefix} are reported, but don't by themselves end the wait.
+       Values computed by callables don't wake waiters (they'd change on
+       every look).  poll_interval is only used on Circuit Python.'''
+    global _WAITERS
+    deadline = time.monotonic() + timeout
+    if _CHANGED:
+        with _CHANGED: _WAITERS += 1
+    try:
+        while True:
+            seen = _CHANGES
+            gen, current = snapshot()
+            changed = {k: current.get(k) for k, g in list(_KEY_GEN.items())
+                       if g > generation and (not prefix or k.startswith(prefix))}
+            remaining = deadline - time.monotonic()
+            if remaining <= 0: return gen, changed
+            if ignore_prefix:
+                if [k for k in changed if not k.startswith(ignore_prefix)]: return gen, changed
+            elif changed: return gen, changed
+            if not _CHANGED:
+                time.sleep(min(poll_interval, remaining))
+                continue
+            with _CHANGED:
+                if _CHANGES == seen: _CHANGED.wait(remaining)
+    finally:
+        if _CHANGED:
+            with _CHANGED: _WAITERS -= 1
+
+
+def _notify():
+    global _CHANGES
+    with _CHANGED:
+        _CHANGES += 1
+        _CHANGED.notify_all()
+
+
 # ---------- management
 
 def reset(counter_name=None):
     global VARZ
     if counter_name: VARZ[counter_name] = None
-    else: VARZ = {}
+    else: VARZ = _VarzDict()
+
+
+# ---------- histograms
+
+class Histogram:
+    '''Fixed-bucket histogram (typically of latencies in ms).
+
+       Memory and observe() cost are constant; percentiles are estimated as
+       the upper bound of the bucket where the percentile falls.  str()
+       gives a one-line summary, which is what /varz displays.'''
+
+    BUCKETS_MS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, float('inf'))
+
+    def __init__(self, buckets=None):
+        self.buckets = buckets or self.BUCKETS_MS
+        self.counts = [0] * len(self.buckets)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+        self._lock = threading.Lock() if not CIRCUITPYTHON else None
+
+    def observe(self, value):
+        i = 0
+        while value > self.buckets[i]: i += 1
+        if self._lock: self._lock.acquire()
+        self.counts[i] += 1
+        self.count += 1
+        self.sum += value
+        if value > self.max: self.max = value
+        if self._lock: self._lock.release()
+
+    def percentile(self, p):
+        if not self.count: return None
+        target = p / 100.0 * self.count
+        running = 0
+        for i, c in enumerate(self.counts):
+            running += c
+            if running >= target: return min(self.buckets[i], self.max)
+        return self.max
+
+    def summary(self):
+        if not self.count: return {'n': 0}
+        return {'n': self.count, 'avg': round(self.sum / self.count, 1),
+                'p50': self.percentile(50), 'p90': self.percentile(90),
+                'p99': self.percentile(99), 'max': round(self.max, 1)}
+
+    def __str__(self):
+        return ' '.join(['%s=%s' % (k, v) for k, v in self.summary().items()])
+
+
+# ---------- windowed rates
+
+class Rate:
+    '''Events-per-second over the last 1, 5 and 15 minutes.
+
+       Counts are kept in a fixed ring of time buckets covering the longest
+       window, so memory is constant and mark() is O(1) (stale buckets are
+       zeroed lazily as time advances).  Windows are bucket-aligned, so a
+       rate may include up to one bucket's worth of older events.  str()
+       gives a one-line summary, which is what /varz displays.'''
+
+    BUCKET_SECONDS = 5
+    WINDOWS = (('1m', 60), ('5m', 300), ('15m', 900))
+
+    def __init__(self, bucket_seconds=None, windows=None):
+        self.bucket_seconds = bucket_seconds or self.BUCKET_SECONDS
+        self.windows = windows or self.WINDOWS
+        self.num_buckets = max([w for _, w in self.windows]) // self.bucket_seconds
+        self.counts = [0] * self.num_buckets
+        self.total = 0
+        self.start = time.monotonic()
+        self.current = int(self.start // self.bucket_seconds)   # Absolute index of the newest bucket.
+        self._lock = threading.Lock() if not CIRCUITPYTHON else None
+
+    def mark(self, n=1, now=None):
+        if self._lock: self._lock.acquire()
+        self._advance(now or time.monotonic())
+        self.counts[self.current % self.num_buckets] += n
+        self.total += n
+        if self._lock: self._lock.release()
+
+    def count(self, seconds, now=None):
+        '''Number of events in the last {seconds} (rounded up to whole buckets).'''
+        buckets = min(-(-seconds // self.bucket_seconds), self.num_buckets)
+        if self._lock: self._lock.acquire()
+        self._advance(now or time.monotonic())
+        total = sum([self.counts[(self.current - i) % self.num_buckets] for i in range(buckets)])
+        if self._lock: self._lock.release()
+        return total
+
+    def rate(self, seconds, now=None):
+        '''Events per second over the last {seconds}, or since creation if that was more recent.'''
+        now = now or time.monotonic()
+        span = min(seconds, max(now - self.start, 1))
+        return self.count(seconds, now) / span
+
+    def rates(self, now=None):
+        now = now or time.monotonic()
+        return {name: round(self.rate(seconds, now), 3) for name, seconds in self.windows}
+
+    def __str__(self):
+        return ' '.join(['%s=%s/s' % (k, v) for k, v in self.rates().items()])
+
+    def _advance(self, now):   # Caller must hold self._lock.
+        newest = int(now // self.bucket_seconds)
+        gap = newest - self.current
+        if gap <= 0: return
+        if gap >= self.num_buckets:
+            self.counts = [0] * self.num_buckets
+        else:
+            for i in range(1, gap + 1): self.counts[(self.current + i) % self.num_buckets] = 0
+        self.current = newest
 
 
 # ==========  INTERNALS
 
+# ---------- sharded counters
+
+class _Counter:
+    '''A counter that's safe to increment from many threads without a lock.
+
+       Each thread increments its own shard (a one-element list, found via
+       threading.local), so there are no lost updates from racing
+       read-modify-writes.  value() sums the shards.  Shards of threads that
+       have exited are folded into .base, so the per-connection threads of
+       ThreadingHTTPServer don't accumulate forever.'''
+
+    MAX_SHARDS = 32     # Fold dead threads' shards once there are this many.
+
+    def __init__(self, base=0):
+        self.base = base
+        self._local = threading.local()
+        self._shards = []           # list of (thread, [value])
+        self._lock = threading.Lock()
+
+    def inc(self, add=1):
+        try:
+            self._local.shard[0] += add
+        except AttributeError:
+            shard = [add]
+            with self._lock:
+                if len(self._shards) >= self.MAX_SHARDS: self._fold()
+                self._shards.append((threading.current_thread(), shard))
+            self._local.shard = shard
+
+    def value(self):
+        with self._lock:
+            if len(self._shards) >= self.MAX_SHARDS: self._fold()
+            return self.base + sum([shard[0] for _, shard in self._shards])
+
+    def _fold(self):   # Caller must hold self._lock.
+        live = []
+        for thread, shard in self._shards:
+            if thread.is_alive(): live.append((thread, shard))
+            else: self.base += shard[0]
+        self._shards = live
+
+
+# Circuit Python has no threads, so a plain number suffices.
+class _SimpleCounter:
+    def __init__(self, base=0): self.base = base
+    def inc(self, add=1): self.base += add
+    def value(self): return self.base
+
+if CIRCUITPYTHON: _Counter = _SimpleCounter
+
+
+def _resolve(value):
+    return value.value() if value.__class__ is _Counter else value
+
+
+def _make_counter(counter_name):
+    if _VARZ_LOCK: _VARZ_LOCK.acquire()
+    try:
+        existing = dict.get(VARZ, counter_name)
+        if existing.__class__ is _Counter: return existing   # Another thread won the race.
+        counter = VARZ[counter_name] = _Counter(existing if isinstance(existing, (int, float)) else 0)
+        return counter
+    finally:
+        if _VARZ_LOCK: _VARZ_LOCK.release()
+
+
+def _make_instance(var_name, cls):
+    if _VARZ_LOCK: _VARZ_LOCK.acquire()
+    try:
+        existing = dict.get(VARZ, var_name)
+        if isinstance(existing, cls): return existing   # Another thread won the race.
+        instance = VARZ[var_name] = cls()
+        return instance
+    finally:
+        if _VARZ_LOCK: _VARZ_LOCK.release()
+
+
+def _exportable(value):
+    if value is None or isinstance(value, (int, float, str, bool)): return value
+    return str(value)
+
+
+def _prom_histogram_factory(name, doc, labels):
+    return PC.Histogram(name, doc, labels, buckets=[b / 1000.0 for b in Histogram.BUCKETS_MS])
+
+
 def _get_prom_instance(varz_name, factory):
+    child = PROM_CHILDREN.get((varz_name, factory))
+    if child: return child
     prefix = '' if varz_name.startswith('healthz') else 'varz_'
     prom_name = prefix + re.sub(r'[^a-zA-Z0-9_:]', '_', varz_name)
     global PROM_INSTANCES
     if prom_name not in PROM_INSTANCES: PROM_INSTANCES[prom_name] = factory(prom_name, '', ['program'])
-    return PROM_INSTANCES[prom_name].labels(PROGRAM_NAME)
+    child = PROM_CHILDREN[(varz_name, factory)] = PROM_INSTANCES[prom_name].labels(PROGRAM_NAME)
+    return child
 
 
 def metrics_handler(request):
@@ -30,6 +30,11 @@ has only quite low-level networking.  So, the functionality is split like this:
 
 - This file (webserver.py) adds on standard Python ("CPython") networking
   (including support for TLS; i.e. certficiate protected https), and threading.
+  By default that's one thread per connection; pass
+  server_class=AsyncioHTTPServer to .start() to instead use a single event
+  loop for the networking and a small bounded thread pool for the handlers,
+  or server_class=PooledHTTPServer for a fixed thread pool with a bounded
+  queue that sheds excess load with 503's.
 
 - webserver_circpy.py is also built on webserver_base.py, and links in the
   low-level networking support for Circuit Python, and a non-blocking "listen"
@@ -37,9 +42,10 @@ has only quite low-level networking.  So, the functionality is split like this:
 
 '''
 
-import cgi, threading, ssl, sys
+import collections, os, re, tempfile, threading, ssl, sys, sysconfig, time
 
 import kcore.common as C             # for logging.
+import kcore.varz as V
 from kcore.webserver_base import *   # you can use Request/Response without separately importing webserver_base.
 
 PY_VER = sys.version_info[0]
@@ -49,81 +55,735 @@ if PY_VER == 2:
     DEFAULT_SERVER_CLASS = HTTPServer
 else:
     from urllib.parse import parse_qs
-    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+    from http.server import BaseHTTPRequestHandler, HTTPServer, ThreadingHTTPServer
+    import asyncio, concurrent.futures, email.utils, http.client, io, mimetypes, queue, socket
     DEFAULT_SERVER_CLASS = ThreadingHTTPServer
 
 
 class Worker(BaseHTTPRequestHandler):
+    # One Worker instance is created per connection, so per-connection
+    # keep-alive state lives here.  Settings come from WebServer.start().
+    def setup(self):
+        ws = self.server._k_webserver
+        self.keep_alive = ws.keep_alive
+        self.requests_left = ws.keep_alive_max_requests
+        if self.keep_alive:
+            self.protocol_version = 'HTTP/1.1'
+            self.timeout = ws.keep_alive_timeout    # idle timeout; applied to the socket by setup().
+        BaseHTTPRequestHandler.setup(self)
+
     def send(self, response):
-        if PY_VER == 3 and not response.binary: response.body = response.body.encode('utf-8')
+        if response.stream is not None: return self.send_stream(response)
+        # nb: don't modify response; cached Responses are shared between requests.
+        body = response.body.encode('utf-8') if PY_VER == 3 and not response.binary else response.body
+        self.send_response(response.status_code, response.status_msg)
+        self.send_header("Server", 'k_webserver')
+        self.send_header("Connection", self._connection_header())
+        self.send_header("Content-type", response.msg_type)
+        self.send_header("Content-Length", len(body))
+        for k, v in response.extra_headers.items(): self.send_header(k, v)
+        self.end_headers()
+        self.wfile.write(body)
+        return True
+
+    def send_stream(self, response):
+        '''Send a Response whose body is a file (via sendfile) or an iterator
+           (chunked for HTTP/1.1 clients, or until-close for HTTP/1.0).'''
+        length = stream_length(response.stream)
+        chunked = length is None and self.request_version == 'HTTP/1.1'
+        if chunked: self.protocol_version = 'HTTP/1.1'
+        elif length is None: self.close_connection = True   # HTTP/1.0: body ends when the connection does.
         self.send_response(response.status_code, response.status_msg)
         self.send_header("Server", 'k_webserver')
-        self.send_header("Connection", 'close')
+        self.send_header("Connection", 'close' if self.close_connection else self._connection_header())
         self.send_header("Content-type", response.msg_type)
-        self.send_header("Content-Length", len(response.body))
+        if length is not None: self.send_header("Content-Length", length)
+        if chunked: self.send_header("Transfer-Encoding", 'chunked')
         for k, v in response.extra_headers.items(): self.send_header(k, v)
         self.end_headers()
-        self.wfile.write(response.body)
+        try:
+            if length is not None:
+                self.wfile.flush()
+                self.connection.sendfile(response.stream)   # zero-copy where the OS supports it.
+            else:
+                for data in stream_chunks(response):
+                    self.wfile.write(chunk_frame(data) if chunked else data)
+                if chunked: self.wfile.write(b'0\r\n\r\n')
+        finally:
+            if hasattr(response.stream, 'close'): response.stream.close()
         return True
 
+    # Decide whether this connection stays open after the current response.
+    # Note that send_header() updates self.close_connection based on the value.
+    def _connection_header(self):
+        if not self.keep_alive or self.close_connection: return 'close'
+        if self.requests_left:
+            self.requests_left -= 1
+            if self.requests_left <= 0: return 'close'
+        return 'keep-alive'
+
     def do_GET(self):
         request = BaseHTTPRequestHandler_to_Request(self, 'GET')
         return self.send(self.server._k_webserver.find_and_run_handler(request))
 
     def do_POST(self):
-        request = BaseHTTPRequestHandler_to_Request(self, 'POST', post_params=self.parse_post())
+        try:
+            post_params = self.parse_post()
+        except PostError as e:
+            self.close_connection = True     # Unread body is still on the socket.
+            return self.send(Response(str(e), e.status_code))
+        # Bodies that aren't forms (e.g. JSON) aren't parsed, but must still be
+        # read, or a keep-alive connection would take them as the next request.
+        self.body.drain()
+        request = BaseHTTPRequestHandler_to_Request(self, 'POST', post_params=post_params)
         return self.send(self.server._k_webserver.find_and_run_handler(request))
 
     def parse_post(self):
-        if PY_VER == 2: ctype, pdict = cgi.parse_header(self.headers.getheader('content-type'))
-        else: ctype, pdict = cgi.parse_header(self.headers.get('content-type'))
         if PY_VER == 2:
-            length = int(self.headers.getheader('content-length'))
+            ctype_header = self.headers.getheader('content-type')
+            length = int(self.headers.getheader('content-length') or 0)
         else:
-            length = int(self.headers.get('content-length'))
-        if ctype == 'multipart/form-data':
-            if PY_VER == 3:
-                pdict['boundary'] = bytes(pdict['boundary'], "utf-8")
-                pdict['CONTENT-LENGTH'] = length   # https://bugs.python.org/issue34226 (needed for Py 3.6 on RPi)
-            postvars = cgi.parse_multipart(self.rfile, pdict)
-        elif ctype == 'application/x-www-form-urlencoded':
-            postvars = parse_qs(self.rfile.read(length), keep_blank_values=1)
-            if PY_VER == 2:
-                postvars = {k: v[0] for k, v in postvars.items()}
-            if PY_VER == 3:
-                postvars = {k.decode('utf-8'): v[0].decode('utf-8') for k, v in postvars.items()}
-        else: postvars = {}
-        return postvars
+            ctype_header = self.headers.get('content-type')
+            length = int(self.headers.get('content-length') or 0)
+        self.body = BodyReader(self.rfile.read, length)
+        return parse_post_data(ctype_header, length, self.body, self.server._k_webserver.max_post_size)
 
     def log_message(self, format, *args):
-        if args[0] in ['GET', 'POST']: return    # Already handled by logging adapter.
+        if args and args[0] in ['GET', 'POST']: return    # Already handled by logging adapter.
+        if format.startswith('Request timed out'): return C.log_debug(format % args)  # idle keep-alive expired.
         C.log_info(format % args)                # Probably redundant, but better not to miss something accidentally.
 
 
+# ---------- POST parsing
+
+MAX_POST_SIZE = 16 * 1024 * 1024     # Default for WebServer.start(max_post_size=...)
+MAX_FIELD_SIZE = 1024 * 1024         # Max size of a non-file multipart field.
+MAX_BUFFERED_BODY = 1024 * 1024      # Max non-form body AsyncioHTTPServer will hold for Request.body.
+FORM_TYPES = ('multipart/form-data', 'application/x-www-form-urlencoded')
+UPLOAD_SPOOL_SIZE = 512 * 1024       # Uploaded files larger than this are spooled to disk.
+READ_BLOCK_SIZE = 64 * 1024
+
+
+class PostError(Exception):
+    def __init__(self, msg, status_code=400):
+        super(PostError, self).__init__(msg)
+        self.status_code = status_code
+
+
+class UploadedFile:
+    '''A multipart/form-data part that had a filename.  The contents are in
+       .file (in memory, or spooled to a temp file if large), and are only
+       read and decoded if .value or .text are accessed.'''
+    def __init__(self, filename, content_type, file, size):
+        self.filename = filename
+        self.content_type = content_type
+        self.file = file
+        self.size = size
+
+    def __repr__(self): return 'UploadedFile(%r, %d bytes)' % (self.filename, self.size)
+
+    def read(self):
+        self.file.seek(0)
+        return self.file.read()
+
+    @property
+    def value(self): return self.read()
+
+    @property
+    def text(self): return self.read().decode('utf-8')
+
+
+class BodyReader:
+    '''File-like view of a request body: reads (via read_func(n)) never go
+       past its length, and drain() discards whatever wasn't read.'''
+    def __init__(self, read_func, length):
+        self.read_func = read_func
+        self.remaining = length
+
+    def read(self, n=-1):
+        if n < 0 or n > self.remaining: n = self.remaining
+        if n <= 0: return b''
+        data = self.read_func(n)
+        self.remaining -= len(data)
+        if not data: self.remaining = 0
+        return data
+
+    def drain(self):
+        while self.remaining:
+            if not self.read(READ_BLOCK_SIZE): break
+
+
+# Shared by Worker and AsyncioHTTPServer.  rfile is any file-like object
+# positioned at the start of the request body.  Raises PostError.
+#
+# urlencoded forms return {name: value}.  multipart forms return
+# {name: [values]} (as cgi.parse_multipart did), where values are strings for
+# regular fields, and UploadedFile instances for parts with a filename.
+def parse_post_data(ctype_header, length, rfile, max_post_size=MAX_POST_SIZE):
+    if max_post_size and length > max_post_size:
+        V.bump('web-post-too-large')
+        raise PostError('POST body of %d bytes exceeds limit of %d' % (length, max_post_size), 413)
+    ctype, pdict = parse_header(ctype_header or '')
+    if ctype == 'multipart/form-data':
+        if not pdict.get('boundary'): raise PostError('multipart POST without boundary')
+        return MultipartParser(rfile, pdict['boundary'].encode('utf-8'), length).parse()
+    elif ctype == 'application/x-www-form-urlencoded':
+        postvars = parse_qs(rfile.read(length), keep_blank_values=1)
+        if PY_VER == 2:
+            postvars = {k: v[0] for k, v in postvars.items()}
+        if PY_VER == 3:
+            postvars = {k.decode('utf-8'): v[0].decode('utf-8') for k, v in postvars.items()}
+    else: postvars = {}
+    return postvars
+
+
+# in: header value like 'multipart/form-data; boundary="xyz"'
+# out: ('multipart/form-data', {'boundary': 'xyz'})   [replaces cgi.parse_header]
+def parse_header(line):
+    parts = line.split(';')
+    key = parts.pop(0).strip().lower()
+    pdict = {}
+    for p in parts:
+        if '=' not in p: continue
+        name, value = p.split('=', 1)
+        value = value.strip()
+        if len(value) >= 2 and value[0] == value[-1] == '"':
+            value = value[1:-1].replace('\\\\', '\\').replace('\\"', '"')
+        pdict[name.strip().lower()] = value
+    return key, pdict
+
+
+class MultipartParser:
+    '''Incremental multipart/form-data parser.  Reads at most length bytes
+       from rfile, in READ_BLOCK_SIZE blocks, so memory use doesn't depend on
+       the size of the upload.'''
+
+    def __init__(self, rfile, boundary, length,
+                 max_field_size=MAX_FIELD_SIZE, spool_size=UPLOAD_SPOOL_SIZE):
+        self.rfile = rfile
+        self.remaining = length
+        self.delimiter = b'\r\n--' + boundary
+        self.max_field_size = max_field_size
+        self.spool_size = spool_size
+        self.buf = b'\r\n'      # So the first boundary looks like every other delimiter.
+
+    def parse(self):
+        out = {}
+        self._skip_to_delimiter()
+        while True:
+            if not self._fill(2): raise PostError('truncated multipart body')
+            if self.buf.startswith(b'--'): break           # closing delimiter.
+            if not self.buf.startswith(b'\r\n'): raise PostError('malformed multipart delimiter')
+            self.buf = self.buf[2:]
+            headers = self._read_part_headers()
+            _, disposition = parse_header('x; ' + headers.get('content-disposition', '').split(';', 1)[-1])
+            name = disposition.get('name')
+            filename = disposition.get('filename')
+            if filename is None:
+                sink = io.BytesIO()
+                size = self._copy_part(sink, self.max_field_size)
+                value = sink.getvalue().decode('utf-8', 'replace')
+            else:
+                sink = tempfile.SpooledTemporaryFile(max_size=self.spool_size)
+                size = self._copy_part(sink, None)
+                sink.seek(0)
+                value = UploadedFile(filename, headers.get('content-type'), sink, size)
+            if name is not None: out.setdefault(name, []).append(value)
+        return out
+
+    # ---------- internals
+
+    def _read_block(self):
+        if self.remaining <= 0: return b''
+        data = self.rfile.read(min(READ_BLOCK_SIZE, self.remaining))
+        self.remaining -= len(data)
+        if not data: self.remaining = 0
+        return data
+
+    # Ensure at least n bytes are buffered, if possible.  Returns False at end of input.
+    def _fill(self, n):
+        while len(self.buf) < n:
+            data = self._read_block()
+            if not data: return False
+            self.buf += data
+        return True
+
+    def _skip_to_delimiter(self):
+        sink = io.BytesIO()
+        self._copy_part(sink, 64 * 1024)    # the (usually empty) preamble.
+
+    def _read_part_headers(self):
+        while True:
+            pos = self.buf.find(b'\r\n\r\n')
+            if pos >= 0: break
+            if len(self.buf) > 16 * 1024: raise PostError('multipart part headers too large')
+            data = self._read_block()
+            if not data: raise PostError('truncated multipart headers')
+            self.buf += data
+        raw, self.buf = self.buf[:pos], self.buf[pos + 4:]
+        headers = {}
+        for line in raw.decode('utf-8', 'replace').split('\r\n'):
+            if ':' not in line: continue
+            k, v = line.split(':', 1)
+            headers[k.strip().lower()] = v.strip()
+        return headers
+
+    # Copy data up to the next delimiter into sink, and consume the delimiter.
+    # Returns bytes copied.
+    def _copy_part(self, sink, max_size):
+        size = 0
+        keep = len(self.delimiter) - 1     # A delimiter might straddle two blocks.
+        while True:
+            pos = self.buf.find(self.delimiter)
+            if pos >= 0:
+                chunk, self.buf = self.buf[:pos], self.buf[pos + len(self.delimiter):]
+            else:
+                chunk, self.buf = self.buf[:-keep], self.buf[-keep:]
+            size += len(chunk)
+            if max_size and size > max_size: raise PostError('multipart field exceeds %d bytes' % max_size, 413)
+            sink.write(chunk)
+            if pos >= 0: return size
+            data = self._read_block()
+            if not data: raise PostError('truncated multipart body')
+            self.buf += data
+
+
+# ---------- streaming helpers shared by the server classes
+
+# Returns the number of bytes remaining in a (real) file stream, or None for
+# streams of unknown length, which must be sent chunked.
+def stream_length(stream):
+    try:
+        return os.fstat(stream.fileno()).st_size - stream.tell()
+    except Exception:
+        return None
+
+# Yields non-empty bytes from a non-file stream Response.
+def stream_chunks(response):
+    for data in response.stream:
+        if not data: continue
+        if not isinstance(data, bytes): data = str(data).encode('utf-8')
+        yield data
+
+def chunk_frame(data):
+    return b'%x\r\n%s\r\n' % (len(data), data)
+
+
+# Returns a streaming Response for a file on disk (sent via sendfile by the
+# CPython servers).  Returns a 404 Response if the file can't be opened.
+def file_response(pathname, msg_type=None, extra_headers={}):
+    try:
+        f = open(pathname, 'rb')
+    except Exception:
+        return Response('file not found', 404)
+    if not msg_type:
+        msg_type = mimetypes.guess_type(pathname)[0] or 'application/octet-stream'
+    return Response(f, msg_type=msg_type, extra_headers=extra_headers, binary=True)
+
+
+# ---------- cached static files and templates
+
+class _CachedFile:
+    def __init__(self, pathname, st, data):
+        self.pathname = pathname
+        self.mtime = st.st_mtime
+        self.size = st.st_size
+        self.data = data                  # bytes
+        self.etag = '"%x-%x"' % (self.size, int(self.mtime * 1000000))
+        self.last_modified = email.utils.formatdate(self.mtime, usegmt=True)
+        self.checked = time.time()
+        self._template = None
+
+    def template(self):
+        '''Returns the file split into alternating [literal, key, literal, key, ...]
+           pieces, for {{ key }} substitution.  Computed once per file load.'''
+        if self._template is None: self._template = TEMPLATE_RE.split(self.data.decode('utf-8'))
+        return self._template
+
+
+TEMPLATE_RE = re.compile(r'\{\{ (\S+?) \}\}')
+
+
+class FileCache:
+    '''In-memory cache of static files and templates, invalidated by mtime.
+
+       Files are re-stat'd at most once per check_interval seconds, so
+       frequently polled pages do (almost) no disk I/O.  Files larger than
+       max_file_size aren't cached; they're streamed from disk instead.'''
+
+    def __init__(self, max_entries=128, max_file_size=4 * 1024 * 1024, check_interval=1.0):
+        self.max_entries = max_entries
+        self.max_file_size = max_file_size
+        self.check_interval = check_interval
+        self.entries = {}           # pathname -> _CachedFile; dict order is LRU order.
+        self.lock = threading.Lock()
+
+    def get(self, pathname):
+        '''Returns a _CachedFile, or None if the file is too large to cache.
+           Raises OSError if the file can't be read.'''
+        with self.lock: entry = self.entries.get(pathname)
+        now = time.time()
+        if entry and now - entry.checked < self.check_interval: return entry
+        st = os.stat(pathname)
+        if entry and entry.mtime == st.st_mtime and entry.size == st.st_size:
+            entry.checked = now
+            return entry
+        if st.st_size > self.max_file_size: return None
+        V.bump('web-file-cache-load')
+        with open(pathname, 'rb') as f: entry = _CachedFile(pathname, st, f.read())
+        with self.lock:
+            self.entries.pop(pathname, None)
+            while self.entries and len(self.entries) >= self.max_entries:
+                self.entries.pop(next(iter(self.entries)))
+            self.entries[pathname] = entry
+        return entry
+
+    def response(self, request, pathname, msg_type=None):
+        '''Returns a Response for a static file, honoring conditional GET
+           (If-None-Match / If-Modified-Since => 304).'''
+        try:
+            entry = self.get(pathname)
+        except OSError:
+            return Response('file not found', 404)
+        if not msg_type: msg_type = mimetypes.guess_type(pathname)[0] or 'application/octet-stream'
+        if entry is None: return file_response(pathname, msg_type)
+        headers = {'ETag': entry.etag, 'Last-Modified': entry.last_modified}
+        etag = request and _not_modified(request.headers, entry)
+        if etag:
+            V.bump('web-file-cache-304')
+            if etag is not True: headers['ETag'] = etag     # the (maybe compressed) variant the client has.
+            return Response(b'', 304, headers, msg_type, binary=True)
+        return Response(entry.data, 200, headers, msg_type, binary=True)
+
+    def render(self, pathname, repl):
+        '''Returns the file's contents with each "{{ key }}" replaced by str(repl[key]).
+           Keys not in repl are left as-is.  Raises OSError if the file can't be read.'''
+        entry = self.get(pathname)
+        if entry is None:
+            with open(pathname) as f: entry = _CachedFile(pathname, os.stat(pathname), f.read().encode('utf-8'))
+        pieces = entry.template()
+        out = []
+        for i, piece in enumerate(pieces):
+            if i % 2 == 0: out.append(piece)
+            elif piece in repl: out.append(str(repl[piece]))
+            else: out.append('{{ %s }}' % piece)
+        return ''.join(out)
+
+
+# Returns the matching ETag (which may be for a compressed variant of the
+# file), True for other reasons not to resend the file, or False.
+def _not_modified(headers, entry):
+    inm = headers.get('If-None-Match')
+    if inm:
+        if inm.strip() == '*': return True
+        variants = [entry.etag] + [encoded_etag(entry.etag, e) for e in ('gzip', 'deflate')]
+        for tag in [i.strip() for i in inm.split(',')]:
+            if tag in variants: return tag
+        return False
+    ims = headers.get('If-Modified-Since')
+    if ims:
+        try:
+            return int(entry.mtime) <= email.utils.parsedate_to_datetime(ims).timestamp()
+        except Exception:
+            return False
+    return False
+
+
+FILE_CACHE = FileCache()    # Shared singleton used by the helpers below.
+
+def static_response(request, pathname, msg_type=None): return FILE_CACHE.response(request, pathname, msg_type)
+def render_template(pathname, repl): return FILE_CACHE.render(pathname, repl)
+
+
+class PooledHTTPServer(HTTPServer):
+    '''HTTPServer with a fixed pool of handler threads and a bounded accept queue.
+
+       Pass as WebServer.start(server_class=PooledHTTPServer).  Accepted
+       connections wait in a queue of at most queue_size entries for one of the
+       pool_size worker threads.  If the queue is full, the connection gets an
+       immediate 503 rather than starting yet another thread.  Note that with
+       keep_alive, a worker stays with its connection until the connection closes.
+
+       Exports varz: web-pool-queue-depth, web-pool-wait-ms (most recent),
+       web-pool-wait-ms-max, and web-pool-rejected.'''
+
+    pool_size = 8            # Override via subclass or functools.partial.
+    queue_size = 32
+    daemon_threads = True
+
+    def __init__(self, server_address, RequestHandlerClass, pool_size=None, queue_size=None):
+        if pool_size: self.pool_size = pool_size
+        if queue_size: self.queue_size = queue_size
+        self._queue = queue.Queue(self.queue_size)
+        self._wait_ms_max = 0
+        HTTPServer.__init__(self, server_address, RequestHandlerClass)
+        self._workers = []
+        for i in range(self.pool_size):
+            t = threading.Thread(target=self._worker, name='k_webserver_pool_%d' % i)
+            t.daemon = True
+            t.start()
+            self._workers.append(t)
+
+    def process_request(self, request, client_address):
+        try:
+            self._queue.put_nowait((request, client_address, time.time()))
+        except queue.Full:
+            V.bump('web-pool-rejected')
+            self._reject(request)
+            return
+        V.set('web-pool-queue-depth', self._queue.qsize())
+
+    def server_close(self):
+        HTTPServer.server_close(self)
+        for _ in self._workers: self._queue.put(None)   # Sentinels to stop the workers.
+
+    # ---------- internals
+
+    def _worker(self):
+        while True:
+            item = self._queue.get()
+            if item is None: return
+            request, client_address, queued_time = item
+            wait_ms = int((time.time() - queued_time) * 1000)
+            self._wait_ms_max = max(self._wait_ms_max, wait_ms)
+            V.set('web-pool-queue-depth', self._queue.qsize())
+            V.set('web-pool-wait-ms', wait_ms)
+            V.set('web-pool-wait-ms-max', self._wait_ms_max)
+            try:
+                self.finish_request(request, client_address)
+            except Exception:
+                self.handle_error(request, client_address)
+            finally:
+                self.shutdown_request(request)
+
+    def _reject(self, request):
+        body = b'server busy'
+        try:
+            request.sendall(b'HTTP/1.0 503 Service Unavailable\r\nServer: k_webserver\r\n'
+                            b'Connection: close\r\nContent-type: text\r\n'
+                            b'Content-Length: %d\r\n\r\n%s' % (len(body), body))
+        except Exception as e:
+            C.log_debug('error sending 503 for full pool queue: %s' % e)
+        self.shutdown_request(request)
+
+
+class AsyncioHTTPServer:
+    '''Event-loop based alternative to ThreadingHTTPServer (Python 3 only).
+
+       Pass as WebServer.start(server_class=AsyncioHTTPServer).  All the
+       network I/O is done on a single asyncio loop, so idle or slow
+       connections cost a few KB of buffers rather than an OS thread each.
+       Handlers are still plain blocking functions; they're run on a bounded
+       thread pool of max_workers threads.  Requests beyond that wait (cheaply)
+       on the loop until a worker frees up.
+
+       Form POST bodies are read on the loop into a spool file (on disk
+       beyond READ_BLOCK_SIZE) and then parsed on the thread pool; other
+       request bodies are passed in Request.body, and so are limited to
+       MAX_BUFFERED_BODY bytes.'''
+
+    max_workers = 8          # Override via subclass or functools.partial.
+    max_header_size = 65536
+
+    def __init__(self, server_address, RequestHandlerClass=None, max_workers=None):
+        # RequestHandlerClass is accepted for signature compatibility with
+        # socketserver classes, but isn't used; this class does its own parsing.
+        self.server_address = server_address
+        if max_workers: self.max_workers = max_workers
+        self.socket = socket.create_server(server_address)
+        self.ssl_context = None     # Set by WebServer.start() for TLS.
+        self.executor = None
+        self._loop = None
+        self._stop = None
+        self._stopped = threading.Event()
+
+    def serve_forever(self):
+        self._stopped.clear()
+        try:
+            asyncio.run(self._serve())
+        finally:
+            if self.executor: self.executor.shutdown(wait=False)
+            self.socket.close()
+            self._stopped.set()
+
+    def shutdown(self):
+        '''Stop serve_forever() and wait for it to return.  Safe to call from a handler.'''
+        if self._loop and self._stop:
+            self._loop.call_soon_threadsafe(self._stop.set)
+            self._stopped.wait()
+
+    # ---------- internals
+
+    async def _serve(self):
+        self._loop = asyncio.get_running_loop()
+        self._stop = asyncio.Event()
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.max_workers)
+        server = await asyncio.start_server(self._handle_connection, sock=self.socket,
+                                            ssl=self.ssl_context, limit=self.max_header_size)
+        async with server:
+            await self._stop.wait()
+        # nb: don't await server.wait_closed(); a handler calling shutdown() is still connected.
+
+    async def _handle_connection(self, reader, writer):
+        ws = self._k_webserver
+        peer = writer.get_extra_info('peername')
+        remote_address = peer[0] if peer else None
+        requests_left = ws.keep_alive_max_requests
+        idle_timeout = ws.keep_alive_timeout if ws.keep_alive else None
+        try:
+            while True:
+                try:
+                    head = await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'), idle_timeout)
+                except (asyncio.IncompleteReadError, asyncio.TimeoutError, ConnectionError):
+                    return
+                except asyncio.LimitOverrunError:
+                    return await self._send_error(writer, 431, 'request header too large')
+
+                request_line, _, header_bytes = head.partition(b'\r\n')
+                try:
+                    method, full_path, version = request_line.decode('iso-8859-1').split(None, 2)
+                    headers = http.client.parse_headers(io.BytesIO(header_bytes))
+                    length = int(headers.get('content-length') or 0)
+                except Exception:
+                    return await self._send_error(writer, 400, 'bad request')
+
+                if ws.max_post_size and length > ws.max_post_size:
+                    return await self._send_error(writer, 413, 'POST body of %d bytes exceeds limit of %d' % (length, ws.max_post_size))
+                body, post_params = b'', {}
+                if method == 'POST' and parse_header(headers.get('content-type') or '')[0] in FORM_TYPES:
+                    # Forms are read here on the loop (so slow uploads don't tie up a
+                    # worker thread) into a spool file (so large ones aren't held in
+                    # memory), and then parsed on the executor.
+                    spool = await self._spool_body(reader, length)
+                    try:
+                        post_params = await self._loop.run_in_executor(
+                            self.executor, parse_post_data, headers.get('content-type'), length, spool, ws.max_post_size)
+                    except PostError as e:
+                        return await self._send_error(writer, e.status_code, str(e))
+                    finally:
+                        spool.close()
+                elif length > MAX_BUFFERED_BODY:
+                    V.bump('web-post-too-large')
+                    return await self._send_error(writer, 413, 'body of %d bytes exceeds limit of %d' % (length, MAX_BUFFERED_BODY))
+                elif length:
+                    body = await reader.readexactly(length)
+                request = Request(method, full_path, body=body, headers=headers,
+                                  remote_address=remote_address, post_params=post_params, server=self)
+                response = await self._loop.run_in_executor(self.executor, ws.find_and_run_handler, request)
+
+                keep_open = (ws.keep_alive and version == 'HTTP/1.1' and
+                             headers.get('connection', '').lower() != 'close')
+                if keep_open and requests_left:
+                    requests_left -= 1
+                    if requests_left <= 0: keep_open = False
+                keep_open = await self._send(writer, response, version, keep_open)
+                if not keep_open: return
+        except Exception as e:
+            C.log_debug('asyncio connection from %s ended with error: %s' % (remote_address, e))
+        finally:
+            writer.close()
+
+    # Returns a file with (up to) length bytes of request body, rewound.
+    async def _spool_body(self, reader, length):
+        spool = tempfile.SpooledTemporaryFile(max_size=READ_BLOCK_SIZE)
+        remaining = length
+        while remaining:
+            data = await reader.read(min(READ_BLOCK_SIZE, remaining))
+            if not data: break
+            spool.write(data)
+            remaining -= len(data)
+        spool.seek(0)
+        return spool
+
+    async def _send(self, writer, response, version, keep_open):
+        stream = response.stream
+        length = stream_length(stream) if stream is not None else None
+        if stream is None: body = response.body if response.binary else response.body.encode('utf-8')
+        chunked = stream is not None and length is None and version == 'HTTP/1.1'
+        if stream is not None and length is None and not chunked: keep_open = False
+        headers = {'Server': 'k_webserver',
+                   'Connection': 'keep-alive' if keep_open else 'close',
+                   'Content-type': response.msg_type}
+        if stream is None: headers['Content-Length'] = len(body)
+        elif length is not None: headers['Content-Length'] = length
+        if chunked: headers['Transfer-Encoding'] = 'chunked'
+        headers.update(response.extra_headers)
+        out = '%s %d %s\r\n' % ('HTTP/1.1' if version == 'HTTP/1.1' else 'HTTP/1.0',
+                                 response.status_code, response.status_msg)
+        out += ''.join(['%s: %s\r\n' % (k, v) for k, v in headers.items()]) + '\r\n'
+        if stream is None:
+            writer.write(out.encode('iso-8859-1') + body)
+            await writer.drain()
+            return keep_open
+        writer.write(out.encode('iso-8859-1'))
+        try:
+            if length is not None:
+                await writer.drain()
+                await self._loop.sendfile(writer.transport, stream)
+            else:
+                # Pull chunks on the executor, as generators may block doing real work.
+                chunks = stream_chunks(response)
+                while True:
+                    data = await self._loop.run_in_executor(self.executor, next, chunks, None)
+                    if data is None: break
+                    writer.write(chunk_frame(data) if chunked else data)
+                    await writer.drain()
+                if chunked: writer.write(b'0\r\n\r\n')
+                await writer.drain()
+        finally:
+            if hasattr(stream, 'close'): stream.close()
+        return keep_open
+
+    async def _send_error(self, writer, status_code, msg):
+        await self._send(writer, Response(msg, status_code), 'HTTP/1.0', False)
+
+
 class WebServer(WebServerBase):
     def __init__(self, *args, **kwargs):
+        '''Takes the same args as WebServerBase, plus profz=True to enable the
+           /profz standard handler (a sampling profiler; see profz_handler).'''
+        profz = kwargs.pop('profz', False)
         logging_adapter = kwargs.get('logging_adapter') or LoggingAdapter(
             log_request=C.log_info, log_404=C.log_info,
             log_general=C.log_info, log_exceptions=C.log_error,
             get_logz_html=C.last_logs_html)
         super(WebServer, self).__init__(logging_adapter=logging_adapter, *args, **kwargs)
+        if profz and self.standard_handlers: self.standard_handlers['/profz'] = profz_handler
 
 
     def start(self, port=None, listen='0.0.0.0', background=True,
               tls_cert_file=None, tls_key_file=None, tls_key_password=None,
-              server_class=DEFAULT_SERVER_CLASS):
+              server_class=DEFAULT_SERVER_CLASS,
+              keep_alive=False, keep_alive_timeout=15, keep_alive_max_requests=100,
+              stats_interval=10, max_post_size=MAX_POST_SIZE):
+        '''keep_alive enables HTTP/1.1 persistent connections, so frequent
+           pollers can reuse their TCP (and TLS) sessions.  An idle connection
+           is closed after keep_alive_timeout seconds, and any connection is
+           closed after serving keep_alive_max_requests requests (0 => no cap).
+
+           stats_interval is the seconds between background samples of the
+           system stats shown on /varz (0 => sample inline on each request).
+
+           POSTs with a Content-Length over max_post_size get a 413 reply.'''
 
         if port: self.port = port         # .start() overrides the constructor.
         if not self.port: self.port = 80
+        self.keep_alive = keep_alive
+        self.keep_alive_timeout = keep_alive_timeout
+        self.keep_alive_max_requests = keep_alive_max_requests
+        self.max_post_size = max_post_size
 
-        if '/varz' in self.standard_handlers: self.add_handler('/varz', ws_varz_handler)
+        if '/varz' in self.standard_handlers:
+            self.add_handler('/varz', ws_varz_handler)
+            if stats_interval: start_stats_sampler(stats_interval)
         self.httpd = server_class((listen, self.port), Worker)
 
         if tls_key_password: raise RuntimeError('TODO: support tls_key_password')
         if tls_key_file:
             ctx = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
             ctx.load_cert_chain(certfile=tls_cert_file, keyfile=tls_key_file)
-            self.httpd.socket = ctx.wrap_socket(self.httpd.socket)
+            if hasattr(self.httpd, 'ssl_context'): self.httpd.ssl_context = ctx  # e.g. AsyncioHTTPServer
+            else: self.httpd.socket = ctx.wrap_socket(self.httpd.socket)
         self.httpd._k_webserver = self  # Make my instance visible to handlers.
         self.logger.log_general('starting webserver on port %d' % self.port)
         if background:
@@ -135,20 +795,154 @@ class WebServer(WebServerBase):
             self.httpd.serve_forever()
 
 
-def ws_varz_handler(request):
-    extra_dict = {}
+# ---------- sampling profiler for /profz
+
+PROFZ_MAX_SECONDS = 60
+PROFZ_MIN_INTERVAL_MS = 1         # Smaller intervals just busy-spin the sampler.
+PROFZ_LOCK = threading.Lock()     # Only one profile at a time.
+
+def sample_stacks(seconds, interval=0.01, include_idle=False):
+    '''Sample the stacks of all threads (other than the caller's) every
+       interval seconds for the given duration.  Returns a dict from
+       collapsed stack ("thread;outer-frame;...;inner-frame") to sample count.'''
+    me = threading.get_ident()
+    names = {}
+    counts = {}
+    end = time.time() + seconds
+    while time.time() < end:
+        for ident, frame in sys._current_frames().items():
+            if ident == me: continue
+            if not include_idle and frame and is_idle_frame(frame): continue
+            frames = []
+            while frame:
+                code = frame.f_code
+                frames.append('%s:%s:%d' % (os.path.basename(code.co_filename), code.co_name, frame.f_lineno))
+                frame = frame.f_back
+            if ident not in names:
+                names = {t.ident: t.name for t in threading.enumerate()}
+            frames.append(names.get(ident, 'thread-%d' % ident))
+            stack = ';'.join(reversed(frames))
+            counts[stack] = counts.get(stack, 0) + 1
+        time.sleep(interval)
+    return counts
+
+# Innermost (Python) frames that indicate a thread is just waiting; skipped
+# unless include_idle.  (stdlib-relative filename, function name)
+IDLE_FRAMES = {
+    ('threading.py', 'wait'),
+    ('selectors.py', 'select'),
+    ('socket.py', 'accept'),
+    ('socket.py', 'readinto'),
+    ('queue.py', 'get'),
+    ('socketserver.py', 'serve_forever'),
+    (os.path.join('concurrent', 'futures', 'thread.py'), '_worker'),
+}
+STDLIB_DIR = sysconfig.get_paths()['stdlib'] + os.sep
+
+def is_idle_frame(frame):
+    code = frame.f_code
+    if not code.co_filename.startswith(STDLIB_DIR): return False
+    return (code.co_filename[len(STDLIB_DIR):], code.co_name) in IDLE_FRAMES
+
+
+def profz_handler(request):
+    '''/profz?seconds=N[&interval_ms=M][&idle=1]: sample all threads for N
+       seconds, and return the stacks in "collapsed" format (one line per
+       distinct stack, followed by its sample count), suitable for
+       flamegraph.pl or speedscope.'''
+    try:
+        seconds = min(float(request.get_params.get('seconds', 5)), PROFZ_MAX_SECONDS)
+        interval_ms = float(request.get_params.get('interval_ms', 10))
+    except ValueError:
+        return Response('invalid seconds or interval_ms', 400)
+    # (Written as positive comparisons so nan fails them.)
+    if not (seconds >= 0 and 0 <= interval_ms <= PROFZ_MAX_SECONDS * 1000):
+        return Response('invalid seconds or interval_ms', 400)
+    interval = max(interval_ms, PROFZ_MIN_INTERVAL_MS) / 1000.0
+    if not PROFZ_LOCK.acquire(False): return Response('another profile is already running', 409)
     try:
-        import psutil
-        extra_dict['sys-boott'] = psutil.boot_time()
-        extra_dict['sys-cpu1s'] = psutil.cpu_percent(interval=1)
-        extra_dict['sys-cpu#'] =  psutil.cpu_count()
-        extra_dict['sys-cput'] =  psutil.cpu_times()
-        extra_dict['sys-disk/'] = psutil.disk_usage('/')
-        extra_dict['sys-fans'] =  psutil.sensors_fans()
-        extra_dict['sys-net/'] =  psutil.net_io_counters()
-        extra_dict['sys-pid-rss'] =  psutil.Process(os.getpid()).memory_info().rss / 1024 ** 2
-        extra_dict['sys-swap'] =  psutil.swap_memory()
-        extra_dict['sys-vmem'] =  psutil.virtual_memory()
-    except Exception as e:
-        extra_dict['sys-stats-error'] = str(e)
+        V.bump('web-profz-runs')
+        counts = sample_stacks(seconds, interval, request.get_params.get('idle') == '1')
+    finally:
+        PROFZ_LOCK.release()
+    lines = ['%s %d' % (stack, n) for stack, n in sorted(counts.items(), key=lambda i: -i[1])]
+    return Response('\n'.join(lines) + '\n', msg_type='text/plain')
+
+
+# ---------- system stats for /varz
+
+class StatsSampler:
+    '''Background thread that samples psutil system stats every interval seconds.
+
+       Sampling used to happen inline in the /varz handler, where
+       psutil.cpu_percent(interval=1) blocked each request for a full second.
+       Now handlers just read the latest snapshot.  Numeric stats are also
+       published with varz.set(), so they show up in Prometheus /metrics.
+       A ring buffer of recent cpu samples provides 1m and 5m averages.'''
+
+    def __init__(self, interval=10):
+        self.interval = interval
+        self.cpu_samples = collections.deque(maxlen=int(300 / interval) + 1)  # (time, cpu%); covers 5m.
+        self.snapshot = {}
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self.sample()
+        self._thread = threading.Thread(target=self._run, name='k_webserver_stats')
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+
+    def cpu_average(self, seconds):
+        cutoff = time.time() - seconds
+        recent = [cpu for t, cpu in list(self.cpu_samples) if t >= cutoff]
+        return round(sum(recent) / len(recent), 1) if recent else None
+
+    def sample(self):
+        snapshot = {}
+        try:
+            import psutil
+            cpu = psutil.cpu_percent(interval=None)   # non-blocking: usage since the previous call.
+            self.cpu_samples.append((time.time(), cpu))
+            numeric = {
+                'sys-boott':   psutil.boot_time(),
+                'sys-cpu':     cpu,
+                'sys-cpu-1m':  self.cpu_average(60),
+                'sys-cpu-5m':  self.cpu_average(300),
+                'sys-cpu#':    psutil.cpu_count(),
+                'sys-pid-rss': psutil.Process(os.getpid()).memory_info().rss / 1024 ** 2,
+            }
+            for k, v in numeric.items(): V.set(k, v)
+            snapshot.update(numeric)
+            snapshot['sys-cput'] =  psutil.cpu_times()
+            snapshot['sys-disk/'] = psutil.disk_usage('/')
+            snapshot['sys-fans'] =  psutil.sensors_fans() if hasattr(psutil, 'sensors_fans') else None
+            snapshot['sys-net/'] =  psutil.net_io_counters()
+            snapshot['sys-swap'] =  psutil.swap_memory()
+            snapshot['sys-vmem'] =  psutil.virtual_memory()
+        except Exception as e:
+            snapshot['sys-stats-error'] = str(e)
+        snapshot['sys-stats-time'] = int(time.time())
+        self.snapshot = snapshot     # Replace (rather than update) so readers never see a partial snapshot.
+        return snapshot
+
+    def _run(self):
+        while not self._stop.wait(self.interval): self.sample()
+
+
+STATS_SAMPLER = None    # Singleton; started by WebServer.start() if /varz is enabled.
+
+def start_stats_sampler(interval=10):
+    global STATS_SAMPLER
+    if not STATS_SAMPLER: STATS_SAMPLER = StatsSampler(interval).start()
+    return STATS_SAMPLER
+
+
+def ws_varz_handler(request):
+    if STATS_SAMPLER: extra_dict = STATS_SAMPLER.snapshot
+    else: extra_dict = StatsSampler().sample()   # No background sampler; take a single (non-blocking) sample.
     return varz_handler(request, extra_dict)
@@ -50,23 +50,30 @@ Supported standard handlers:
   indication of the health of your service.
 
 - /logz: integrated with the kcore.common logging system, provieds a web
-  interface to review the most recent log messages.  WARNING- by default this
+  interface to review the most recent log messages; supports ?level=, ?q=
+  (substring) and ?offset=/limit= paging.  WARNING- by default this
   method does not have any access control, so DO NOT PUT SENSITIVE INFORMATION
   INTO YOUR LOGS (which is good practice anyway).
 
+- /profz: (webserver.py only, and only if WebServer(profz=True)) runs a
+  sampling profiler across all threads for ?seconds=N, and returns the stacks
+  in flame-graph-ready "collapsed" text format.  Same lack of access control
+  as the others, which is why it's opt-in.
+
 - /varz: integrated with the kcore.varz system, will show the current value of
   all 'varz' that have been set.  The web-server keeps some internal stats
   using varz, but this will be much more valuable if you "import kcore.varz"
   into your code, and set various counters and status-indicators to reflect
   the internal state of your service.  Great for debugging.  WARNING- again,
   no access control by default, so DO NOT PUT SENSITIVE INFORMATION IN VARZ.
+  Pollers can use /varz?since=<generation> to get JSON of just the changes.
 
 
 TODO: add support for basic auth (with db file compatible with htpasswd...?)
 
 '''
 
-import re, os, sys
+import json, re, os, sys, time
 import kcore.common0 as C
 import kcore.html as H
 import kcore.varz as V
@@ -75,7 +82,8 @@ import kcore.varz as V
 CIRCUITPYTHON = 'boot_out.txt' in os.listdir('/')
 PY_VER = sys.version_info[0]
 
-if not CIRCUITPYTHON:   # urllib not currently available in circuitpy
+if not CIRCUITPYTHON:   # urllib, threading, and zlib compression not currently available in circuitpy
+    import threading, zlib
     if PY_VER == 2: import urllib
     else: import urllib.parse
 
@@ -105,9 +113,19 @@ class Request:
 # .exception: If processing generates an exception, a handler may populate
 # this to communicate up the stack (eventually causing a status 500 reply).
 # If the web-server has wrap_handlers turned on, it does this for you.
+#
+# body may also be an iterator/generator (yielding strings, or bytes if
+# binary=True) or a file object.  These are kept in .stream (with .body left
+# empty), and are sent incrementally (chunked or via sendfile) by servers that
+# support it, so large outputs needn't be built in memory.  msg_type can't be
+# sniffed from a stream, so pass it explicitly if 'text' isn't right.
 class Response:
     def __init__(self, body, status_code=200, extra_headers={}, msg_type=None, exception=None, status_msg=None, binary=False):
-        if binary: self.body = body
+        self.stream = None
+        if _is_stream(body):
+            self.stream = body
+            self.body = b'' if binary else ''
+        elif binary: self.body = body
         else: self.body = str(body) if body else ''
         self.status_code = status_code
         self.ok = (status_code == 200)
@@ -115,6 +133,8 @@ class Response:
         self.extra_headers = extra_headers
         if msg_type:
             self.msg_type = msg_type
+        elif self.stream is not None:
+            self.msg_type = 'text'
         else:
             if self.body:
                 self.msg_type = msg_type or ('text/html' if self.body.startswith('<') else 'text')
@@ -125,14 +145,168 @@ class Response:
 
     def __str__(self): return '[%d] %s' % (self.status_code, self.exception or self.body[:70].replace('\n', '\\n'))
 
+    # For servers (or tests) that can't stream: drain .stream into .body.
+    def materialize(self):
+        if self.stream is None: return self
+        if hasattr(self.stream, 'read'):
+            self.body = self.stream.read()
+            if hasattr(self.stream, 'close'): self.stream.close()
+        else:
+            self.body = (b'' if self.binary else '').join(self.stream)
+        self.stream = None
+        return self
+
+
+def _is_stream(body):
+    if isinstance(body, (str, bytes, bytearray)): return False
+    return hasattr(body, 'read') or hasattr(body, '__next__')
+
 
 # Internal use class for tracking handlers.
+# Note: instances are shared between threads, so must not hold per-request state.
 class _HandlerData:
-    def __init__(self, regex, func):
+    def __init__(self, regex, func, cache=None, label=None):
         self.regex = regex
         self.compiled_regex = re.compile(regex)
         self.func = func
-        self.match_groups = None   # Populated once match is made.
+        self.label = label or (regex[1:-1] if regex.startswith('^') and regex.endswith('$') else regex)  # for varz.
+        self.cache = cache       # _ResponseCache or None
+        # Literal routes can be looked up by dict, and the literal prefix of a
+        # dynamic route lets the router skip regexs that can't possibly match.
+        self.literal_path = _literal_path(regex)
+        self.literal_prefix = self.literal_path or _literal_prefix(regex)
+
+
+_REGEX_SPECIAL_CHARS = '.^$*+?{}[]\\|()'
+
+def _literal_prefix(regex):
+    if '|' in regex: return ''     # alternation; no safe common prefix.
+    if regex.startswith('^'): regex = regex[1:]
+    for i, ch in enumerate(regex):
+        if ch in '*?{': return regex[:max(i - 1, 0)]   # quantifier applies to the previous char.
+        if ch in _REGEX_SPECIAL_CHARS: return regex[:i]
+    return regex
+
+# Returns the exact path matched by regex, or None if regex is dynamic.
+def _literal_path(regex):
+    if not regex.startswith('^') or not regex.endswith('$'): return None
+    inner = regex[1:-1]
+    for ch in inner:
+        if ch in _REGEX_SPECIAL_CHARS: return None
+    return inner
+
+
+# Internal use class: per-route cache of handler outputs, keyed by full_path.
+# Entries expire after ttl seconds, and the least recently used entry is
+# evicted once there are max_entries.  Concurrent misses for the same key are
+# coalesced: the first caller computes, and the others wait for its answer.
+# Only successful answers (plain strings or status 200 Responses) are cached.
+class _ResponseCache:
+    def __init__(self, ttl, max_entries=64):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.entries = {}        # key -> (expiry time, answer); dict order is LRU order.
+        self.inflight = {}       # key -> _Inflight
+        self.lock = threading.Lock() if not CIRCUITPYTHON else None
+
+    def get(self, key, func, request):
+        if not self.lock: return self._get_unlocked(key, func, request)
+        with self.lock:
+            answer = self._lookup(key)
+            if answer is not None: return answer
+            inflight = self.inflight.get(key)
+            owner = not inflight
+            if owner: inflight = self.inflight[key] = _Inflight()
+        if not owner:
+            # Someone else is computing this key; share their answer (or exception),
+            # even if it's not cacheable.  Streams can only be sent once though.
+            inflight.done.wait()
+            if inflight.exception: raise inflight.exception
+            answer = inflight.answer
+            if _is_stream(answer) or (isinstance(answer, Response) and answer.stream is not None): return func(request)
+            V.bump('web-cache-shared')
+            return answer
+        V.bump('web-cache-miss')
+        try:
+            answer = inflight.answer = func(request)
+            with self.lock: self._store(key, answer)
+            return answer
+        except Exception as e:
+            inflight.exception = e
+            raise
+        finally:
+            with self.lock: self.inflight.pop(key, None)
+            inflight.done.set()
+
+    def clear(self):
+        if self.lock: self.lock.acquire()
+        self.entries = {}
+        if self.lock: self.lock.release()
+
+    # ---------- internals
+
+    def _get_unlocked(self, key, func, request):
+        answer = self._lookup(key)
+        if answer is not None: return answer
+        V.bump('web-cache-miss')
+        answer = func(request)
+        self._store(key, answer)
+        return answer
+
+    def _lookup(self, key):
+        entry = self.entries.pop(key, None)
+        if entry and entry[0] > time.monotonic():
+            self.entries[key] = entry    # Re-insert to mark as most recently used.
+            V.bump('web-cache-hit')
+            return entry[1]
+        return None
+
+    def _store(self, key, answer):
+        if answer is None or _is_stream(answer): return
+        if isinstance(answer, Response) and (answer.status_code != 200 or answer.exception or answer.stream is not None): return
+        while self.entries and len(self.entries) >= self.max_entries:
+            self.entries.pop(next(iter(self.entries)))
+        self.entries[key] = (time.monotonic() + self.ttl, answer)
+
+
+# A computation in progress for _ResponseCache, whose outcome other requests for the same key wait for.
+class _Inflight:
+    def __init__(self):
+        self.done = threading.Event()
+        self.answer = None
+        self.exception = None
+
+
+# Internal use class: small LRU of compressed bodies, so that repeatedly served
+# content (static files, cached handler output) is only compressed once.
+# Bodies larger than max_body_size are compressed but not cached.
+class _CompressCache:
+    def __init__(self, max_entries=16, max_body_size=1024 * 1024, level=6):
+        self.max_entries = max_entries
+        self.max_body_size = max_body_size
+        self.level = level
+        self.entries = {}     # (encoding, body) -> compressed bytes; dict order is LRU order.
+        self.lock = threading.Lock()
+
+    def compress(self, body, encoding):
+        key = (encoding, body)
+        cacheable = len(body) <= self.max_body_size
+        if cacheable:
+            with self.lock:
+                compressed = self.entries.pop(key, None)
+                if compressed is not None:
+                    self.entries[key] = compressed
+                    return compressed
+        data = body if isinstance(body, bytes) else body.encode('utf-8')
+        # wbits: 16+ => gzip wrapper, plain => zlib wrapper (which is what HTTP calls "deflate").
+        c = zlib.compressobj(self.level, zlib.DEFLATED, 16 + zlib.MAX_WBITS if encoding == 'gzip' else zlib.MAX_WBITS)
+        compressed = c.compress(data) + c.flush()
+        if cacheable:
+            with self.lock:
+                while self.entries and len(self.entries) >= self.max_entries:
+                    self.entries.pop(next(iter(self.entries)))
+                self.entries[key] = compressed
+        return compressed
 
 
 # WebServerBase expects an instance of this as logging_adapter.
@@ -160,16 +334,34 @@ class WebServerBase:
     # off via use_standard_handlers=False in the constructor, or add a handler
     # with the route ".*".
 
+    # Note: if varz is enabled, each route gets a latency Histogram varz named
+    # "web-latency-{route}", windowed Rate varz "web-qps" and "web-error-rate"
+    # (5xx responses) are kept, and requests taking at least slow_request_ms are
+    # logged (None to disable).
+    #
+    # Note: text-ish responses of at least compress_min_size bytes are gzip or
+    # deflate compressed if the client's Accept-Encoding allows.  Pass
+    # compress_min_size=None to turn this off.
+
     def __init__(self, handlers={}, port=None, context={},
                  wrap_handlers=True, use_standard_handlers=True,
                  varz=True, varz_path_trim=14,
                  logging_adapter=None, logging_filters=['favicon.ico'],
-                 flagz_args=None):
+                 flagz_args=None, compress_min_size=1024, slow_request_ms=2000):
         self.routes = []
+        # (literal, dynamic): literal maps path -> (index into self.routes, _HandlerData),
+        # dynamic is a list of (index into self.routes, _HandlerData).
+        self._route_index = ({}, [])
         self.default_handler = None
         self.add_handlers(handlers)
+        self.compress_min_size = compress_min_size if not CIRCUITPYTHON else None
+        self._compress_cache = _CompressCache() if self.compress_min_size else None
         self.context = context
         self.flagz_args = flagz_args
+        self.inflight = 0
+        self.inflight_max = 0
+        self._inflight_lock = threading.Lock() if not CIRCUITPYTHON else None
+        self.slow_request_ms = slow_request_ms
         self.logger = logging_adapter
         self.logging_filters = logging_filters
         self.port = port
@@ -182,7 +374,7 @@ class WebServerBase:
                 '/favicon.ico':  lambda _: '',
                 '/flagz':        self._flagz_handler,
                 '/healthz':      lambda _: 'ok',
-                '/logz':         lambda _: self.logger.get_logz_html(),
+                '/logz':         self._logz_handler,
                 '/varz':         varz_handler,
             }
         else: self.standard_handlers = {}
@@ -210,18 +402,25 @@ class WebServerBase:
         if not route_regex.startswith('^/'): route_regex = '^/' + route_regex[1:]
         return route_regex
 
-    def add_handler(self, route_regex, func, fixup_regex=True):
+    def add_handler(self, route_regex, func, fixup_regex=True, cache_ttl=None, cache_max_entries=64):
+        '''cache_ttl (seconds) turns on response caching for this route.  Cached
+           answers are keyed by full path (including GET params), and are never
+           used for POSTs.  Only use for handlers whose output doesn't depend on
+           anything else about the request (e.g. headers or authentication).'''
         if not route_regex:
             self.default_handler = func
             return
         if fixup_regex: route_regex = WebServerBase._finalize_regex(route_regex)
-        self.routes.append(_HandlerData(route_regex, func))
+        cache = _ResponseCache(cache_ttl, cache_max_entries) if cache_ttl else None
+        self.routes.append(_HandlerData(route_regex, func, cache))
+        self._index_routes()
 
     def del_handler(self, route_regex):
         fixed_regex = WebServerBase._finalize_regex(route_regex)
         for i, r in enumerate(self.routes):
             if r.regex == fixed_regex:
                 self.routes.pop(i)
+                self._index_routes()
                 return True
         return False
 
@@ -236,13 +435,14 @@ class WebServerBase:
 
         # varz
         if self.varz:
+            V.rate('web-qps')
             V.bump('web-method-%s' % request.method)
             if self.varz_path_trim:
                 trimmed_path = request.path[1:(self.varz_path_trim + 1)]
                 V.bump('web-path-%s' % trimmed_path)
 
         # Find a matching handler.
-        handler_data = self._find_handler(request.path)
+        handler_data, match_groups = self._route(request.path)
         if not handler_data:
             if self.logger and self.logger.log_404:
                 self.logger.log_404('No handler found for: %s' % request.path)
@@ -251,59 +451,175 @@ class WebServerBase:
 
         # Finalize request instance contents.
         request.context = self.context
-        request.route_match_groups = handler_data.match_groups
+        request.route_match_groups = match_groups
 
-        # And call the handler.
-        if self.wrap_handlers:
-            try:
-                answer = handler_data.func(request)
-            except Exception as e:
-                import traceback
-                if self.logger and self.logger.log_exceptions:
-                    self.logger.log_exceptions('handler exception. path=%s, error=%s, details: %s' % (request.path, e, traceback.format_exc()))
-                if self.varz: V.bump('web-handler-exception')
-                return Response(None, -1, exception=e)
+        # And call the handler, tracking latency and in-flight counts.
+        if not self.varz and not self.slow_request_ms:
+            answer = self._call_handler(handler_data, request)
         else:
-            answer = handler_data.func(request)
-
-        if not isinstance(answer, Response): answer = Response(str(answer))
-        if self.varz: V.bump('web-status-%d' % answer.status_code)
+            start = time.monotonic()
+            self._inflight_change(1)
+            try:
+                answer = self._call_handler(handler_data, request)
+            finally:
+                self._inflight_change(-1)
+                elapsed_ms = (time.monotonic() - start) * 1000
+                if self.varz: V.observe('web-latency-%s' % handler_data.label, elapsed_ms)
+                if self.slow_request_ms and elapsed_ms >= self.slow_request_ms:
+                    if self.varz: V.bump('web-slow-requests')
+                    if self.logger and self.logger.log_general:
+                        self.logger.log_general('slow request: %s %s took %d ms' % (request.method, request.path, elapsed_ms))
+
+        if not isinstance(answer, Response): answer = Response(answer if _is_stream(answer) else str(answer))
+        if self.varz:
+            V.bump('web-status-%d' % answer.status_code)
+            if answer.status_code >= 500: V.rate('web-error-rate')
+        if self.compress_min_size: answer = self._maybe_compress(request, answer)
         return answer
 
     # Takes a path rather than a pre-built request.  Useful for testing.
-    def test_handler(self, path, method='test'):
-        return self.find_and_run_handler(Request(method, path))
+    def test_handler(self, path, method='test', headers={}):
+        return self.find_and_run_handler(Request(method, path, headers=headers))
 
 
     # ---------- Internals
 
+    # /logz?level=WARNING&q=substring&offset=0&limit=200
+    def _logz_handler(self, request):
+        if not self.logger: return Response('no logz data available', 503)
+        params = request.get_params
+        level = params.get('level')
+        if level and C.getLevelNumber(level.upper()) is None: return Response('invalid level', 400)
+        try:
+            offset = int(params.get('offset') or 0)
+            limit = int(params.get('limit') or LOGZ_PAGE_SIZE)
+        except ValueError:
+            return Response('invalid offset or limit', 400)
+        if offset < 0 or limit <= 0: return Response('invalid offset or limit', 400)
+        query = {'level': level, 'q': params.get('q')}
+        try:
+            out = self.logger.get_logz_html(level=level, substring=query['q'], offset=offset, limit=limit)
+        except TypeError:
+            return self.logger.get_logz_html()     # An adapter that doesn't support filtering or paging.
+        if not C.log_records(level=level, substring=query['q'], offset=offset + limit, limit=1): return out
+        query = {k: v for k, v in query.items() if v}
+        query['limit'] = limit
+        query['offset'] = offset + limit
+        return out + '<p><a href="/logz?%s">older</a>' % html_escape(C.urlencode(query))
+
     def _flagz_handler(self, request):
         if isinstance(self.flagz_args, dict): d= self.flagz_args
         elif self.flagz_args: d= vars(self.flagz_args)
         else: return Response('no flagz data available', 503)  # 503 => "service unavailable"
         return H.dict_to_page(d, 'flagz')
 
+    # Call the handler (or its cache).  Returns whatever it returns, or an
+    # exception Response if wrap_handlers is set.
+    def _call_handler(self, handler_data, request):
+        func = handler_data.func
+        if handler_data.cache and request.method != 'POST':
+            func = lambda req: handler_data.cache.get(req.full_path, handler_data.func, req)
+        if not self.wrap_handlers: return func(request)
+        try:
+            return func(request)
+        except Exception as e:
+            import traceback
+            if self.logger and self.logger.log_exceptions:
+                self.logger.log_exceptions('handler exception. path=%s, error=%s, details: %s' % (request.path, e, traceback.format_exc()))
+            if self.varz: V.bump('web-handler-exception')
+            return Response(None, -1, exception=e)
+
+    def _inflight_change(self, delta):
+        if self._inflight_lock: self._inflight_lock.acquire()
+        self.inflight += delta
+        if self.inflight > self.inflight_max: self.inflight_max = self.inflight
+        if self._inflight_lock: self._inflight_lock.release()
+        if self.varz:
+            V.set('web-inflight', self.inflight)
+            V.set('web-inflight-max', self.inflight_max)
+
+    # Returns answer, or a compressed copy of it if the client accepts that and
+    # it's worth doing.  Never modifies answer, which may be a shared cached instance.
+    def _maybe_compress(self, request, answer):
+        if answer.stream is not None or answer.status_code != 200: return answer
+        if len(answer.body) < self.compress_min_size: return answer
+        if not answer.msg_type.startswith(COMPRESSIBLE_TYPES): return answer
+        if 'Content-Encoding' in answer.extra_headers: return answer
+        headers = dict(answer.extra_headers)
+        vary = headers.get('Vary')              # on the identity version too, so caches keep them apart.
+        if not vary: headers['Vary'] = 'Accept-Encoding'
+        elif 'accept-encoding' not in vary.lower(): headers['Vary'] = vary + ', Accept-Encoding'
+        encoding = choose_encoding(request.headers.get('Accept-Encoding') or request.headers.get('accept-encoding'))
+        if not encoding:
+            out = Response(answer.body, answer.status_code, headers, answer.msg_type, binary=answer.binary)
+            out.status_msg = answer.status_msg
+            return out
+        compressed = self._compress_cache.compress(answer.body, encoding)
+        if self.varz:
+            V.bump('web-compressed-%s' % encoding)
+            V.inc('web-compressed-bytes-saved', len(answer.body) - len(compressed))
+        headers['Content-Encoding'] = encoding
+        if 'ETag' in headers: headers['ETag'] = encoded_etag(headers['ETag'], encoding)
+        return Response(compressed, answer.status_code, headers, answer.msg_type, binary=True)
+
     # returns _HandlerData or None
     def _find_handler(self, path):
-        for r in self.routes:
+        return self._route(path)[0]
+
+    # returns (_HandlerData, match_groups) or (None, None).
+    # Routes keep their registration-order precedence: a literal route only
+    # wins if no dynamic route registered before it also matches.
+    def _route(self, path):
+        literal_routes, dynamic_routes = self._route_index
+        literal = literal_routes.get(path)
+        for i, r in dynamic_routes:
+            if literal and i >= literal[0]: break
+            if not path.startswith(r.literal_prefix): continue
             my_match = r.compiled_regex.match(path)
             if False:  # turn on for debugging...
                 sys.stderr.write('ROUTER DEBUG: path %s comp to %s => %s\n' % (path, r.compiled_regex, my_match))
-            if my_match:
-                r.match_groups = my_match.groups()
-                return r
+            if my_match: return r, my_match.groups()
+        if literal: return literal[1], ()
         # Check for a standard handler match.
         stnd = self.standard_handlers.get(path)
-        if stnd: return _HandlerData(path, stnd)
+        if stnd: return _HandlerData('', stnd, label=path), None
         # Check for a default handler.
-        if self.default_handler: return _HandlerData(path, self.default_handler)
+        if self.default_handler: return _HandlerData('', self.default_handler, label='default'), None
         # No handler found.
-        return None
+        return None, None
+
+    # Rebuild the routing indices; called whenever self.routes changes.
+    # The new index is swapped in whole, so requests being routed concurrently
+    # never see it part-built.
+    def _index_routes(self):
+        literal_routes = {}
+        dynamic_routes = []
+        for i, r in enumerate(self.routes):
+            if r.literal_path is None: dynamic_routes.append((i, r))
+            elif r.literal_path not in literal_routes: literal_routes[r.literal_path] = (i, r)
+        self._route_index = (literal_routes, dynamic_routes)
 
 
 # ---------- Other helper functions
 
+def html_escape(s):
+    return s.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;').replace('"', '&quot;').replace("'", '&#x27;')
+
+
+# Number of log lines /logz shows per page by default.
+LOGZ_PAGE_SIZE = 200
+
+# Long-polls of /varz?since=...&wait=... are capped at this many seconds.
+VARZ_MAX_WAIT = 60
+
+# /varz?since=<generation> returns JSON {"generation": n, "changes": {...}}
+# with just the keys changed after that generation (0 gets everything).  Add
+# &wait=<seconds> to block until something changes, and &prefix=<str> to
+# only consider keys starting with that prefix.  The web server's own web-*
+# varz change on every request (including the poll itself), so changes to
+# them are reported but don't end a wait, unless prefix asks for them.
 def varz_handler(request, extra_dict=None):
+    if 'since' in request.get_params: return _varz_changes(request)
     varz = dict(V.get_dict())
     if extra_dict: varz.update(extra_dict)
     if '?' in request.full_path:
@@ -312,6 +628,51 @@ def varz_handler(request, extra_dict=None):
     return H.dict_to_page(varz, 'varz')
 
 
+def _varz_changes(request):
+    params = request.get_params
+    try:
+        since = int(params.get('since') or 0)
+        wait = float(params.get('wait') or 0)
+    except ValueError:
+        return Response('invalid since or wait parameter', 400)
+    if not wait >= 0: return Response('invalid wait parameter', 400)    # (also catches nan)
+    wait = min(wait, VARZ_MAX_WAIT) if not CIRCUITPYTHON else 0
+    # Every request (including this poll) changes web-* varz, so unless they're
+    # asked for via prefix, don't let them end a long-poll.
+    prefix = params.get('prefix')
+    ignore = None if prefix and prefix.startswith('web-') else 'web-'
+    gen, changes = V.changes_since(since, timeout=wait, prefix=prefix, ignore_prefix=ignore)
+    return Response(json.dumps({'generation': gen, 'changes': changes}), msg_type='application/json')
+
+
+# Response types worth compressing (prefix match against msg_type).
+COMPRESSIBLE_TYPES = ('text', 'application/json', 'application/javascript', 'application/xml', 'image/svg')
+
+# in: an Accept-Encoding header value, out: 'gzip', 'deflate', or None.
+# Each encoding of a response is a different representation, so gets its own
+# ETag: '"abc"' -> '"abc-gzip"' (or 'W/"abc"' -> 'W/"abc-gzip"').
+def encoded_etag(etag, encoding):
+    if not etag.endswith('"'): return etag + '-' + encoding
+    return etag[:-1] + '-' + encoding + '"'
+
+
+def choose_encoding(accept_encoding):
+    if not accept_encoding: return None
+    accepted = {}
+    for item in accept_encoding.split(','):
+        parts = item.strip().split(';')
+        q = 1.0
+        for p in parts[1:]:
+            p = p.strip()
+            if p.startswith('q='):
+                try: q = float(p[2:])
+                except ValueError: q = 0
+        accepted[parts[0].strip().lower()] = q
+    for encoding in ['gzip', 'deflate']:
+        if accepted.get(encoding, accepted.get('*', 0)) > 0: return encoding
+    return None
+
+
 # in: full url with get params, out: dict of get params.
 def parse_get_params(full_path):
     if '?' not in full_path: return {}
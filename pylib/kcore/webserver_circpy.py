@@ -153,6 +153,7 @@ class WebServer(WebServerBase):
         return request
 
     def _send_response(self, client, response):
+        if response.stream is not None: response.materialize()   # no chunked/sendfile support here.
         headers = response.extra_headers.copy()
         headers["Server"] = "kds_webserver_circpy"
         headers["Connection"] = "close"
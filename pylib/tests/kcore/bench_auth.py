@@ -0,0 +1,68 @@
+#!/usr/bin/python3
+'''Measure kcore.auth token verification throughput, overall and per stage.
+
+Not a test (pytest doesn't collect it); run directly:
+  ./bench_auth.py [--clients N] [--tokens N]
+
+Registers --clients shared secrets in an in-memory registration db, then
+verifies --tokens tokens spread across them, one at a time and as a batch.
+'''
+
+import context_kcore   # fixup Python include path
+
+import argparse, os, sys, time
+
+import kcore.auth as A
+
+
+def timed(label, count, func):
+    start = time.perf_counter()
+    func()
+    secs = time.perf_counter() - start
+    print(f'{label:22s} {count / secs:10.0f}/s  {secs * 1e6 / count:8.2f} us each')
+
+
+def main(argv=[]):
+    ap = argparse.ArgumentParser(description='kcore.auth verification benchmark')
+    ap.add_argument('--clients', '-c', type=int, default=50, help='number of registered clients')
+    ap.add_argument('--tokens', '-t', type=int, default=20000, help='number of tokens to verify')
+    args = ap.parse_args(argv)
+
+    os.environ['PUID'] = 'bench-puid'
+    db_passwd = 'bench'
+    for i in range(args.clients):
+        sec = A.generate_shared_secret(f'user{i}', 'pass')
+        sec.server_override_hostname = '*'
+        A.register(sec, db_passwd=db_passwd, db_filename=None)
+
+    use_time = A.now()
+    requests = []
+    for i in range(args.tokens):
+        user = f'user{i % args.clients}'
+        requests.append((A.generate_token(f'cmd{i}', user, 'pass', override_time=use_time), f'cmd{i}', '127.0.0.1'))
+    n = len(requests)
+    reg = A.get_registration_index(db_passwd, None)
+    fields = [A.parse_token(token) for token, _, _ in requests]
+    secrets = [A.lookup_shared_secret(reg, f[1], addr, f[2]) for f, (_, _, addr) in zip(fields, requests)]
+    print(f'{args.clients} clients, {n} tokens')
+
+    print('-- stages')
+    timed('db index', n, lambda: [A.get_registration_index(db_passwd, None) for i in range(n)])
+    timed('parse', n, lambda: [A.parse_token(token) for token, _, _ in requests])
+    timed('lookup', n, lambda: [A.lookup_shared_secret(reg, f[1], '127.0.0.1', f[2]) for f in fields])
+    timed('render secret', n, lambda: [A.render_shared_secret(s) for s in secrets])
+    timed('hash', n, lambda: [A.generate_token_given_shared_secret_str(
+        'cmd', 'secret-str', use_hostname='host', username='user', override_time=use_time) for i in range(n)])
+
+    print('-- end to end')
+    A.LAST_RECEIVED_TIMES.clear()
+    timed('verify_token', n, lambda: [A.verify_token(token, cmd, addr, db_passwd, db_filename=None)
+                                      for token, cmd, addr in requests])
+    A.LAST_RECEIVED_TIMES.clear()
+    rslts = []
+    timed('verify_tokens_batch', n, lambda: rslts.extend(A.verify_tokens_batch(requests, db_passwd, db_filename=None)))
+    assert all(r.ok for r in rslts)
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
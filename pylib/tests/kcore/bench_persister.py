@@ -0,0 +1,56 @@
+#!/usr/bin/python3
+'''Compare load and save throughput of the Persister serialization formats.
+
+Not a test (pytest doesn't collect it); run directly:
+  ./bench_persister.py [--entries N] [--reps N]
+
+Uses a DictOfDataclasses shaped like homesec's TOUCH_DATA.
+'''
+
+import context_kcore   # fixup Python include path
+
+import argparse, os, sys, tempfile, time
+from dataclasses import dataclass
+
+import kcore.persister as P
+
+
+@dataclass
+class TouchData:
+    trigger: str
+    last_update: int
+    value: str = None
+
+
+def bench(label, serializer, entries, reps, dirname):
+    filename = os.path.join(dirname, label)
+    p = P.PersisterDictOfDC(filename, TouchData, serializer=serializer)
+    data = {f'trigger{i}': TouchData(f'trigger{i}', 1700000000 + i, 'home' if i % 2 else None) for i in range(entries)}
+
+    start = time.perf_counter()
+    for i in range(reps): p.set_data(data)
+    save_secs = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for i in range(reps): p.load_from_file()
+    load_secs = time.perf_counter() - start
+
+    assert p.cache == data
+    size = os.path.getsize(filename)
+    print(f'{label:6s}  save: {reps / save_secs:8.1f}/s   load: {reps / load_secs:8.1f}/s   size: {size} bytes')
+
+
+def main(argv=[]):
+    ap = argparse.ArgumentParser(description='Persister serializer benchmark')
+    ap.add_argument('--entries', '-e', type=int, default=200, help='number of dataclass entries in the dict')
+    ap.add_argument('--reps', '-r', type=int, default=200, help='number of saves and loads to time')
+    args = ap.parse_args(argv)
+
+    print(f'{args.entries} entries, {args.reps} reps')
+    with tempfile.TemporaryDirectory() as dirname:
+        bench('eval', None, args.entries, args.reps, dirname)
+        bench('json', P.JSON, args.entries, args.reps, dirname)
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
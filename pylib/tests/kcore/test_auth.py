@@ -124,3 +124,75 @@ def test_cli():
     assert 'verified? True' in out
 
     os.unlink(A.DEFAULT_DB_FILENAME)
+
+
+def test_registration_index():
+    sec = A.generate_shared_secret('idxuser', 'idxpass')
+    sec.server_override_hostname = 'otherhost'
+    A.register(sec, db_passwd='dbpw', db_filename=None)
+
+    index = A.get_registration_index('dbpw', None)
+    assert 'otherhost:idxuser' in index
+    assert A.get_registration_index('dbpw', None) is index   # unchanged db -> same snapshot
+
+    assert A.get_shared_secret_from_db('dbpw', None, token_hostname='otherhost', username='idxuser') == sec
+    assert A.get_shared_secret_from_db('dbpw', None, token_hostname='nope', client_addr='otherhost', username='idxuser') == sec
+    assert A.get_shared_secret_from_db('dbpw', None, token_hostname='nope', client_addr='nope', username='idxuser') is None
+
+    # A new registration must be visible to the next lookup.
+    sec2 = A.generate_shared_secret('idxuser2', 'idxpass')
+    sec2.server_override_hostname = '*'
+    A.register(sec2, db_passwd='dbpw', db_filename=None)
+    assert A.get_shared_secret_from_db('dbpw', None, token_hostname='anyhost', username='idxuser2') == sec2
+
+
+def test_dns_cache(monkeypatch):
+    lookups = []
+    def fake_gethostbyname(host):
+        lookups.append(host)
+        if host == 'bad': raise socket.gaierror('nope')
+        return '10.0.0.1'
+    monkeypatch.setattr(socket, 'gethostbyname', fake_gethostbyname)
+    A.DNS_CACHE.clear()
+
+    assert A.compare_hosts('hosta', '10.0.0.1')
+    assert A.compare_hosts('hosta', 'hostb')
+    assert A.compare_hosts('hosta', '10.0.0.1')
+    assert lookups == ['hosta', 'hostb']
+
+    assert not A.compare_hosts('bad', '10.0.0.1')
+    assert not A.compare_hosts('', '10.0.0.1')
+    assert lookups.count('bad') == 1
+
+    # Expired entries are resolved again.
+    A.DNS_CACHE['hosta'] = (time.time() - 1, '10.0.0.1')
+    assert A.compare_hosts('hosta', '10.0.0.1')
+    assert lookups.count('hosta') == 2
+    A.DNS_CACHE.clear()
+
+
+def test_verify_tokens_batch():
+    sec = A.generate_shared_secret('batchuser', 'batchpass')
+    sec.server_override_hostname = '*'
+    A.register(sec, db_passwd='dbpw', db_filename=None)
+
+    use_time = int(time.time())
+    tokens = [A.generate_token(f'cmd{i}', 'batchuser', 'batchpass', override_time=use_time) for i in range(3)]
+    requests = [(t, f'cmd{i}', 'somehost') for i, t in enumerate(tokens)]
+    requests.append((tokens[0], 'wrong-cmd', 'somehost'))
+    requests.append(('v2:bogus', 'cmd0', 'somehost'))
+    requests.append((None, 'cmd0', 'somehost'))
+    requests.append((tokens[1], 'cmd1', 'somehost'))   # replay
+
+    rslts = A.verify_tokens_batch(requests, db_passwd='dbpw', db_filename=None)
+    assert [r.ok for r in rslts] == [True, True, True, False, False, False, False]
+    assert 'Token fails' in rslts[3].status
+    assert 'parse' in rslts[4].status
+    assert 'no authN' in rslts[5].status
+    assert 'not later' in rslts[6].status
+    assert rslts[0].username == 'batchuser'
+
+    # Single-token path agrees with the batch path.
+    token = A.generate_token('cmd9', 'batchuser', 'batchpass', override_time=use_time)
+    assert A.verify_token(token, 'cmd9', 'somehost', db_passwd='dbpw', db_filename=None).ok
+    assert not A.verify_token('garbage', 'cmd9', 'somehost', db_passwd='dbpw', db_filename=None).ok
@@ -108,6 +108,78 @@ def test_logging(tmp_path):
     assert C.last_logs() == 'log: TIME: ERROR: test4'
 
 
+def test_async_log_writer(tmp_path):
+    tempname = str(tmp_path / "async.log")
+    C.init_log(logfile=tempname, force_time='TIME', clear=True, async_write=True)
+    assert C.LOG_WRITER
+    C.log('line1')
+    C.log_warning('line2')
+    C.flush_log()
+    assert C.read_file(tempname) == 'INFO:log:TIME: line1\nWARNING:log:TIME: line2\n'
+
+    # Simulate logrotate; the writer should notice and start a new file.
+    os.rename(tempname, tempname + '.1')
+    C.log('line3')      # Rotation is noticed before this is written.
+    C.flush_log()
+    C.log('line4')
+    C.flush_log()
+    assert C.read_file(tempname + '.1') == 'INFO:log:TIME: line1\nWARNING:log:TIME: line2\n'
+    assert C.read_file(tempname) == 'INFO:log:TIME: line3\nINFO:log:TIME: line4\n'
+
+    writer = C.LOG_WRITER
+    C.clear_log()       # Clears the records, but leaves the writer running...
+    assert C.LOG_WRITER is writer
+    C.log('line4b')
+    C.log('line4c')
+    C.flush_log()
+    assert C.read_file(tempname) == 'INFO:log:TIME: line4b\nINFO:log:TIME: line4c\n'   # ... writing to a new file.
+
+    # A deleted logfile is noticed before the next batch is written.
+    os.unlink(tempname)
+    C.log('line4d')
+    C.flush_log()
+    assert C.read_file(tempname) == 'INFO:log:TIME: line4d\n'
+
+    C.stop_log_writer()
+    assert not C.LOG_WRITER
+    C.log('line5')      # Back to synchronous writes.
+    assert C.read_file(tempname).endswith('line5\n')
+
+    # The exit hook detaches the writer, so later lines aren't queued to a dead thread.
+    C.init_log(logfile=tempname, force_time='TIME', async_write=True)
+    C.LOG_WRITER._atexit()
+    assert not C.LOG_WRITER
+    C.log('line6')
+    assert C.read_file(tempname).endswith('line6\n')
+
+
+def test_lazy_log_formatting():
+    C.init_log('test', logfile=None, clear=True, filter_level_logfile=C.INFO,
+               filter_level_stderr=C.NEVER, filter_level_syslog=C.NEVER, force_time='TIME')
+    C.LOG_FILENAME = None           # init_log(logfile=None) keeps any earlier logfile.
+    assert C.is_enabled(C.INFO)
+    assert not C.is_enabled(C.DEBUG)
+
+    calls = []
+    def expensive():
+        calls.append(1)
+        return 'expensive'
+    C.log_debug(expensive)          # Filtered, so never rendered.
+    C.log_debug('x=%s', expensive)
+    assert calls == []
+
+    C.log_info('x=%s y=%d', 'a', 2)
+    C.log_warning(expensive)
+    assert calls == []              # Queue entries aren't rendered until viewed.
+    assert C.last_logs() == 'test: TIME: WARNING: expensive\ntest: TIME: INFO: x=a y=2'
+    assert C.last_logs() == 'test: TIME: WARNING: expensive\ntest: TIME: INFO: x=a y=2'
+    assert calls == [1]             # ... and are only rendered once.
+    assert C.LOG_QUEUE[0]._raw is None   # ... after which the args are released.
+
+    C.log_info('no placeholders', 3)
+    assert C.LOG_QUEUE[0].msg == 'no placeholders (3,)'
+
+
 def test_log_queue():
     C.init_log('test', logfile=None, log_queue_len=3, clear=True,
                filter_level_syslog=C.NEVER, force_time='TIME')
@@ -117,25 +189,47 @@ def test_log_queue():
     C.log_warning('msg3')
     C.log('msg4', C.CRITICAL)
 
-    assert C.LOG_QUEUE[0] == 'test: TIME: CRITICAL: msg4'
-    assert C.LOG_QUEUE[1] == 'test: TIME: WARNING: msg3'
-    assert C.LOG_QUEUE[2] == 'test: TIME: INFO: msg2'
+    assert str(C.LOG_QUEUE[0]) == 'test: TIME: CRITICAL: msg4'
+    assert str(C.LOG_QUEUE[1]) == 'test: TIME: WARNING: msg3'
+    assert str(C.LOG_QUEUE[2]) == 'test: TIME: INFO: msg2'
     assert len(C.LOG_QUEUE) == 3
 
     C.set_queue_len(2)
-    assert C.LOG_QUEUE[0] == 'test: TIME: CRITICAL: msg4'
-    assert C.LOG_QUEUE[1] == 'test: TIME: WARNING: msg3'
+    assert str(C.LOG_QUEUE[0]) == 'test: TIME: CRITICAL: msg4'
+    assert str(C.LOG_QUEUE[1]) == 'test: TIME: WARNING: msg3'
     assert len(C.LOG_QUEUE) == 2
 
     C.log_alert('msg5')
-    assert C.LOG_QUEUE[0] == 'test: TIME: CRITICAL: msg5'
-    assert C.LOG_QUEUE[1] == 'test: TIME: CRITICAL: msg4'
+    assert str(C.LOG_QUEUE[0]) == 'test: TIME: CRITICAL: msg5'
+    assert str(C.LOG_QUEUE[1]) == 'test: TIME: CRITICAL: msg4'
     assert len(C.LOG_QUEUE) == 2
 
     assert C.last_logs() == 'test: TIME: CRITICAL: msg5\ntest: TIME: CRITICAL: msg4'
     assert C.last_logs_html() == '<p>test: TIME: CRITICAL: msg5<br/>test: TIME: CRITICAL: msg4'
 
 
+def test_log_records():
+    C.init_log('test', logfile=None, log_queue_len=100, clear=True,
+               filter_level_stderr=C.NEVER, filter_level_syslog=C.NEVER, force_time='TIME')
+    for i in range(10): C.log('info %d' % i)
+    C.log_error('disk full')
+    C.log_warning('disk slow')
+
+    r = C.LOG_QUEUE[0]
+    assert (r.level, r.title, r.msg) == (C.WARNING, 'test', 'disk slow')
+    assert C.last_logs(level='warning') == 'test: TIME: WARNING: disk slow\ntest: TIME: ERROR: disk full'
+    assert C.last_logs(level=C.ERROR) == 'test: TIME: ERROR: disk full'
+    assert [r.msg for r in C.log_records(substring='disk')] == ['disk slow', 'disk full']
+    assert [r.msg for r in C.log_records(offset=2, limit=3)] == ['info 9', 'info 8', 'info 7']
+    assert [r.msg for r in C.log_records(substring='info', offset=8)] == ['info 1', 'info 0']
+
+    C.set_queue_len(5)
+    assert len(C.LOG_QUEUE) == 5
+    C.log('newest')
+    assert len(C.LOG_QUEUE) == 5
+    assert C.LOG_QUEUE[0].msg == 'newest'
+
+
 # ---------- web get
 
 '''
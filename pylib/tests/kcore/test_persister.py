@@ -231,6 +231,320 @@ def test_ListOfDataclasses(tmp_path):
     assert d2.get_data()[1].f2 == 44
 
 
+# ---------- json serializer
+
+def test_json_serializer(tmp_path):
+    tempfile = str(tmp_path / "tempfile")
+    d1 = P.DictOfDataclasses(tempfile, Dc2, serializer=P.JSON)
+    with d1.get_rw():
+        d1['a'] = Dc2(1, 'x')
+        d1['b'] = Dc2(2, 'y', 'z')
+        d1['b'].not_a_field = 'skipped'
+
+    with open(tempfile) as f: serialized = f.read()
+    assert serialized == '{"a":{"f2":1,"f1":"x","f3":"f3-default"},"b":{"f2":2,"f1":"y","f3":"z"}}\n'
+
+    d2 = P.PersisterDictOfDC(tempfile, Dc2, serializer=P.JSON)
+    assert d2.get_data()['b'] == Dc2(2, 'y', 'z')
+
+    tempfile2 = str(tmp_path / "tempfile2")
+    l1 = P.PersisterListOfDC(tempfile2, Dc1, serializer=P.JSON)
+    l1.set_data([Dc1('s', 1), Dc1('t', 2)])
+    assert P.PersisterListOfDC(tempfile2, Dc1, serializer=P.JSON).get_data()[1] == Dc1('t', 2)
+
+    tempfile3 = str(tmp_path / "tempfile3")
+    p1 = P.PersisterDC(tempfile3, Dc1, serializer=P.JSON)
+    p1.set_data(Dc1('u', 3))
+    assert P.PersisterDC(tempfile3, Dc1, serializer=P.JSON).get_data() == Dc1('u', 3)
+
+    tempfile4 = str(tmp_path / "tempfile4")
+    P.Persister(tempfile4, password='pw', serializer=P.JSON).set_data({'k': [1, 'two', None]})
+    assert P.Persister(tempfile4, password='pw', serializer=P.JSON).get_data() == {'k': [1, 'two', None]}
+
+
+def test_json_migration(tmp_path):
+    tempfile = str(tmp_path / "tempfile")
+    with open(tempfile, 'w') as f:
+        f.write("'key1': Dc1(f1='str1', f2=11)\n'key2': Dc1(f1='str2', f2=22)\n")
+
+    d1 = P.PersisterDictOfDC(tempfile, Dc1, serializer=P.JSON)
+    assert d1.get_data()['key2'].f2 == 22      # Legacy format is still readable.
+    assert d1.migrate()
+    with open(tempfile) as f: assert f.read().startswith('{"key1":{"f1":"str1"')
+    d2 = P.PersisterDictOfDC(tempfile, Dc1, serializer=P.JSON)
+    assert d2.get_data() == d1.get_data()
+
+
+# ---------- journal mode
+
+def test_journal(tmp_path):
+    tempfile = str(tmp_path / "tempfile")
+    d1 = P.DictOfDataclasses(tempfile, Dc1, serializer=P.JSON, journal=True, compact_bytes=300)
+    with d1.get_rw():
+        d1['a'] = Dc1('x', 1)
+        d1['b'] = Dc1('y', 2)
+    assert not os.path.isfile(tempfile)      # Only the journal so far.
+
+    with d1.get_rw():
+        d1['b'].f2 = 3
+    with open(tempfile + '.journal') as f: lines = f.read().split('\n')
+    assert lines[2] == '{"k": "b", "v": {"f1": "y", "f2": 3}}'     # Only the change was written.
+
+    d2 = P.PersisterDictOfDC(tempfile, Dc1, serializer=P.JSON, journal=True)
+    assert d2.get_data() == {'a': Dc1('x', 1), 'b': Dc1('y', 3)}
+
+    time.sleep(0.01)
+    with d1.get_rw():
+        del d1['a']
+    assert d2.get_data() == {'b': Dc1('y', 3)}
+
+    # A torn final line (e.g. power loss mid-write) is skipped.
+    with open(tempfile + '.journal', 'a') as f: f.write('{"k": "c", "v": {"f1"')
+    d3 = P.PersisterDictOfDC(tempfile, Dc1, serializer=P.JSON, journal=True)
+    assert d3.get_data() == {'b': Dc1('y', 3)}
+    with d3.get_rw(): d3.get_data()['c'] = Dc1('w', 4)    # ... and doesn't swallow the next record.
+    d1.load_from_file()
+    assert sorted(d1) == ['b', 'c']
+    with d1.get_rw(): del d1['c']
+
+    # Pass the compaction threshold.
+    for i in range(5):
+        with d1.get_rw(): d1['k%d' % i] = Dc1('z', i)
+    if d1._compactor: d1._compactor.join()
+    assert os.path.isfile(tempfile)
+    assert not os.path.isfile(tempfile + '.journal.compacting')
+    d4 = P.PersisterDictOfDC(tempfile, Dc1, serializer=P.JSON, journal=True)
+    assert d4.get_data() == dict(d1)
+    assert len(d4.get_data()) == 6
+
+    d1.compact(wait=True)
+    assert not os.path.isfile(tempfile + '.journal')
+    assert P.PersisterDictOfDC(tempfile, Dc1, serializer=P.JSON).get_data() == dict(d1)
+
+
+def test_write_file_atomic_keeps_mode(tmp_path):
+    tempfile = str(tmp_path / "tempfile")
+    P.write_file_atomic(tempfile, 'one')
+    os.chmod(tempfile, 0o600)
+    P.write_file_atomic(tempfile, 'two')
+    assert os.stat(tempfile).st_mode & 0o777 == 0o600
+    with open(tempfile) as f: assert f.read() == 'two'
+
+
+def test_write_file_atomic_symlink_and_failure(tmp_path):
+    target = str(tmp_path / "target")
+    link = str(tmp_path / "link")
+    P.write_file_atomic(target, 'one')
+    os.symlink(target, link)
+    P.write_file_atomic(link, 'two')
+    assert os.path.islink(link)
+    with open(target) as f: assert f.read() == 'two'
+
+    # A failed write leaves neither a temp file nor a changed file.
+    try:
+        P.write_file_atomic(target, None)
+        assert False, 'expected TypeError'
+    except TypeError:
+        pass
+    assert sorted(os.listdir(tmp_path)) == ['link', 'target']
+    with open(target) as f: assert f.read() == 'two'
+
+
+def test_journal_interrupted_compaction(tmp_path):
+    tempfile = str(tmp_path / "tempfile")
+    d1 = P.DictOfDataclasses(tempfile, Dc1, serializer=P.JSON, journal=True)
+    with d1.get_rw():
+        d1['a'] = Dc1('x', 1)
+        d1['b'] = Dc1('y', 2)
+
+    # Crash right after the journal was set aside: only .compacting is left.
+    os.replace(tempfile + '.journal', tempfile + '.journal.compacting')
+    d2 = P.DictOfDataclasses(tempfile, Dc1, serializer=P.JSON, journal=True)
+    assert sorted(d2) == ['a', 'b']
+
+    # Retrying keeps the leftover records as well as the new ones.
+    with d2.get_rw(): d2['c'] = Dc1('z', 3)
+    d2.compact(wait=True)
+    assert not os.path.isfile(tempfile + '.journal.compacting')
+    assert sorted(P.PersisterDictOfDC(tempfile, Dc1, serializer=P.JSON).get_data()) == ['a', 'b', 'c']
+
+
+def test_journal_inplace_mutation(tmp_path):
+    tempfile = str(tmp_path / "tempfile")
+    d1 = P.DictOfDataclasses(tempfile, Dc1, serializer=P.JSON, journal=True)
+    with d1.get_rw(): d1['a'] = Dc1('x', [1])
+    with d1.get_rw(): d1['a'].f2.append(2)
+    d2 = P.PersisterDictOfDC(tempfile, Dc1, serializer=P.JSON, journal=True)
+    assert d2.get_data()['a'].f2 == [1, 2]
+
+
+def test_journal_dirty_keys(tmp_path, monkeypatch):
+    tempfile = str(tmp_path / "tempfile")
+    d1 = P.PersisterDictOfDC(tempfile, Dc1, serializer=P.JSON, journal=True, cow=True)
+    with d1.get_rw() as d:
+        for i in range(50): d[f'k{i}'] = Dc1('x', i)
+    snapshot = d1.get_data()
+
+    encoded = []
+    real_dc_to_plain = P.dc_to_plain
+    monkeypatch.setattr(P, 'dc_to_plain', lambda v: encoded.append(v) or real_dc_to_plain(v))
+    with d1.get_rw(dirty_keys=['k1']) as d:
+        d['k1'].f2 = 100       # in place, as promised
+        d['new'] = Dc1('y', 1)
+        del d['k2']
+    assert len(encoded) == 2   # k1 and new; nothing else was re-encoded.
+    assert snapshot['k1'].f2 == 1 and 'k2' in snapshot   # The reader's snapshot is untouched.
+
+    d2 = P.PersisterDictOfDC(tempfile, Dc1, serializer=P.JSON, journal=True)
+    data = d2.get_data()
+    assert data['k1'].f2 == 100 and data['new'] == Dc1('y', 1) and 'k2' not in data
+    assert len(data) == 50
+
+
+def test_journal_compaction_keeps_other_writers(tmp_path):
+    tempfile = str(tmp_path / "tempfile")
+    d1 = P.DictOfDataclasses(tempfile, Dc1, serializer=P.JSON, journal=True)
+    d2 = P.DictOfDataclasses(tempfile, Dc1, serializer=P.JSON, journal=True)
+    with d1.get_rw(): d1['a'] = Dc1('x', 1)
+    with d2.get_rw(): d2['b'] = Dc1('y', 2)    # d1 hasn't seen this.
+    d1.compact(wait=True)
+    assert sorted(P.PersisterDictOfDC(tempfile, Dc1, serializer=P.JSON).get_data()) == ['a', 'b']
+
+
+# ---------- watched freshness
+
+def wait_for(condition, timeout=2):
+    deadline = time.time() + timeout
+    while not condition() and time.time() < deadline: time.sleep(0.01)
+    return condition()
+
+def test_watch(tmp_path):
+    tempfile = str(tmp_path / "tempfile")
+    d1 = P.Persister(tempfile)
+    d2 = P.Persister(tempfile, watch=True)
+    d1.set_data([1])
+    assert d2.get_data() == [1]
+    if not P.get_watcher(): return    # No inotify here; polling is covered below.
+    assert d2._inotify
+
+    # Fresh checks don't touch the file...
+    orig_mtime = d2.get_file_mtime
+    d2.get_file_mtime = lambda: 1 / 0
+    assert d2.get_data() == [1]
+    d2.get_file_mtime = orig_mtime
+
+    # ...but external changes are still noticed.
+    d1.set_data([2])
+    assert wait_for(lambda: d2._stale)
+    assert d2.get_data() == [2]
+
+    # Our own saves don't flag us as stale.
+    d2.set_data([3])
+    time.sleep(0.1)
+    assert not d2._stale
+
+
+def test_watch_polling_fallback(tmp_path):
+    tempfile = str(tmp_path / "tempfile")
+    d1 = P.Persister(tempfile)
+    d1.set_data('a')
+    orig_watcher, orig_interval = P.WATCHER, P.WATCH_POLL_INTERVAL
+    try:
+        P.WATCHER = False
+        P.WATCH_POLL_INTERVAL = 0.2
+        d2 = P.Persister(tempfile, watch=True)
+        assert d2.get_data() == 'a'
+        time.sleep(0.01)
+        d1.set_data('b')
+        assert d2.get_data() == 'a'     # Within the poll interval.
+        time.sleep(0.25)
+        assert d2.get_data() == 'b'
+    finally:
+        P.WATCHER, P.WATCH_POLL_INTERVAL = orig_watcher, orig_interval
+
+
+def test_watch_lost_and_collected(tmp_path, monkeypatch):
+    import gc, shutil
+    if not P.get_watcher(): return
+    monkeypatch.setattr(P, 'WATCH_POLL_INTERVAL', 0.01)
+    subdir = tmp_path / "sub"
+    subdir.mkdir()
+    tempfile = str(subdir / "tempfile")
+    P.Persister(tempfile).set_data('a')
+    d2 = P.Persister(tempfile, watch=True)
+    assert d2.get_data() == 'a'
+    assert d2._inotify
+
+    # A queue overflow means events were lost, so everything is rechecked.
+    P.WATCHER._handle(P.InotifyWatcher.EVENT.pack(-1, P.InotifyWatcher.IN_Q_OVERFLOW, 0, 0))
+    assert d2._stale
+    assert d2.get_data() == 'a'
+
+    # Deleting the directory loses the watch; d2 falls back to polling.
+    shutil.rmtree(str(subdir))
+    assert wait_for(lambda: not d2._inotify)
+    subdir.mkdir()
+    P.Persister(tempfile).set_data('b')
+    assert wait_for(lambda: d2.get_data() == 'b')
+
+    # Watched Persisters don't leak once dropped.
+    d3 = P.Persister(str(tmp_path / "other"), watch=True)
+    d3.get_data()
+    dirname = str(tmp_path)
+    assert len(P.WATCHER.persisters[dirname]) == 1
+    del d3
+    gc.collect()
+    assert P.WATCHER.persisters[dirname] == []
+
+
+# ---------- copy-on-write and writer locking
+
+def test_cow(tmp_path):
+    tempfile = str(tmp_path / "tempfile")
+    d1 = P.PersisterDictOfDC(tempfile, Dc1, cow=True)
+    with d1.get_rw() as d: d['a'] = Dc1('x', 1)
+
+    snapshot = d1.get_data()
+    with d1.get_rw() as d:
+        d['a'].f2 = 2
+        d['b'] = Dc1('y', 3)
+    assert snapshot == {'a': Dc1('x', 1)}       # Readers' snapshots never change underneath them.
+    assert d1.get_data() == {'a': Dc1('x', 2), 'b': Dc1('y', 3)}
+
+    try:
+        with d1.get_rw() as d:
+            d['c'] = Dc1('z', 4)
+            raise RuntimeError('abort')
+    except RuntimeError: pass
+    assert 'c' not in d1.get_data()             # Failed writers don't publish.
+    assert 'c' not in P.PersisterDictOfDC(tempfile, Dc1).get_data()
+    assert os.listdir(tmp_path) == ['tempfile']  # No temp files left behind.
+
+    try:
+        P.DictOfDataclasses(tempfile, Dc1, cow=True)
+        assert '' == 'fail: expected exception'
+    except ValueError: pass
+
+
+def test_concurrent_writers(tmp_path):
+    import threading
+    tempfile = str(tmp_path / "tempfile")
+    for kwargs in ({}, {'cow': True}):
+        d1 = P.Persister(tempfile, default_value={'n': 0}, **kwargs)
+        d1.set_data({'n': 0})
+        def bump():
+            for i in range(20):
+                with d1.get_rw() as d: d['n'] += 1
+        threads = [threading.Thread(target=bump) for i in range(5)]
+        for t in threads: t.start()
+        for t in threads: t.join()
+        assert d1.get_data()['n'] == 100
+        assert P.Persister(tempfile).get_data()['n'] == 100
+
+    with d1.get_rw_locked_thread() as d: d['n'] = 5
+    assert P.Persister(tempfile).get_data()['n'] == 5
+
+
 # ---------- with encryption
 
 def test_encryption_addin(tmp_path):
@@ -128,6 +128,37 @@ def test_symmetric_encryption():
     assert UC.decrypt(encrypted, password, 'wrong-salt').startswith('ERROR')
 
 
+def test_key_cache(monkeypatch):
+    import cryptography.hazmat.primitives.kdf.pbkdf2 as pbkdf2
+    derivations = []
+    real_kdf = pbkdf2.PBKDF2HMAC
+    monkeypatch.setattr(pbkdf2, 'PBKDF2HMAC', lambda **kwargs: derivations.append(1) or real_kdf(**kwargs))
+
+    UC.wipe_key_cache()
+    encrypted = UC.encrypt('data', 'pw1')
+    assert len(derivations) == 1
+
+    for i in range(10): assert UC.decrypt(encrypted, 'pw1') == 'data'
+    assert len(derivations) == 1      # All cache hits.
+    assert len(UC._KEY_CACHE) == 1
+
+    orig_max = UC.KEY_CACHE_MAX
+    try:
+        UC.KEY_CACHE_MAX = 2
+        UC.encrypt('data', 'pw2')
+        UC.encrypt('data', 'pw3')
+        assert len(UC._KEY_CACHE) == 2   # pw1 evicted.
+    finally:
+        UC.KEY_CACHE_MAX = orig_max
+
+    assert len(derivations) == 3
+
+    UC.wipe_key_cache()
+    assert len(UC._KEY_CACHE) == 0
+    assert UC.decrypt(encrypted, 'pw1') == 'data'
+    assert len(derivations) == 4      # Derived again after the wipe.
+
+
 def test_gpg_symmetric():
     # not supported in python2
     if sys.version_info[0] == 2: return err('test_gpg_symmetric not supported in py2; skipping test.')
@@ -6,7 +6,7 @@ port connections.
 
 import context_kcore     # fix path to includes work as expected in tests
 
-import os, random
+import json, os, random, threading, time
 import kcore.common as C
 import kcore.webserver as W
 import kcore.varz as V
@@ -100,3 +100,134 @@ def test_prometheus_metrics():
     assert 'varz_stamp1_total{program="pytest-3"} 3.0' in metrics
     assert 'healthz_info{program="pytest-3",value="error1"} 1.0' in metrics
     assert 'healthz_status{program="pytest-3"} 1.0' in metrics
+
+
+def test_histogram():
+    h = V.Histogram()
+    assert h.percentile(50) is None
+    for i in range(90): h.observe(3)
+    for i in range(10): h.observe(700)
+    assert h.count == 100
+    assert h.percentile(50) == 5
+    assert h.percentile(90) == 5
+    assert h.percentile(99) == 700     # capped at the observed max.
+    assert h.summary()['avg'] == 72.7
+
+    ws = start()
+    V.reset()
+    V.observe('lat', 12)
+    assert V.get('lat').count == 1
+    assert C.read_web(url('varz?lat')).startswith('n=1 avg=12.0')
+
+
+def test_concurrent_counters():
+    V.reset()
+    V.set('ctr', 5)
+    def worker():
+        for i in range(10000): V.bump('ctr')
+    threads = [threading.Thread(target=worker) for i in range(8)]
+    for t in threads: t.start()
+    for t in threads: t.join()
+    assert V.get('ctr') == 80005
+    assert V.VARZ['ctr'] == 80005
+    assert V.get_dict()['ctr'] == 80005
+
+    # Shards from exited threads get folded in without losing counts.
+    for i in range(40):
+        t = threading.Thread(target=V.inc, args=('ctr', 2))
+        t.start(); t.join()
+    assert V.get('ctr') == 80085
+
+    V.set('ctr', 1)      # set() replaces the counter with a plain value.
+    V.bump('ctr')
+    assert V.get('ctr') == 2
+
+
+def race_first_use(func, n=16):
+    barrier = threading.Barrier(n)
+    def worker():
+        barrier.wait()
+        func()
+    threads = [threading.Thread(target=worker) for i in range(n)]
+    for t in threads: t.start()
+    for t in threads: t.join()
+
+
+def test_concurrent_histogram_creation():
+    V.reset()
+    for i in range(20):
+        race_first_use(lambda: V.observe('h%d' % i, 5))
+        assert dict.get(V.VARZ, 'h%d' % i).count == 16
+
+
+def test_concurrent_rate_creation():
+    V.reset()
+    for i in range(20):
+        race_first_use(lambda: V.rate('r%d' % i))
+        assert dict.get(V.VARZ, 'r%d' % i).count(60) == 16
+
+
+def test_rate():
+    r = V.Rate()
+    t0 = r.start
+    for i in range(30): r.mark(now=t0 + i)          # 1/sec for 30 seconds.
+    assert r.count(60, now=t0 + 30) == 30
+    assert r.rate(60, now=t0 + 30) == 1.0            # Only 30s elapsed, so the span is 30s.
+    for i in range(30, 120): r.mark(now=t0 + i)
+    assert abs(r.rate(60, now=t0 + 120) - 1.0) < 0.1
+    assert r.count(900, now=t0 + 120) == 120
+    assert r.count(60, now=t0 + 400) == 0             # Old buckets age out.
+    assert r.count(900, now=t0 + 400) == 120
+    assert r.count(900, now=t0 + 5000) == 0           # Idle longer than the whole ring.
+    assert r.total == 120
+
+    ws = start()
+    V.reset()
+    V.rate('triggers', 5)
+    assert V.get('triggers').count(60) == 5
+    assert C.read_web(url('varz?triggers')).startswith('1m=')
+    assert V.get('web-qps').total == 1
+
+
+def test_changes_since():
+    V.reset()
+    V.set('a', 1)
+    V.set('b', 'x')
+    gen, changes = V.changes_since(0)
+    assert changes == {'a': 1, 'b': 'x'}
+    assert V.changes_since(gen) == (gen, {})
+
+    V.bump('a')
+    gen2, changes = V.changes_since(gen)
+    assert gen2 > gen
+    assert changes == {'a': 2}
+
+    # Long-poll: returns as soon as a matching key changes.
+    threading.Timer(0.3, V.set, args=('b', 'y')).start()
+    t0 = time.time()
+    gen3, changes = V.changes_since(gen2, timeout=5, prefix='b')
+    assert changes == {'b': 'y'}
+    assert time.time() - t0 < 4
+
+    ws = start()
+    out = json.loads(C.read_web(url('varz?since=%d&prefix=b' % gen3)))
+    assert out['changes'] == {}
+    out = json.loads(C.read_web(url('varz?since=0')))
+    assert out['changes']['b'] == 'y'
+    assert out['generation'] >= gen3
+
+    # Without a prefix, the poll's own web-* bookkeeping doesn't end the wait...
+    gen = out['generation']
+    t0 = time.time()
+    out = json.loads(C.read_web(url('varz?since=%d&wait=0.5' % gen)))
+    assert time.time() - t0 >= 0.5
+    assert not [k for k in out['changes'] if not k.startswith('web-')]
+    # ... but anything else does.
+    threading.Timer(0.2, V.set, args=('c', 1)).start()
+    t0 = time.time()
+    out = json.loads(C.read_web(url('varz?since=%d&wait=5' % out['generation'])))
+    assert out['changes']['c'] == 1
+    assert time.time() - t0 < 4
+
+    assert C.web_get(url('varz?since=0&wait=-1')).status_code == 400
+    assert C.web_get(url('varz?since=0&wait=x')).status_code == 400
@@ -6,7 +6,7 @@ port connections.
 
 import context_kcore     # fix path to includes work as expected in tests
 
-import pytest, random, subprocess, threading, time
+import os, pytest, random, subprocess, sys, threading, time
 import kcore.common as C
 import kcore.webserver as W
 
@@ -19,8 +19,12 @@ ROUTES = {
     '/get':     lambda request: request.get_params.get('g'),
     '/post':    lambda request: request.post_params.get('p'),
     '/post2':   lambda request: str(request.post_params),
+    '/upload':  lambda request: '%d' % request.post_params['f'][0].size,
+    '/bodylen': lambda request: '%d' % len(request.body or b''),
     '/quit':    lambda request: request.server.shutdown(), # q(request),
     r'/match/(\w+)': lambda request: request.route_match_groups[0],
+    '/gen':     lambda _: ('line %d\n' % i for i in range(1000)),
+    '/file':    lambda _: W.file_response('testdata/file1'),
 }
 
 def random_high_port(): return random.randrange(10000, 19999)
@@ -88,3 +92,353 @@ def test_tls():
     assert 'https' in my_url
     got = C.web_get_e(my_url, verify_ssl=True, cafile='testdata/server-cn=localhost.crt')
     assert got.text == 'hello world'
+
+
+def test_keep_alive():
+    import http.client
+    ws = start({}, {'keep_alive': True, 'keep_alive_max_requests': 3})
+    conn = http.client.HTTPConnection('localhost', PORT, timeout=5)
+
+    conn.request('GET', '/hi')
+    resp = conn.getresponse()
+    assert resp.read() == b'hello world'
+    assert resp.getheader('Connection') == 'keep-alive'
+    sock = conn.sock
+    assert sock
+
+    conn.request('GET', '/get?g=h')
+    resp = conn.getresponse()
+    assert resp.read() == b'h'
+    assert conn.sock is sock      # same TCP connection reused.
+
+    # Third request hits the per-connection cap.
+    conn.request('GET', '/hi')
+    resp = conn.getresponse()
+    assert resp.read() == b'hello world'
+    assert resp.getheader('Connection') == 'close'
+    conn.close()
+    ws.httpd.shutdown()
+
+
+def test_keep_alive_unparsed_post_body():
+    import http.client
+    ws = start({}, {'keep_alive': True})
+    conn = http.client.HTTPConnection('localhost', PORT, timeout=5)
+    conn.request('POST', '/hi', body='{"x": [1, 2, 3]}', headers={'Content-Type': 'application/json'})
+    resp = conn.getresponse()
+    assert resp.read() == b'hello world'
+    conn.request('GET', '/get?g=h')
+    resp = conn.getresponse()
+    assert resp.status == 200
+    assert resp.read() == b'h'
+    conn.close()
+    ws.httpd.shutdown()
+
+
+def test_no_keep_alive_by_default():
+    import http.client
+    ws = start()
+    conn = http.client.HTTPConnection('localhost', PORT, timeout=5)
+    conn.request('GET', '/hi')
+    resp = conn.getresponse()
+    assert resp.read() == b'hello world'
+    assert resp.getheader('Connection') == 'close'
+    conn.close()
+    ws.httpd.shutdown()
+
+
+# ---------- asyncio server class
+
+def test_asyncio_basics():
+    ws = start({'c': 'hello'}, {'server_class': W.AsyncioHTTPServer})
+    assert C.read_web(url('hi')) == 'hello world'
+    assert C.web_get_e(url('get?a=b&g=h&x=y')).text == 'h'
+    assert C.web_get_e(url('post'), post_dict={'p': 'q'}).text == 'q'
+    assert subprocess.check_output(['curl', '-sS', '--form', 'a=b', url('post2')]) == b"{'a': ['b']}"
+    assert C.web_get_e(url('context')).text == 'hello'
+    assert C.web_get_e(url('match/v1')).text == 'v1'
+    assert C.web_get(url('nope')).status_code == 404
+    ws.httpd.shutdown()
+    ws.web_thread.join()
+
+
+def test_asyncio_post_bodies(monkeypatch):
+    import http.client
+    monkeypatch.setattr(W, 'MAX_BUFFERED_BODY', 1000)
+    ws = start({}, {'server_class': W.AsyncioHTTPServer, 'keep_alive': True})
+    conn = http.client.HTTPConnection('localhost', PORT, timeout=5)
+
+    # A multipart upload bigger than MAX_BUFFERED_BODY is streamed to the parser.
+    upload = b'x' * 300000
+    body = (b'--bnd\r\nContent-Disposition: form-data; name="f"; filename="a.bin"\r\n\r\n' +
+            upload + b'\r\n--bnd--\r\n')
+    conn.request('POST', '/upload', body=body, headers={'Content-Type': 'multipart/form-data; boundary=bnd'})
+    assert conn.getresponse().read() == b'300000'
+
+    conn.request('POST', '/bodylen', body='{"a": 1}', headers={'Content-Type': 'application/json'})
+    assert conn.getresponse().read() == b'8'
+
+    conn.request('POST', '/bodylen', body='x' * 2000, headers={'Content-Type': 'application/json'})
+    assert conn.getresponse().status == 413
+    conn.close()
+    ws.httpd.shutdown()
+
+
+
+def test_asyncio_slow_uploads_dont_block_workers():
+    import functools, socket
+    ws = start({}, {'server_class': functools.partial(W.AsyncioHTTPServer, max_workers=2)})
+    slow = []
+    for i in range(3):     # More slow uploaders than workers.
+        sock = socket.create_connection(('localhost', PORT))
+        sock.sendall(b'POST /post HTTP/1.1\r\nContent-Type: application/x-www-form-urlencoded\r\n'
+                     b'Content-Length: 100\r\n\r\np=')
+        slow.append(sock)
+    try:
+        assert C.web_get(url('hi'), timeout=2).text == 'hello world'
+    finally:
+        for sock in slow: sock.close()
+    ws.httpd.shutdown()
+
+
+@pytest.mark.timeout(3)
+def test_asyncio_shutdown_from_handler():
+    threading.Timer(1.0, send_quit_request_url).start()
+    ws = start({}, {'background': False, 'server_class': W.AsyncioHTTPServer})
+
+
+def test_asyncio_keep_alive():
+    import http.client
+    ws = start({}, {'server_class': W.AsyncioHTTPServer, 'keep_alive': True})
+    conn = http.client.HTTPConnection('localhost', PORT, timeout=5)
+    for i in range(3):
+        conn.request('GET', '/hi')
+        resp = conn.getresponse()
+        assert resp.read() == b'hello world'
+        assert resp.getheader('Connection') == 'keep-alive'
+        if i == 0: sock = conn.sock
+        assert conn.sock is sock
+    conn.close()
+    ws.httpd.shutdown()
+
+
+def test_asyncio_tls():
+    ws = start({},
+               {'server_class': W.AsyncioHTTPServer,
+                'tls_cert_file': 'testdata/server-cn=localhost.crt',
+                'tls_key_file': 'testdata/server-cn=localhost.pem'})
+    got = C.web_get_e(url('hi', tls=True), verify_ssl=True, cafile='testdata/server-cn=localhost.crt')
+    assert got.text == 'hello world'
+    ws.httpd.shutdown()
+
+
+# ---------- pooled server class
+
+def test_pooled_server_backpressure():
+    import functools
+    import kcore.varz as V
+    release = threading.Event()
+    ROUTES['/block'] = lambda _: release.wait(5) and 'released'
+    try:
+        V.reset()
+        ws = start({}, {'server_class': functools.partial(W.PooledHTTPServer, pool_size=1, queue_size=1)})
+        assert C.read_web(url('hi')) == 'hello world'
+
+        results = {}
+        def get(name): results[name] = C.web_get(url('block'))
+        t1 = threading.Thread(target=get, args=('a',))
+        t1.start()
+        time.sleep(0.3)   # 'a' now occupies the only worker.
+        t2 = threading.Thread(target=get, args=('b',))
+        t2.start()
+        time.sleep(0.3)   # 'b' now occupies the only queue slot.
+
+        resp = C.web_get(url('hi'))
+        assert resp.status_code == 503
+        assert V.get('web-pool-rejected') == 1
+
+        release.set()
+        t1.join()
+        t2.join()
+        assert results['a'].text == 'released'
+        assert results['b'].text == 'released'
+        assert V.get('web-pool-wait-ms-max') >= 200
+        ws.httpd.shutdown()
+        ws.httpd.server_close()
+    finally:
+        ROUTES.pop('/block')
+
+
+def test_varz_stats_sampler():
+    ws = start()
+    assert W.STATS_SAMPLER
+    t0 = time.time()
+    page = C.read_web(url('varz'))
+    assert time.time() - t0 < 0.9      # used to block for cpu_percent(interval=1).
+    assert 'sys-stats-time' in page
+    sampler = W.StatsSampler(interval=1)
+    sampler.sample()
+    sampler.sample()
+    assert len(sampler.cpu_samples) == 2
+    assert sampler.cpu_average(60) is not None
+    assert sampler.snapshot['sys-cpu-1m'] is not None
+
+
+# ---------- streaming responses
+
+def check_streaming():
+    import http.client
+    expected = ''.join(['line %d\n' % i for i in range(1000)])
+    conn = http.client.HTTPConnection('localhost', PORT, timeout=5)
+    conn.request('GET', '/gen')
+    resp = conn.getresponse()
+    assert resp.getheader('Transfer-Encoding') == 'chunked'
+    assert resp.read().decode() == expected
+    conn.close()
+
+    with open('testdata/file1', 'rb') as f: file1 = f.read()
+    resp = C.web_get(url('file'))
+    assert resp.content == file1
+    assert int(resp.headers['Content-Length']) == len(file1)
+    assert C.web_get(url('gen')).text == expected
+
+def test_streaming():
+    ws = start()
+    check_streaming()
+    ws.httpd.shutdown()
+
+def test_streaming_asyncio():
+    ws = start({}, {'server_class': W.AsyncioHTTPServer})
+    check_streaming()
+    ws.httpd.shutdown()
+
+
+def test_compression():
+    page = '<p>' + 'hello world ' * 500
+    ROUTES['/big'] = lambda _: page
+    try:
+        ws = start()
+        resp = C.web_get(url('big'))    # requests sends Accept-Encoding: gzip by default.
+        assert resp.headers['Content-Encoding'] == 'gzip'
+        assert resp.text == page
+        assert subprocess.check_output(['curl', '-sS', url('big')]).decode() == page
+        ws.httpd.shutdown()
+    finally:
+        ROUTES.pop('/big')
+
+
+# ---------- file cache
+
+def test_file_cache(tmp_path):
+    fc = W.FileCache(check_interval=0)
+    tmpl = str(tmp_path / 't.html')
+    with open(tmpl, 'w') as f: f.write('<p>{{ a }} and {{ b }} and {{ c }}</p>')
+    assert fc.render(tmpl, {'a': 1, 'b': 'two'}) == '<p>1 and two and {{ c }}</p>'
+    entry = fc.get(tmpl)
+    assert fc.get(tmpl) is entry                  # unchanged file => same cache entry.
+
+    resp = fc.response(W.Request('GET', '/t.html'), tmpl)
+    assert resp.status_code == 200
+    assert resp.msg_type == 'text/html'
+    etag = resp.extra_headers['ETag']
+    assert fc.response(W.Request('GET', '/t.html', headers={'If-None-Match': etag}), tmpl).status_code == 304
+    resp = fc.response(W.Request('GET', '/t.html', headers={'If-None-Match': W.encoded_etag(etag, 'gzip')}), tmpl)
+    assert resp.status_code == 304
+    assert resp.extra_headers['ETag'] == W.encoded_etag(etag, 'gzip')
+
+    time.sleep(0.01)
+    with open(tmpl, 'w') as f: f.write('<p>{{ a }} changed</p>')
+    os.utime(tmpl, (time.time() + 5, time.time() + 5))
+    assert fc.render(tmpl, {'a': 'x'}) == '<p>x changed</p>'
+    assert fc.response(W.Request('GET', '/t.html', headers={'If-None-Match': etag}), tmpl).status_code == 200
+
+    assert fc.response(None, str(tmp_path / 'nope')).status_code == 404
+
+    big = W.FileCache(max_file_size=4)
+    assert big.response(None, tmpl).stream is not None     # too big to cache => streamed.
+    big.response(None, tmpl).stream.close()
+
+
+# ---------- POST parsing
+
+def test_multipart_parser():
+    import io
+    body = (b'--XyZ\r\nContent-Disposition: form-data; name="a"\r\n\r\nb\r\n'
+            b'--XyZ\r\nContent-Disposition: form-data; name="a"\r\n\r\nsecond\r\n'
+            b'--XyZ\r\nContent-Disposition: form-data; name="up"; filename="f.bin"\r\n'
+            b'Content-Type: application/octet-stream\r\n\r\n' + b'\r\n--Xy' * 30000 + b'\r\n'
+            b'--XyZ--\r\n')
+    got = W.parse_post_data('multipart/form-data; boundary="XyZ"', len(body), io.BytesIO(body))
+    assert got['a'] == ['b', 'second']
+    up = got['up'][0]
+    assert up.filename == 'f.bin'
+    assert up.size == 6 * 30000
+    assert up.value == b'\r\n--Xy' * 30000
+
+    with pytest.raises(W.PostError) as e:
+        W.parse_post_data('multipart/form-data; boundary=XyZ', len(body), io.BytesIO(body), max_post_size=1000)
+    assert e.value.status_code == 413
+    with pytest.raises(W.PostError):
+        W.parse_post_data('multipart/form-data; boundary=XyZ', 50, io.BytesIO(body[:50]))
+
+def test_parse_header():
+    assert W.parse_header('text/plain') == ('text/plain', {})
+    assert W.parse_header('Multipart/Form-Data; boundary="a b"; x=y') == ('multipart/form-data', {'boundary': 'a b', 'x': 'y'})
+
+def test_post_too_large():
+    ws = start({}, {'max_post_size': 100})
+    assert C.web_get(url('post'), post_dict={'p': 'q'}).text == 'q'
+    resp = C.web_get(url('post'), post_dict={'p': 'q' * 200})
+    assert resp.status_code == 413
+    ws.httpd.shutdown()
+
+
+# ---------- profiler
+
+def busy_loop(stop):
+    while not stop.is_set(): sum(range(1000))
+
+def test_profz():
+    ws = W.WebServer(ROUTES, profz=True)
+    assert '/profz' not in W.WebServer(ROUTES).standard_handlers
+    stop = threading.Event()
+    t = threading.Thread(target=busy_loop, args=(stop,), name='busy')
+    t.start()
+    try:
+        resp = ws.test_handler('/profz?seconds=0.3&interval_ms=5')
+    finally:
+        stop.set()
+        t.join()
+    assert resp.status_code == 200
+    lines = resp.body.strip().split('\n')
+    busy = [l for l in lines if l.startswith('busy;')]
+    assert busy
+    assert 'test_webserver.py:busy_loop:' in busy[0]
+    assert int(busy[0].rsplit(' ', 1)[1]) > 0
+    assert ws.test_handler('/profz?seconds=x').status_code == 400
+    for bad in ['-1', 'nan', 'inf', 'x']:
+        assert ws.test_handler('/profz?seconds=0.1&interval_ms=' + bad).status_code == 400
+
+
+def test_profz_min_interval(monkeypatch):
+    ws = W.WebServer(ROUTES, profz=True)
+    intervals = []
+    monkeypatch.setattr(W, 'sample_stacks', lambda seconds, interval, idle: intervals.append(interval) or {})
+    assert ws.test_handler('/profz?seconds=0.1&interval_ms=0').status_code == 200
+    assert intervals == [W.PROFZ_MIN_INTERVAL_MS / 1000.0]
+
+
+def test_profz_idle_frames():
+    import queue
+    q = queue.Queue()
+    t = threading.Thread(target=q.get, name='idle')
+    t.start()
+    try:
+        time.sleep(0.05)
+        assert W.is_idle_frame(sys._current_frames()[t.ident])
+    finally:
+        q.put(None)
+        t.join()
+
+    def get(): return sys._getframe()     # User code with a common name isn't idle.
+    assert not W.is_idle_frame(get())
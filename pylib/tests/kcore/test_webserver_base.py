@@ -1,6 +1,7 @@
 
 import context_kcore     # fix path to includes work as expected in tests
 
+import kcore.common0 as C
 import kcore.webserver_base as B
 import kcore.varz
 
@@ -64,7 +65,7 @@ def test_unquote_get_params():
     assert len(d) == 1
     assert d['x1'] == 'a b c+d e'
 
-    orig = B.CIRCUITPYTHON
+    B.CIRCUITPYTHON = orig
 
 def test_finding_handlers():
     wsb = B.WebServerBase(paths, wrap_handlers=False, logging_adapter=None)
@@ -168,6 +169,32 @@ def test_standard_handlers():
     assert '<td>web-path-healthz</td><td>1</td>' in wsb.test_handler('/varz').body
     assert wsb.test_handler('/varz?web-path-healthz').body == '1'
 
+def test_logz_filtering():
+    C.init_log('test', logfile=None, log_queue_len=100, clear=True, filter_level_stderr=C.NEVER,
+               filter_level_syslog=C.NEVER, force_time='TIME')
+    for i in range(5): C.log('msg%d' % i)
+    C.log_error('oops')
+    adapter = B.LoggingAdapter(None, None, None, None, C.last_logs_html)
+    wsb = B.WebServerBase([], logging_adapter=adapter)
+    assert wsb.test_handler('/logz?level=error').body == '<p>test: TIME: ERROR: oops'
+    body = wsb.test_handler('/logz?q=msg&limit=2').body
+    assert 'msg4<br/>test: TIME: INFO: msg3<p>' in body
+    assert 'offset=2' in body
+    assert 'msg2<br/>test: TIME: INFO: msg1<p>' in wsb.test_handler('/logz?q=msg&limit=2&offset=2').body
+    assert wsb.test_handler('/logz?limit=x').status_code == 400
+    assert wsb.test_handler('/logz?level=bogus').status_code == 400
+    assert 'older' not in wsb.test_handler('/logz?q=msg&limit=5').body     # no more records.
+
+    # Only the known params make it into the "older" link, and they're escaped.
+    for i in range(2): C.log('a "<b> b')
+    body = wsb.test_handler('/logz?%22%3E%3Cscript%3E=1&q=%22%3Cb%3E&limit=1').body
+    assert '<script>' not in body
+    assert 'href="/logz?q=%22%3Cb%3E&amp;limit=1&amp;offset=1"' in body
+
+    # Adapters whose get_logz_html takes no args still work.
+    wsb = B.WebServerBase([], logging_adapter=B.LoggingAdapter(None, None, None, None, lambda: 'plain'))
+    assert wsb.test_handler('/logz?limit=2').body == 'plain'
+
 def test_mixed_hanlder_types():
     handlers = { None: lambda _: 'default' }
     handlers.update(paths)
@@ -182,3 +209,168 @@ def test_match_groups():
         {r'/(\w+)/(\w+)/x': lambda rqst: "%s::%s" % (rqst.route_match_groups[0], rqst.route_match_groups[1])},
         wrap_handlers=False, logging_adapter=None)
     assert wsb.test_handler('/d1/d2/x').body == 'd1::d2'
+
+def test_router_precedence():
+    # An earlier dynamic route beats a later literal one, and vice-versa.
+    wsb = B.WebServerBase([(r'/a/\w+', lambda _: 'dyn'), ('/a/lit', lambda _: 'lit'),
+                           ('/b/lit', lambda _: 'lit'), (r'/b/\w+', lambda _: 'dyn'),
+                           ('/ab?c', lambda _: 'opt'), ('/x|/y', lambda _: 'alt')],
+                          wrap_handlers=False, logging_adapter=None)
+    assert wsb.test_handler('/a/lit').body == 'dyn'
+    assert wsb.test_handler('/b/lit').body == 'lit'
+    assert wsb.test_handler('/b/other').body == 'dyn'
+    assert wsb.test_handler('/ac').body == 'opt'
+    assert wsb.test_handler('/abc').body == 'opt'
+    assert wsb.test_handler('/y').body == 'alt'
+    assert wsb._route_index[0]['/a/lit'][0] == 1
+    assert len(wsb._route_index[1]) == 4
+
+def test_router_concurrent_changes():
+    import sys, threading
+    wsb = B.WebServerBase({'/lit': lambda _: 'lit', r'/dyn/\w+': lambda _: 'dyn'},
+                          wrap_handlers=False, logging_adapter=None)
+    stop = threading.Event()
+    def churn():
+        while not stop.is_set():
+            wsb.add_handler('/extra', lambda _: 'x')
+            wsb.del_handler('/extra')
+    t = threading.Thread(target=churn)
+    old_interval = sys.getswitchinterval()
+    sys.setswitchinterval(1e-6)     # Switch threads often, to catch a part-built index.
+    t.start()
+    try:
+        for i in range(20000):
+            assert wsb._route('/lit')[0] is not None
+            assert wsb._route('/dyn/a')[0] is not None
+    finally:
+        stop.set()
+        t.join()
+        sys.setswitchinterval(old_interval)
+
+def test_match_groups_not_shared():
+    wsb = B.WebServerBase({r'/m/(\w+)': lambda rqst: rqst.route_match_groups[0]},
+                          wrap_handlers=False, logging_adapter=None)
+    assert wsb.test_handler('/m/one').body == 'one'
+    handler_data, groups = wsb._route('/m/two')
+    assert groups == ('two',)
+    assert not hasattr(handler_data, 'match_groups')
+
+def test_response_cache():
+    import threading, time
+    calls = []
+    def slow_handler(request):
+        calls.append(request.full_path)
+        time.sleep(0.2)
+        return 'v%d' % len(calls)
+    wsb = B.WebServerBase([], wrap_handlers=False, logging_adapter=None)
+    wsb.add_handler('/slow', slow_handler, cache_ttl=0.5, cache_max_entries=2)
+
+    # Concurrent requests for the same path share one computation.
+    out = []
+    threads = [threading.Thread(target=lambda: out.append(wsb.test_handler('/slow').body)) for i in range(4)]
+    for t in threads: t.start()
+    for t in threads: t.join()
+    assert out == ['v1'] * 4
+    assert len(calls) == 1
+
+    # Distinct GET params are cached separately, and LRU eviction applies.
+    assert wsb.test_handler('/slow?a=1').body == 'v2'
+    assert wsb.test_handler('/slow?a=2').body == 'v3'
+    assert wsb.test_handler('/slow?a=2').body == 'v3'
+    assert wsb.test_handler('/slow').body == 'v4'      # evicted by the above.
+
+    # Entries expire, and POSTs are never cached.
+    time.sleep(0.6)
+    assert wsb.test_handler('/slow?a=2').body == 'v5'
+    assert wsb.test_handler('/slow?a=2', method='POST').body == 'v6'
+
+def test_response_cache_skips_errors():
+    answers = [B.Response('bad', 500), 'good', 'not-reached']
+    wsb = B.WebServerBase([], wrap_handlers=False, logging_adapter=None)
+    wsb.add_handler('/x', lambda _: answers.pop(0), cache_ttl=10)
+    assert wsb.test_handler('/x').status_code == 500
+    assert wsb.test_handler('/x').body == 'good'
+    assert wsb.test_handler('/x').body == 'good'
+
+def test_response_cache_shares_uncacheable_answers():
+    import threading, time
+    calls = []
+    def unavailable(request):
+        calls.append(1)
+        time.sleep(0.2)
+        return B.Response('busy', 503)
+    wsb = B.WebServerBase([], wrap_handlers=False, logging_adapter=None)
+    wsb.add_handler('/u', unavailable, cache_ttl=10)
+    kcore.varz.reset()
+    out = []
+    threads = [threading.Thread(target=lambda: out.append(wsb.test_handler('/u').status_code)) for i in range(5)]
+    for t in threads: t.start()
+    for t in threads: t.join()
+    assert out == [503] * 5
+    assert len(calls) == 1                         # Waiters got the in-flight answer...
+    assert kcore.varz.get('web-cache-miss') == 1
+    assert wsb.test_handler('/u').status_code == 503
+    assert len(calls) == 2                         # ... but it wasn't cached.
+
+def test_streaming_response():
+    wsb = B.WebServerBase({'/gen': lambda _: (str(i) for i in range(3))}, wrap_handlers=False, logging_adapter=None)
+    resp = wsb.test_handler('/gen')
+    assert resp.stream is not None
+    assert resp.body == ''
+    assert resp.msg_type == 'text'
+    assert resp.materialize().body == '012'
+    assert resp.stream is None
+
+def test_compression():
+    import gzip, zlib
+    page = '<table>' + '<tr><td>x</td></tr>' * 200 + '</table>'
+    wsb = B.WebServerBase({'/big': lambda _: page, '/small': lambda _: 'tiny'},
+                          wrap_handlers=False, logging_adapter=None)
+    resp = wsb.test_handler('/big', headers={'Accept-Encoding': 'gzip, deflate'})
+    assert resp.extra_headers['Content-Encoding'] == 'gzip'
+    assert gzip.decompress(resp.body).decode() == page
+    assert len(resp.body) < len(page) / 10
+    assert wsb.test_handler('/big', headers={'Accept-Encoding': 'gzip, deflate'}).body == resp.body  # from cache
+
+    resp = wsb.test_handler('/big', headers={'Accept-Encoding': 'gzip;q=0, deflate'})
+    assert resp.extra_headers['Content-Encoding'] == 'deflate'
+    assert zlib.decompress(resp.body).decode() == page
+
+    assert wsb.test_handler('/big').body == page                                          # not accepted
+    assert wsb.test_handler('/big').extra_headers['Vary'] == 'Accept-Encoding'
+
+    # Each encoding gets its own ETag.
+    wsb.add_handler('/tagged', lambda _: B.Response(page, extra_headers={'ETag': '"v1"'}))
+    assert wsb.test_handler('/tagged').extra_headers['ETag'] == '"v1"'
+    assert wsb.test_handler('/tagged', headers={'Accept-Encoding': 'gzip'}).extra_headers['ETag'] == '"v1-gzip"'
+    assert B.encoded_etag('W/"v1"', 'deflate') == 'W/"v1-deflate"'
+    assert wsb.test_handler('/small', headers={'Accept-Encoding': 'gzip'}).body == 'tiny'  # too small
+
+def test_choose_encoding():
+    assert B.choose_encoding(None) is None
+    assert B.choose_encoding('identity') is None
+    assert B.choose_encoding('br, gzip;q=0.5') == 'gzip'
+    assert B.choose_encoding('*') == 'gzip'
+    assert B.choose_encoding('*, gzip;q=0') == 'deflate'
+
+def test_latency_tracking():
+    import time
+    kcore.varz.reset()
+    log = []
+    logger = B.LoggingAdapter(None, None, log.append, None, None)
+    wsb = B.WebServerBase({r'/slow/\w+': lambda _: time.sleep(0.06) or 'zzz', None: lambda _: 'dflt'},
+                          wrap_handlers=False, logging_adapter=logger, slow_request_ms=50)
+    wsb.test_handler('/slow/a')
+    wsb.test_handler('/slow/b')
+    wsb.test_handler('/healthz')
+    wsb.test_handler('/anything')
+    h = kcore.varz.get('web-latency-/slow/\\w+')
+    assert h.count == 2
+    assert h.percentile(50) >= 50
+    assert 'n=2' in str(h)
+    assert kcore.varz.get('web-latency-/healthz').count == 1
+    assert kcore.varz.get('web-latency-default').count == 1
+    assert kcore.varz.get('web-slow-requests') == 2
+    assert 'slow request: test /slow/a' in log[0]
+    assert kcore.varz.get('web-inflight') == 0
+    assert kcore.varz.get('web-inflight-max') == 1
@@ -61,7 +61,7 @@ class CookieData:
   last_update: int
   data: typing.Dict[str, str]
 
-COOKIE_DATA = P.DictOfDataclasses('data/session_cookies.data', CookieData)
+COOKIE_DATA = P.DictOfDataclasses('data/session_cookies.data', CookieData, serializer=P.JSON)
 
 
 # ---------- private.d overrides
@@ -61,11 +61,7 @@ def get_session_data(request):
 # ---------- template system
 
 def render(template_filename, repl):
-    out = C.read_file(os.path.join(TEMPLATE_DIR, template_filename), wrap_exceptions=False)
-    for seek0, replace in repl.items():
-        seek = '{{ ' + seek0 + ' }}'
-        out = out.replace(seek, str(replace))
-    return out
+    return W.render_template(os.path.join(TEMPLATE_DIR, template_filename), repl)
 
 
 # ---------- handlers
@@ -202,7 +202,7 @@ class PartitionState:
     def __post_init__(self): self.last_update_nice = nice_time(self.last_update)
 
     
-PARTITION_STATE = P.DictOfDataclasses('data/partition_state.data', PartitionState)
+PARTITION_STATE = P.PersisterDictOfDC('data/partition_state.data', PartitionState, cow=True)
 
 
 @dataclass
@@ -214,7 +214,7 @@ class TouchData:
     def __post_init__(self): self.last_update_nice = nice_time(self.last_update)
 
     
-TOUCH_DATA = P.DictOfDataclasses('data/touch.data', TouchData)
+TOUCH_DATA = P.PersisterDictOfDC('data/touch.data', TouchData, serializer=P.JSON, journal=True, watch=True, cow=True)
 
 
 # ---------- private.d overrides
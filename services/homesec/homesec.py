@@ -180,7 +180,8 @@ def main(argv=[]):
 
   C.init_log('homesec', '-' if args.debug else args.logfile,
              filter_level_logfile=C.DEBUG if args.debug else C.INFO,
-             filter_level_syslog=C.CRITICAL if args.syslog else C.NEVER)
+             filter_level_syslog=C.CRITICAL if args.syslog else C.NEVER,
+             async_write=True)
 
   # ---- Security inits that require keymanager queries
 
@@ -1,7 +1,7 @@
 
 # see homesec.py for doc
 
-import datetime, hashlib, os, time
+import copy, datetime, hashlib, os, time
 
 import data
 
@@ -24,6 +24,7 @@ def get_friendly_touches():
   for touch in get_all_touches():
     tl = lookup_trigger(touch.trigger)
     if not tl or not tl.friendly_name: continue
+    touch = copy.copy(touch)   # TOUCH_DATA is a shared read-only snapshot.
     touch.friendly_name = tl.friendly_name
     touch.tardy = (time_now - touch.last_update) > tl.tardy_time
     out.append(touch)
@@ -107,6 +108,7 @@ def partition_states():
   for ps in data.PARTITION_STATE.get_data().values():
     new_state = resolve_auto(ps.state)
     if new_state != ps.state:
+      ps = copy.copy(ps)   # PARTITION_STATE data is a shared read-only snapshot.
       ps.state = '%s(auto)' % new_state
     answer.append(ps)
   return answer
@@ -153,7 +155,7 @@ def touch(trigger_name, value=''):
      'value' is generally only used if the trigger is the name of a user, and
      the user's "at home" state is being updated to "home" or "away".  '''
   time_now = now()
-  with data.TOUCH_DATA.get_rw() as d:
+  with data.TOUCH_DATA.get_rw(dirty_keys=[trigger_name]) as d:
     target = d.get(trigger_name, None)
     if not target:
       # Not found, so create a new one.
@@ -39,7 +39,16 @@ def test_static_view():
     V.STATIC_DIR = 'tests'
     fake_request = W.Request('GET', '/static/template_test.html')
     resp = V.static_view(fake_request)
-    assert resp == 'this is a lot of {{ something }}.\n'
+    assert resp.body == b'this is a lot of {{ something }}.\n'
+    assert resp.msg_type == 'text/html'
+
+    # Conditional GET
+    fake_request.headers = {'If-None-Match': resp.extra_headers['ETag']}
+    assert V.static_view(fake_request).status_code == 304
+    fake_request.headers = {'If-Modified-Since': resp.extra_headers['Last-Modified']}
+    assert V.static_view(fake_request).status_code == 304
+    fake_request.headers = {'If-None-Match': '"something-else"'}
+    assert V.static_view(fake_request).status_code == 200
 
     fake_request = W.Request('GET', '/static/nonexistent')
     resp = V.static_view(fake_request)
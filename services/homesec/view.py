@@ -74,11 +74,7 @@ def authn_required(func):
 # ---------- template system
 
 def render(template_filename, repl):
-  out = C.read_file(os.path.join(TEMPLATE_DIR, template_filename), wrap_exceptions=False)
-  for seek0, replace in repl.items():
-    seek = '{{ ' + seek0 + ' }}'
-    out = out.replace(seek, str(replace))
-  return out
+  return W.render_template(os.path.join(TEMPLATE_DIR, template_filename), repl)
 
 
 # ---------- handlers
@@ -119,8 +115,7 @@ def static_view(request):
   if not os.path.isfile(pathname):
       C.log_warning(f'attempt to read non-existent static file {pathname}')
       return W.Response('file not found', 404)
-  mode = 'r' if filename.endswith('.css') or filename.endswith('.html') else 'rb'
-  with open(pathname, mode) as f: return f.read()
+  return W.static_response(request, pathname)
 
 
 @authn_required
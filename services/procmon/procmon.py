@@ -144,7 +144,7 @@ def get_docker_map():
       continue
     cid, name = i.split(' ', 1)
     cid_map[cid] = name
-  C.log_debug(f'procmap: {cid_map}')
+  C.log_debug('procmap: %s', cid_map)
   return cid_map
 
 
@@ -267,19 +267,19 @@ class Scanner(object):
       wl.hit_last = now()
       wl.hit_count += 1
       wl.hit_count_last_scan += 1
-    C.log_debug('proc: %s; wl: %s' % (pd.desc, wl))
+    C.log_debug('proc: %s; wl: %s', pd.desc, wl)
 
     if not wl:  # first check if its on the greylist.
       gl = self.find_whitelist_entry(WL.GREYLIST, pd)
       if gl:
-        C.log_debug('proc: %s; gl: %s' % (pd.desc, gl))
+        C.log_debug('proc: %s; gl: %s', pd.desc, gl)
         gl.hit_last = now()
         gl.hit_count += 1
         gl.hit_count_last_scan += 1
         return self.add_to_pset(self.greylisted, pd)
 
       else:  # Neither whitelist nor greylist; this is an unexpected process.
-        C.log_debug('UNEXPECTED: %s' % pd.desc)
+        C.log_debug('UNEXPECTED: %s', pd.desc)
         return self.add_to_pset(self.unexpected, pd)
 
     if wl.allow_children:
@@ -305,11 +305,11 @@ class Scanner(object):
       for i, part in enumerate(parts):
         if part == b'-id':
           cid = parts[i + 1].decode()[:12]
-          C.log_debug(f'pid {init_pid}: got cid from -id (docker style): {cid}')
+          C.log_debug('pid %s: got cid from -id (docker style): %s', init_pid, cid)
           break
         elif part.startswith(b'/usr/bin/conmon'):
           cid = parts[i + 4].decode()[:12]
-          C.log_debug('pid {init_pid}: got cid from conmon (podman style): {cid}')
+          C.log_debug('pid %s: got cid from conmon (podman style): %s', init_pid, cid)
           break
       else:
         return self.add_error_process(pd, f'unable to get container id for pid {init_pid}')
@@ -318,7 +318,7 @@ class Scanner(object):
       return self.add_error_process(pd, f'Unable to parse docker shim; {cpuset=}, {cid=}, {match=}, {cname=}, {e=}')
 
     # We have a container name, so add the subtree.
-    C.log_debug('adding container subtree. parent pid=%d, cname=%s, cid=%s, children=%s' % (pd.pid, cname, cid, shim_children_pids))
+    C.log_debug('adding container subtree. parent pid=%d, cname=%s, cid=%s, children=%s', pd.pid, cname, cid, shim_children_pids)
     self.add_pid_list(shim_children_pids, cname)
 
 
@@ -335,7 +335,7 @@ class Scanner(object):
 
   def add_to_pset(self, pset, pd, note=''):
     if pd.cmdline == '':
-      C.log_debug(f'skipping add of process with empty cmdline: {pd.desc}')
+      C.log_debug('skipping add of process with empty cmdline: %s', pd.desc)
       return
     if note: pd.note = note
     pset.add(pd.pid)
@@ -500,7 +500,8 @@ def main(argv=[]):
   ARGS = parse_args(argv or sys.argv[1:])
   C.init_log('procmon', ARGS.logfile,
              filter_level_stderr=C.DEBUG if ARGS.debug else C.NEVER,
-             filter_level_syslog=C.NEVER if ARGS.no_syslog else C.CRITICAL)
+             filter_level_syslog=C.NEVER if ARGS.no_syslog else C.CRITICAL,
+             async_write=True)
 
   global WL
   WL = UC.load_file_as_module(ARGS.whitelist)